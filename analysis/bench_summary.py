@@ -0,0 +1,76 @@
+# Benchmark for parallel log summarizing.
+#
+# Creates a folder of synthetic logs (similar in size to real test logs at 0.1 s intervals) and
+# times log_summary.summarize_parallel() with increasing numbers of worker processes.
+# Use 'bench_summary.py --help' for a summary of usage options.
+
+import os
+import random
+import sys
+import tempfile
+from time import perf_counter
+
+from log_summary import summarize_parallel
+from statlog import Channel, Log, LogEntry
+
+num_logs = 64
+num_samples = 1500
+log_format = 'json'
+
+for arg in sys.argv[1:]:
+    tmp = arg.split('=')
+    match tmp[0]:
+        case '--logs':
+            num_logs = int(tmp[1])
+        case '--samples':
+            num_samples = int(tmp[1])
+        case '--format':
+            log_format = tmp[1]
+        case _:
+            print('Usage: bench_summary.py [--logs=64] [--samples=1500] [--format=json|npz]')
+            exit(0 if tmp[0] == '--help' else 1)
+
+
+def make_log(seed: int) -> Log:
+    rng = random.Random(seed)
+    log = Log()
+    log.time_log_start = 0
+    log.time_log_end = num_samples * 0.1
+    stamps = ['LOG_START', 'IDLE_START', 'IDLE_END', 'MODEL_LOAD_START', 'MODEL_LOAD_END', 'GENERATE_START', 'GENERATE_END', 'LOG_END']
+    for j, stamp in enumerate(stamps):
+        log.timestamps.append(LogEntry(log.time_log_end * j / (len(stamps) - 1), stamp))
+    log.memory_ram[1000] = Channel()
+    log.memory_gpu[1000] = Channel()
+    for j in range(num_samples):
+        t = j * 0.1
+        log.power.append(t, 5 + 10 * rng.random())
+        log.freq_gpu.append(t, 1300)
+        log.memory_ram[1000].append(t, 100000 + j)
+        log.memory_gpu[1000].append(t, 50000 + j)
+    log.tokens_generated = 64
+    return log
+
+
+with tempfile.TemporaryDirectory() as folder:
+    print(f'Creating {num_logs} logs with {num_samples} samples each...')
+    paths = list()
+    for j in range(num_logs):
+        path = os.path.join(folder, f'log_{j}.{log_format}')
+        make_log(j).save(path)
+        paths.append(path)
+
+    print('Processes | Time (s) | Logs/s | Speedup')
+    baseline = None
+    processes = 1
+    cpus = os.cpu_count() or 1
+    while True:
+        t_start = perf_counter()
+        for _ in summarize_parallel(paths, processes):
+            pass
+        t_total = perf_counter() - t_start
+        if baseline is None:
+            baseline = t_total
+        print(f'{processes:>9} | {t_total:>8.3f} | {num_logs / t_total:>6.1f} | {baseline / t_total:>6.2f}x')
+        if processes >= cpus:
+            break
+        processes = min(processes * 2, cpus)
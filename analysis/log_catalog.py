@@ -0,0 +1,112 @@
+# Shared helper for finding and indexing test logs for the analysis scripts.
+#
+# Log files are discovered once and indexed by the tags in their filenames, so looking up
+# the iterations of a specific configuration doesn't require scanning every log. Log
+# filenames follow the pattern created by tests/run_tests.py:
+#
+#   log_<model>_<iteration>[_no-quant][_<extra tags>...]_<device>_<power mode>.<json|npz|ndjson>
+
+import os
+import sys
+
+_ANALYSIS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(_ANALYSIS_DIR, '..', 'tests'))
+import statlog
+
+DEFAULT_FOLDER = os.path.abspath(os.path.join(_ANALYSIS_DIR, '..', 'tests', 'out'))
+'''Default folder to search for logs (tests/out)'''
+LOG_EXTENSIONS = ['.json', '.npz', '.ndjson']
+'''File extensions of supported log formats'''
+
+# important test naming info
+def m_name(param):
+    return f'pythia-{param}-deduped'
+device_order = ['agx-orin-devkit', 'agx-orin-32gb', 'orin-nx-16gb', 'orin-nx-8gb', 'orin-nano-8gb', 'orin-nano-4gb']
+pm_order = ['7W', '7W-AI', '7W-CPU', '10W', '15W', '20W', '25W', '30W', '40W', '50W', 'MAXN']
+model_params = ['70m', '160m', '410m', '1.4b']
+model_order = [m_name(x) for x in model_params]
+device_pm_dict = {
+    'agx-orin-devkit': ['MAXN', '50W', '30W', '15W'],
+    'agx-orin-32gb': ['MAXN', '40W', '30W', '15W'],
+    'orin-nx-16gb': ['MAXN', '25W', '15W', '10W'],
+    'orin-nx-8gb': ['MAXN', '20W', '15W', '10W'],
+    'orin-nano-8gb': ['15W', '7W'],
+    'orin-nano-4gb': ['10W', '7W-AI', '7W-CPU']
+}
+
+
+class LogRecord:
+    '''Information about a single log file, parsed from its filename.'''
+    path: str
+    device: str
+    pm: str
+    model: str
+    iteration: int
+    quant: bool
+    '''False if the log was run with the no-quant option.'''
+    tags: tuple[str, ...]
+    '''Any extra tags in the filename (other than no-quant), in order.'''
+
+    def __init__(self, path: str):
+        self.path = path
+        name, ext = os.path.splitext(os.path.basename(path))
+        if not name.startswith('log_') or ext not in LOG_EXTENSIONS:
+            raise ValueError(f'Not a log file: {path}')
+        data = name[4:].split('_')
+        if len(data) < 4:
+            raise ValueError(f'Not enough tags in log filename: {path}')
+        self.device = data.pop(-2)
+        self.pm = data.pop(-1)
+        self.model = data.pop(0)
+        self.iteration = int(data.pop(0))
+        self.quant = 'no-quant' not in data
+        self.tags = tuple(x for x in data if x != 'no-quant')
+
+    def key(self) -> tuple:
+        '''Returns the configuration key used to index this log in a LogCatalog.'''
+        return (self.device, self.pm, self.model, self.quant, self.tags)
+
+    def load(self) -> statlog.Log:
+        '''Loads the log file.'''
+        return statlog.load(self.path)
+
+
+class LogCatalog:
+    '''Index of all log files in a folder (searched recursively).'''
+    records: list[LogRecord]
+    '''All logs found, sorted by configuration and iteration.'''
+    max_iterations: int
+    '''Highest iteration number seen in any log.'''
+
+    _index: dict[tuple, list[LogRecord]]
+
+    def __init__(self, in_folder: str = DEFAULT_FOLDER):
+        print('Searching...')
+        self.records = list()
+        for p, _, fs in os.walk(in_folder):
+            for f in fs:
+                if f.startswith('log_') and os.path.splitext(f)[1] in LOG_EXTENSIONS:
+                    try:
+                        self.records.append(LogRecord(os.path.join(p, f)))
+                    except ValueError:
+                        print(f'Skipping log with unexpected filename: {f}')
+        self.records.sort(key=lambda x: (x.key(), x.iteration, x.path))
+        print(f'Found {len(self.records)} logs')
+
+        self.max_iterations = max([x.iteration for x in self.records], default=0)
+        self._index = dict()
+        for rec in self.records:
+            self._index.setdefault(rec.key(), list()).append(rec)
+
+    def find(self, device: str, pm: str, model: str, quant: bool = True, tags: tuple[str, ...] = ()) -> list[LogRecord]:
+        '''Returns the logs for the given configuration, sorted by iteration.
+        Only logs with exactly the given extra tags are returned.'''
+        return self._index.get((device, pm, model, quant, tuple(tags)), list())
+
+    def load(self, device: str, pm: str, model: str, quant: bool = True, tags: tuple[str, ...] = ()) -> list[statlog.Log]:
+        '''Loads the logs for the given configuration, sorted by iteration.'''
+        return [rec.load() for rec in self.find(device, pm, model, quant, tags)]
+
+    def configs(self) -> list[tuple]:
+        '''Returns the keys of every configuration found.'''
+        return list(self._index.keys())
@@ -0,0 +1,118 @@
+# Vectorized metrics for time series in test logs.
+#
+# All functions take sorted arrays of sample times and values (i.e. from statlog.Channel.to_numpy())
+# and select windows with np.searchsorted instead of checking every sample. Window edges are
+# linearly interpolated, so energy over a period isn't biased by where samples happen to land
+# relative to the period's timestamps.
+
+import numpy as np
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tests'))
+from statlog import Channel, Log
+
+DEFAULT_PERCENTILES = (50, 90, 99)
+'''Power percentiles reported by period_metrics()'''
+
+
+def window(times: np.ndarray, values: np.ndarray, t_start: float, t_end: float, interpolate: bool = True) -> tuple[np.ndarray, np.ndarray]:
+    '''Returns the samples between t_start and t_end (inclusive).
+    If interpolate is True, values at exactly t_start and t_end are interpolated and added at the edges.'''
+    i_start = np.searchsorted(times, t_start, side='left')
+    i_end = np.searchsorted(times, t_end, side='right')
+    t = times[i_start:i_end]
+    v = values[i_start:i_end]
+    if not interpolate or len(times) == 0:
+        return t, v
+    edges_v = np.interp([t_start, t_end], times, values)
+    return np.concatenate(([t_start], t, [t_end])), np.concatenate(([edges_v[0]], v, [edges_v[1]]))
+
+def integrate(times: np.ndarray, values: np.ndarray) -> float:
+    '''Integrates a series using the trapezoid rule.'''
+    if len(times) < 2:
+        return 0.0
+    return float(np.sum((values[1:] + values[:-1]) * np.diff(times)) / 2)
+
+def energy(times: np.ndarray, values: np.ndarray, t_start: float, t_end: float) -> float:
+    '''Returns the energy (J) used between t_start and t_end, given a series of power measurements (W).'''
+    return integrate(*window(times, values, t_start, t_end))
+
+def peak(times: np.ndarray, values: np.ndarray, t_start: float, t_end: float) -> float:
+    '''Returns the highest sampled value between t_start and t_end, or NaN if there are no samples.'''
+    _, v = window(times, values, t_start, t_end, interpolate=False)
+    return float(np.max(v)) if len(v) > 0 else float('nan')
+
+def merge_pids(series: dict[int, Channel]) -> tuple[np.ndarray, np.ndarray, dict[int, np.ndarray]]:
+    '''Aligns per-process measurements (i.e. Log.memory_ram) on their shared sample times.
+
+    Returns the sorted unique sample times, the values summed over all processes at each time, and a
+    dictionary of per-process values aligned to those times (NaN where a process wasn't sampled).'''
+    if len(series) == 0:
+        return np.zeros(0), np.zeros(0), dict()
+    arrays = [ch.to_numpy() for ch in series.values()]
+    times, inverse = np.unique(np.concatenate([x[0] for x in arrays]), return_inverse=True)
+    inverse = inverse.reshape(-1)
+    summed = np.zeros(len(times))
+    np.add.at(summed, inverse, np.concatenate([x[1] for x in arrays]))
+
+    per_pid = dict()
+    offset = 0
+    for pid, (_, values) in zip(series.keys(), arrays):
+        aligned = np.full(len(times), np.nan)
+        aligned[inverse[offset:offset + len(values)]] = values
+        per_pid[pid] = aligned
+        offset += len(values)
+    return times, summed, per_pid
+
+def period_metrics(log: Log, t_start: float, t_end: float, percentiles: tuple = DEFAULT_PERCENTILES) -> dict:
+    '''Computes metrics for the period of a log between t_start and t_end.
+
+    Returns a dictionary with 'latency' (s), 'energy' (J), 'peak_power'/'mean_power' (W),
+    'p<N>_power' for each of the given percentiles (W), and 'peak_ram'/'peak_gpu' (KB, summed over
+    all logged processes). Mean power is time-weighted (energy / latency).'''
+    metrics = dict()
+    latency = t_end - t_start
+    metrics['latency'] = latency
+
+    p_times, p_values = log.power.to_numpy()
+    metrics['energy'] = energy(p_times, p_values, t_start, t_end)
+    metrics['peak_power'] = peak(p_times, p_values, t_start, t_end)
+    metrics['mean_power'] = metrics['energy'] / latency if latency > 0 else float('nan')
+    _, p_window = window(p_times, p_values, t_start, t_end, interpolate=False)
+    for pct in percentiles:
+        metrics[f'p{pct}_power'] = float(np.percentile(p_window, pct)) if len(p_window) > 0 else float('nan')
+
+    ram_times, ram_total, _ = merge_pids(log.memory_ram)
+    gpu_times, gpu_total, _ = merge_pids(log.memory_gpu)
+    metrics['peak_ram'] = peak(ram_times, ram_total, t_start, t_end)
+    metrics['peak_gpu'] = peak(gpu_times, gpu_total, t_start, t_end)
+    return metrics
+
+def token_metrics(log: Log, t_start: float, t_end: float, batch_size: int = 1, percentiles: tuple = DEFAULT_PERCENTILES) -> dict:
+    '''Computes per-token generation metrics from the tokens generated between t_start and t_end (see Log.token_latency).
+
+    Each recorded token time is one generation step, which produces a token for every sequence in the batch.
+    Returns a dictionary with 'steps', 'tokens' (steps times the batch size), 'ttft' (time to first token,
+    i.e. prefill, in s), 'decode_time' (time from the first token to the last, in s), 'prefill_fraction'
+    (of the total generation time), 'decode_rate' (tokens/s over the whole batch after the first token), and
+    'itl_mean'/'itl_p<N>' for each of the given percentiles (inter-token latency of each sequence, in s).
+    Returns an empty dictionary if no tokens were recorded.'''
+    times, latencies = window(*log.token_latency.to_numpy(), t_start, t_end, interpolate=False)
+    if len(times) == 0:
+        return dict()
+    ttft = float(latencies[0])
+    itl = latencies[1:]
+    decode_time = float(np.sum(itl))
+    metrics = {
+        'steps': len(times),
+        'tokens': len(times) * batch_size,
+        'ttft': ttft,
+        'decode_time': decode_time,
+        'prefill_fraction': ttft / (ttft + decode_time),
+        'decode_rate': len(itl) * batch_size / decode_time if decode_time > 0 else float('nan'),
+        'itl_mean': float(np.mean(itl)) if len(itl) > 0 else float('nan')
+    }
+    for pct in percentiles:
+        metrics[f'itl_p{pct}'] = float(np.percentile(itl, pct)) if len(itl) > 0 else float('nan')
+    return metrics
@@ -0,0 +1,222 @@
+# Per-log summary metrics for the analysis scripts, with a persistent cache.
+#
+# Most of the analysis scripts only need a handful of scalars from each log (period latency,
+# peak power, energy, peak memory). These are computed once per log by summarize() and stored
+# in an SQLite database in the log folder, keyed by the log's path, modification time and size.
+# Logs that are new or have changed since their last summary are re-read, everything else is
+# served from the cache.
+
+import json
+import multiprocessing
+import numpy as np
+import os
+import sqlite3
+from typing import Iterator
+
+from log_catalog import DEFAULT_FOLDER, LogRecord
+from log_metrics import period_metrics, token_metrics
+import statlog
+from statlog import Log
+
+CACHE_FILENAME = '.summary_cache.sqlite'
+'''Filename of the summary cache database, stored in the log folder'''
+SUMMARY_VERSION = 13
+'''Version of the summary metrics, increment when summarize() changes to invalidate old cache entries'''
+LOAD_PHASES = ['LOAD_CONFIG', 'LOAD_WEIGHTS', 'LOAD_TRANSFER', 'LOAD_TOKENIZER']
+'''Phases of MODEL_LOAD, in order, in logs of models loaded in phases (see tests/mmap_loader.py)'''
+PERIODS = ['MODEL_LOAD', 'GENERATE', 'PREFILL', 'DECODE'] + LOAD_PHASES
+'''Periods that are summarized for each log (PREFILL and DECODE split GENERATE at the first token)'''
+MAX_JITTER_P99 = 0.5
+'''Highest 99th percentile of sampler jitter (as a fraction of the interval) before a log is considered perturbed'''
+MAX_MISSED_TICKS = 0.01
+'''Highest fraction of missed sampler ticks before a log is considered perturbed'''
+MAX_SAMPLER_CPU_LOAD = 0.05
+'''Highest CPU load of the sampler thread before a log is considered perturbed'''
+
+
+def perturbed(sampler_info: dict) -> bool:
+    '''Returns True if the sampler's timing or overhead (see Log.sampler_info) suggests that measuring
+    perturbed the test. Logs without sampler timing information are never considered perturbed.'''
+    interval = sampler_info.get('interval', 0)
+    ticks = sampler_info.get('ticks', 0)
+    if interval <= 0 or ticks == 0:
+        return False
+    return sampler_info['jitter_p99'] > MAX_JITTER_P99 * interval \
+        or sampler_info['missed_ticks'] > MAX_MISSED_TICKS * (ticks + sampler_info['missed_ticks']) \
+        or sampler_info.get('cpu_load', 0) > MAX_SAMPLER_CPU_LOAD
+
+def summarize(log: Log) -> dict:
+    '''Computes summary metrics for a log.
+
+    Returns a dictionary containing 'tokens_generated', 'batch_size', 'truncated', 'perturbed' (see perturbed()) and
+    'sampler' (Log.sampler_info), 'message_delay' (the mean and max transport delay of messages from the test
+    process in seconds, if recorded), along with a dictionary of metrics for each period in PERIODS found in
+    the log (see log_metrics.period_metrics()). The 'GENERATE' period also contains 'tokens_per_second'
+    (over the whole batch). If per-token times were recorded, the 'GENERATE' period
+    also contains 'tokens', a dictionary of per-token metrics (see log_metrics.token_metrics()), and the
+    'PREFILL' and 'DECODE' periods contain 'energy_per_token' (J, over the first token of each sequence and the rest
+    respectively). For quantized models loaded in phases, the 'LOAD_TRANSFER' period also contains 'quantize_time'
+    (s), the part of the transfer spent quantizing the linear layers.
+    If the log has an idle baseline (Log.baseline), it is included as 'baseline', and each period also contains
+    'dynamic_energy' (J), its energy above the baseline power.
+
+    Logs of warm tests (see tests/run_tests.py --warm) have numbered GENERATE_<n> periods instead of GENERATE.
+    Their summaries contain 'requests', a list of the metrics of each request in order (with 'tokens_generated',
+    'tokens_per_second' and 'tokens' as above), and 'steady_tokens_per_second', the median throughput of the
+    requests after the first.'''
+    summary = dict()
+    summary['tokens_generated'] = log.tokens_generated
+    summary['batch_size'] = log.batch_size
+    summary['truncated'] = log.truncated
+    summary['perturbed'] = perturbed(log.sampler_info)
+    summary['sampler'] = log.sampler_info
+    if len(log.message_delay) > 0:
+        delays = log.message_delay.to_numpy()[1]
+        summary['message_delay'] = {'mean': float(np.mean(delays)), 'max': float(np.max(delays))}
+    summary['baseline'] = log.baseline
+    if len(log.baseline) == 0 and log.period('IDLE')[0] != -1:
+        # logs from before the baseline was recorded by the test runner still have their idle period
+        t_start, t_end = log.period('IDLE')
+        power, power_std, _ = log.power_stats(t_start, t_end)
+        if power != -1:
+            summary['baseline'] = {'power': power, 'power_std': power_std, 'duration': t_end - t_start, 'shared': False}
+    baseline_power = summary['baseline'].get('power', -1)
+
+    for period in PERIODS:
+        t_start, t_end = log.period(period)
+        if t_start == -1:
+            continue
+        summary[period] = period_metrics(log, t_start, t_end)
+        if baseline_power != -1:
+            summary[period]['dynamic_energy'] = summary[period]['energy'] - baseline_power * (t_end - t_start)
+        if period == 'GENERATE':
+            summary[period]['tokens_per_second'] = log.tokens_generated / (t_end - t_start) if t_end > t_start else float('nan')
+        if period == 'GENERATE' and len(log.token_latency) > 0:
+            summary[period]['tokens'] = token_metrics(log, t_start, t_end, log.batch_size)
+
+    if 'LOAD_TRANSFER' in summary:
+        # the time spent quantizing during the transfer is in a 'LOAD_QUANTIZE_TIME:<seconds>' timestamp
+        for entry in log.timestamps:
+            if entry.value.startswith('LOAD_QUANTIZE_TIME:'):
+                summary['LOAD_TRANSFER']['quantize_time'] = float(entry.value.split(':', 1)[1])
+
+    if 'PREFILL' in summary and 'DECODE' in summary and 'tokens' in summary.get('GENERATE', dict()).get('tokens', dict()):
+        # prefill gives the first token of every sequence in the batch
+        summary['PREFILL']['energy_per_token'] = summary['PREFILL']['energy'] / log.batch_size
+        decode_tokens = summary['GENERATE']['tokens']['tokens'] - log.batch_size
+        summary['DECODE']['energy_per_token'] = summary['DECODE']['energy'] / decode_tokens if decode_tokens > 0 else float('nan')
+
+    requests = [x for x in log.periods() if x.startswith('GENERATE_') and x[9:].isdigit()]
+    if len(requests) > 0:
+        # tokens generated by each request are in 'TOKENS_<n>:<count>' timestamps
+        request_tokens = dict()
+        for entry in log.timestamps:
+            if entry.value.startswith('TOKENS_') and ':' in entry.value:
+                name, count = entry.value.split(':', 1)
+                request_tokens[name[7:]] = int(count)
+        summary['requests'] = list()
+        for period in requests:
+            t_start, t_end = log.period(period)
+            metrics = period_metrics(log, t_start, t_end)
+            if baseline_power != -1:
+                metrics['dynamic_energy'] = metrics['energy'] - baseline_power * (t_end - t_start)
+            metrics['tokens_generated'] = request_tokens.get(period[9:], -1)
+            metrics['tokens_per_second'] = metrics['tokens_generated'] / (t_end - t_start) if t_end > t_start else float('nan')
+            if len(log.token_latency) > 0:
+                metrics['tokens'] = token_metrics(log, t_start, t_end, log.batch_size)
+            summary['requests'].append(metrics)
+        steady = [x['tokens_per_second'] for x in summary['requests'][1:]]
+        summary['steady_tokens_per_second'] = float(np.median(steady)) if len(steady) > 0 else float('nan')
+    return summary
+
+
+def _summarize_path(path: str) -> tuple[str, dict]:
+    return path, summarize(statlog.load(path))
+
+def summarize_parallel(paths: list[str], processes: int = None) -> Iterator[tuple[str, dict]]:
+    '''Loads and summarizes logs in a process pool, yielding (path, summary) pairs as they finish.
+
+    Each worker only sends back the summary of a log, never the log itself, so memory use is bounded
+    by the number of logs being parsed at once. If processes is 1 or the 'fork' start method isn't
+    available (the analysis scripts aren't safe to re-import in a spawned process), logs are
+    summarized serially instead.'''
+    if processes is None:
+        processes = os.cpu_count() or 1
+    processes = min(processes, len(paths))
+    if processes <= 1 or 'fork' not in multiprocessing.get_all_start_methods():
+        for path in paths:
+            yield _summarize_path(path)
+        return
+    with multiprocessing.get_context('fork').Pool(processes, maxtasksperchild=64) as pool:
+        for result in pool.imap_unordered(_summarize_path, paths):
+            yield result
+
+
+class SummaryCache:
+    '''Persistent cache of log summaries, stored in an SQLite database in the log folder.'''
+
+    def __init__(self, in_folder: str = DEFAULT_FOLDER, processes: int = None):
+        '''Opens (or creates) the cache for the given log folder.
+        Uncached logs are summarized using up to the given number of processes (Default: CPU count).'''
+        self._folder = os.path.abspath(in_folder)
+        self._processes = processes
+        os.makedirs(self._folder, exist_ok=True)
+        self._db = sqlite3.connect(os.path.join(self._folder, CACHE_FILENAME))
+        self._db.execute('CREATE TABLE IF NOT EXISTS summaries (path TEXT PRIMARY KEY, mtime REAL, size INTEGER, version INTEGER, summary TEXT)')
+        self._db.commit()
+
+    def _key(self, path: str) -> tuple[str, float, int]:
+        # paths are stored relative to the log folder, so the cache survives moving the folder
+        st = os.stat(path)
+        return os.path.relpath(os.path.abspath(path), self._folder), st.st_mtime, st.st_size
+
+    def _lookup(self, key: tuple[str, float, int]) -> dict:
+        row = self._db.execute('SELECT mtime, size, version, summary FROM summaries WHERE path = ?', (key[0],)).fetchone()
+        if row is None or row[0] != key[1] or row[1] != key[2] or row[2] != SUMMARY_VERSION:
+            return None
+        return json.loads(row[3])
+
+    def _store(self, key: tuple[str, float, int], summary: dict):
+        self._db.execute('INSERT OR REPLACE INTO summaries VALUES (?, ?, ?, ?, ?)', (key[0], key[1], key[2], SUMMARY_VERSION, json.dumps(summary)))
+
+    def get(self, record: LogRecord) -> dict:
+        '''Returns the summary of a log, loading and summarizing it if it isn't cached or has changed.'''
+        return self.get_many([record], include_truncated=True, include_perturbed=True)[0]
+
+    def get_many(self, records: list[LogRecord], include_truncated: bool = False, include_perturbed: bool = False) -> list[dict]:
+        '''Returns the summaries of several logs, in order.
+        Summaries of truncated logs (i.e. recovered from an interrupted test) are skipped unless include_truncated is True,
+        and summaries of logs perturbed by the sampler (see perturbed()) are skipped unless include_perturbed is True.'''
+        summaries: dict[str, dict] = dict()
+        keys: dict[str, tuple] = dict()
+        for rec in records:
+            keys[rec.path] = self._key(rec.path)
+            summary = self._lookup(keys[rec.path])
+            if summary is not None:
+                summaries[rec.path] = summary
+
+        missing = [path for path in keys.keys() if path not in summaries]
+        if len(missing) > 0:
+            print(f'Summarizing {len(missing)} logs...')
+            for path, summary in summarize_parallel(missing, self._processes):
+                self._store(keys[path], summary)
+                summaries[path] = summary
+            self._db.commit()
+        return [summaries[rec.path] for rec in records
+                if (include_truncated or not summaries[rec.path]['truncated']) and (include_perturbed or not summaries[rec.path]['perturbed'])]
+
+    def update(self, records: list[LogRecord]):
+        '''Summarizes any logs that aren't cached yet, all at once.
+        Calling this once up front lets the whole set of logs be summarized in parallel.'''
+        self.get_many(records)
+
+    def prune(self):
+        '''Removes cached summaries of logs that no longer exist.'''
+        paths = [row[0] for row in self._db.execute('SELECT path FROM summaries')]
+        for path in paths:
+            if not os.path.exists(os.path.join(self._folder, path)):
+                self._db.execute('DELETE FROM summaries WHERE path = ?', (path,))
+        self._db.commit()
+
+    def close(self):
+        self._db.close()
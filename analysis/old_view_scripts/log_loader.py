@@ -3,12 +3,15 @@
 # Liam Seymour 6/26/24
 
 #import pandas as pd
+import multiprocessing
 import numpy as np
 import os
 import sys
 
 sys.path.insert(0, '../tests')
-from statlog import Log
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import statlog
+from log_metrics import merge_pids, window
 
 class LogPeriod:
     name: str
@@ -48,48 +51,80 @@ class TaggedDataList:
     def with_and_without_tags(self, tags_with: list, tags_without: list) -> list[TaggedData]:
         return [tagged for tagged in self._list if tagged.has_tags(tags_with) and not tagged.has_tags(tags_without)]
 
-def _get_timestamp_period(log: Log, flag: str) -> tuple[float, float]:
-    start = log.get_timestamp(f'{flag}_START')
-    end = log.get_timestamp(f'{flag}_END')
-    if start == -1 or end == -1:
-        return None, None
-    return start, end
+def _period_series(times: np.ndarray, values: np.ndarray, start: float, end: float) -> np.ndarray:
+    # samples within the period as (time since period start, value) rows
+    t, v = window(times, values, start, end, interpolate=False)
+    return np.column_stack((t - start, v))
 
+def _load_periods(filepath: str) -> tuple[list[str], list[LogPeriod]]:
+    # loads a single log file and splits it into periods, run in a worker process
+    log = statlog.load(filepath)
+    name_data = os.path.splitext(os.path.basename(filepath))[0][4:].split('_')
+    i = int(name_data[1])
 
-def load_logs_from_folder(in_folder: str) -> TaggedDataList:
-    '''Loads log files from a given folder path.'''
+    # just going to add up total if there are multiple pids
+    ram_times, ram_total, _ = merge_pids(log.memory_ram)
+    gpu_times, gpu_total, _ = merge_pids(log.memory_gpu)
+
+    period_list: list[LogPeriod] = list()
+    for pname in log.periods():
+        # fill LogPeriod with data
+
+        log_period = LogPeriod()
+        log_period.name = pname
+        log_period.i = i # TODO: REMOVE
+
+        log_period.accuracy = log.accuracy
+        log_period.tokens_generated = log.tokens_generated
+
+        start, end = log.period(pname)
+        log_period.length = end - start
+
+        log_period.freq_gpu = _period_series(*log.freq_gpu.to_numpy(), start, end)
+        log_period.memory_ram = _period_series(ram_times, ram_total, start, end)
+        log_period.memory_gpu = _period_series(gpu_times, gpu_total, start, end)
+        log_period.power = _period_series(*log.power.to_numpy(), start, end)
+        
+        period_list.append(log_period)
+    return name_data, period_list
+
+def _try_load_periods(filepath: str):
+    try:
+        return _load_periods(filepath)
+    except:
+        return None
+
+
+def load_logs_from_folder(in_folder: str, processes: int = None) -> TaggedDataList:
+    '''Loads log files from a given folder path.
+    Files are loaded and split into periods in parallel, using up to the given number of processes (Default: CPU count).'''
     in_folder = os.path.abspath(in_folder)
     print('Loading all log files from', in_folder)
 
-    # load from files into a list of logs associated with name fragments
-    loaded: list[tuple[list[str], Log]] = list()
-    for filename in os.listdir(in_folder):
-        if filename.endswith('.json'):
-            try:
-                filepath = os.path.join(in_folder, filename)
-                log_data = None
-                with open(filepath, 'r') as fp:
-                    jstr = ''.join(fp.readlines())
-                    log_data = Log.from_json(jstr)
-                
-                name_data = filename[4:-5].split('_')
-                #name_data.insert(0, name_data.pop()) # move suffix to the beginning of the name data
-
-                loaded.append((name_data, log_data))
-            except:
-                pass
+    # load from files into a list of periods associated with name fragments
+    # only the periods are sent back from the worker processes, not the whole logs
+    filepaths = [os.path.join(in_folder, f) for f in os.listdir(in_folder) if os.path.splitext(f)[1] in ['.json', '.npz', '.ndjson']]
+    loaded: list[tuple[list[str], list[LogPeriod]]] = list()
+    if processes is None:
+        processes = os.cpu_count() or 1
+    if processes > 1 and 'fork' in multiprocessing.get_all_start_methods():
+        with multiprocessing.get_context('fork').Pool(processes) as pool:
+            results = list(pool.imap_unordered(_try_load_periods, filepaths))
+    else:
+        results = [_try_load_periods(x) for x in filepaths]
+    loaded = [x for x in results if x is not None]
     print(f'Loaded {len(loaded)} files')
 
     # move loaded data into dict, grouping iterations together
-    loaded_iter_groups: dict[str, list[tuple[int, Log]]] = dict()
-    for name, log in sorted(loaded, key=lambda x: x[0]):
+    loaded_iter_groups: dict[str, list[tuple[int, list[LogPeriod]]]] = dict()
+    for name, period_list in sorted(loaded, key=lambda x: x[0]):
         i = int(name.pop(1)) # this fragment is an iteration number, the rest are used as tags
         name_str = '_'.join(name)
 
         if name_str not in loaded_iter_groups:
             loaded_iter_groups[name_str] = list()
         
-        loaded_iter_groups[name_str].append((i, log))
+        loaded_iter_groups[name_str].append((i, period_list))
         loaded_iter_groups[name_str] = sorted(loaded_iter_groups[name_str], key=lambda x: x[0])
     
     # move grouped data into tagged data
@@ -98,73 +133,7 @@ def load_logs_from_folder(in_folder: str) -> TaggedDataList:
         tagged_data = TaggedData()
         tagged_data._tags = name_str.split('_')
         
-        iter_periods_list: list[list[LogPeriod]] = list()
-        for i, log in iter_list:
-            # get period names in iteration
-            period_names = list()
-            for pname in [x.value[:-6] for x in log.timestamps if x.value.endswith('_START')]:
-                if log.get_timestamp(f'{pname}_END') != -1:
-                    period_names.append(pname)
-            
-            period_list: list[LogPeriod] = list()
-            for pname in period_names:
-                # fill LogPeriod with data
-
-                log_period = LogPeriod()
-                log_period.name = pname
-                log_period.i = i # TODO: REMOVE
-
-                log_period.accuracy = log.accuracy
-                log_period.tokens_generated = log.tokens_generated
-
-                start, end = _get_timestamp_period(log, pname)
-                log_period.length = end - start
-
-                tmp: list[tuple[float, float]] = list()
-                for entry in log.freq_gpu:
-                    if entry.time >= start and entry.time <= end:
-                        tmp.append((entry.time - start, entry.value))
-                log_period.freq_gpu = np.array(tmp)
-                
-                tmp: list[tuple[float, float]] = list()
-                # just going to add up total if there are multiple pids
-                for pid, entries in log.memory_ram.items():
-                    for entry in entries:
-                        if entry.time >= start and entry.time <= end:
-                            p_t = entry.time - start
-                            flag = False
-                            for prev_ram in tmp:
-                                if not flag and prev_ram[0] == p_t:
-                                    flag = True
-                                    prev_ram[1] += entry.value
-                            if not flag:
-                                tmp.append((p_t, entry.value))
-                log_period.memory_ram = np.array(tmp)
-                
-                tmp: list[tuple[float, float]] = list()
-                # just going to add up total if there are multiple pids
-                for pid, entries in log.memory_gpu.items():
-                    for entry in entries:
-                        if entry.time >= start and entry.time <= end:
-                            p_t = entry.time - start
-                            flag = False
-                            for prev_gpu in tmp:
-                                if not flag and prev_gpu[0] == p_t:
-                                    flag = True
-                                    prev_gpu[1] += entry.value
-                            if not flag:
-                                tmp.append((p_t, entry.value))
-                log_period.memory_gpu = np.array(tmp)
-
-                tmp: list[tuple[float, float]] = list()
-                for entry in log.power:
-                    if entry.time >= start and entry.time <= end:
-                        tmp.append((entry.time - start, entry.value))
-                log_period.power = np.array(tmp)
-                
-                period_list.append(log_period)
-
-            iter_periods_list.append(period_list)
+        iter_periods_list: list[list[LogPeriod]] = [period_list for _, period_list in iter_list]
         
         # save periods and append tagged data
         tagged_data._periods = sorted(iter_periods_list, key=lambda x: x[0].i)
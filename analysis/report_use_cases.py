@@ -1,95 +1,16 @@
 from math import isnan
 import numpy as np
-import os
 import json
+from log_catalog import LogCatalog, device_order, model_order, device_pm_dict
+from log_summary import SummaryCache
 
-in_folder = os.path.abspath('../tests/out')
-
-# important test naming info
-def m_name(param):
-    return f'pythia-{param}-deduped'
-device_order = ['agx-orin-devkit', 'agx-orin-32gb', 'orin-nx-16gb', 'orin-nx-8gb', 'orin-nano-8gb', 'orin-nano-4gb']
-pm_order = ['7W', '7W-AI', '7W-CPU', '10W', '15W', '20W', '25W', '30W', '40W', '50W', 'MAXN']
-model_params = ['70m', '160m', '410m', '1.4b']
-model_order = [m_name(x) for x in model_params]
-device_pm_dict = {
-    'agx-orin-devkit': ['MAXN', '50W', '30W', '15W'],
-    'agx-orin-32gb': ['MAXN', '40W', '30W', '15W'],
-    'orin-nx-16gb': ['MAXN', '25W', '15W', '10W'],
-    'orin-nx-8gb': ['MAXN', '20W', '15W', '10W'],
-    'orin-nano-8gb': ['15W', '7W'],
-    'orin-nano-4gb': ['10W', '7W-AI', '7W-CPU']
-}
-
-
-def get_times_between_stamps(data: dict, prefix: str) -> tuple[float, float]:
-    start = -1
-    end = -1
-    for entry in data['timestamps']:
-        t = entry['time']
-        v = entry['value']
-        if prefix in v:
-            if 'START' in v:
-                start = t
-            elif 'END' in v:
-                end = t
-    assert start >= 0
-    assert end >= 0
-    return start, end
-
-def is_within_times(t, t1s, t1e, t2s, t2e):
-    return (t1s <= t <= t1e) or (t2s <= t <= t2e)
-
-def load_log(path: str) -> dict:
-    with open(path, 'r') as fp:
-        return json.load(fp)
-    
-def integrate(lst: list[tuple]) -> float:
-    acc = 0
-    for j in range(len(lst) - 1):
-        t0 = lst[j][0]
-        v0 = lst[j][1]
-        t1 = lst[j+1][0]
-        v1 = lst[j+1][1]
-        t_delta = t1 - t0
-        v_avg = (v0 + v1) / 2
-        acc += (v_avg * t_delta)
-    return acc
-
-
-# get all logs
-print('Searching...')
-
-log_paths = list()
-for p, _, fs in list(os.walk(in_folder)):
-    for f in fs:
-        if f.startswith('log_') and f.endswith('json'):
-            log_paths.append(os.path.join(p, f))
-
-print(f'Found {len(log_paths)} logs\nLoading details...')
-
-# begin
-existing = list()
-max_iterations = 0
-
-for path in log_paths:
-    data = os.path.basename(path)[4:-5].split('_')
-    tags = list()
-    tags.append(data.pop(-2)) # device
-    tags.append(data.pop(-1)) # pm
-    tags.append(data.pop(0)) # model
-    iters = int(data.pop(0))
-    max_iterations = max(max_iterations, iters)
-    tags.append(iters) # iteration
-    if len(data) > 0:
-        tags = tags + data
-    tags.append(path) # add to the end
-    
-    existing.append(tags)
-
-existing.sort()
 
 
+# get all logs and their summaries
+catalog = LogCatalog()
+cache = SummaryCache()
+cache.update(catalog.records)
+
 accuracy = dict()
 with open('accuracy.json', 'r') as fp:
     af = json.load(fp)
@@ -115,38 +36,25 @@ results = list()
 for dev in device_order:
     for pm in device_pm_dict[dev]:
         for llm in model_order:
-            iters_nq = [x for x in existing if dev in x and pm in x and llm in x and 'no-quant' in x]
-            iters_q = [x for x in existing if dev in x and pm in x and llm in x and ('no-quant' not in x)]
+            iters_nq = catalog.find(dev, pm, llm, quant=False)
+            iters_q = catalog.find(dev, pm, llm, quant=True)
 
             for iters, q in zip([iters_q, iters_nq], ['q', 'nq']):
                 lats = list()
                 mems = list()
                 pows = list()
                 energies = list()
-                for log in [load_log(x[-1]) for x in iters]:
-                    t_load_start, t_load_end = get_times_between_stamps(log, 'MODEL_LOAD')
-                    t_gen_start, t_gen_end = get_times_between_stamps(log, 'GENERATE')
-                    lats.append((t_load_end - t_load_start) + (t_gen_end - t_gen_start))
-
-                    series_gpu = log['memory_gpu']
-                    pid_gpu = list(series_gpu.keys())[0]
-                    series_ram = log['memory_ram']
-                    pid_ram = list(series_gpu.keys())[0]
-                    assert len(series_gpu) == 1
-                    assert len(series_ram) == 1
-                    assert pid_gpu == pid_ram
-                    i_gpu = [x['value'] for x in series_gpu[pid_gpu] if is_within_times(x['time'], t_load_start, t_load_end, t_gen_start, t_gen_end)] # gpu memory for this iteration
-                    i_ram = [x['value'] for x in series_ram[pid_ram] if is_within_times(x['time'], t_load_start, t_load_end, t_gen_start, t_gen_end)] # cpu memory for this iteration
-                    i_pk_gpu = np.max(i_gpu) / 1024.0 # peak gpu memory for this iteration
-                    i_pk_ram = np.max(i_ram) / 1024.0 # peak cpu memory for this iteration
-                    mems.append(i_pk_ram + i_pk_gpu)
+                for summary in cache.get_many(iters):
+                    load = summary['MODEL_LOAD']
+                    gen = summary['GENERATE']
+                    lats.append(load['latency'] + gen['latency'])
 
-                    series_pwr = [(x['time'], x['value']) for x in log['power'] if t_gen_start <= x['time'] <= t_gen_end]
-                    pk_pwr = np.max(series_pwr, axis=0)[1]
-                    pows.append(pk_pwr)
+                    i_pk_gpu = max(load['peak_gpu'], gen['peak_gpu']) / 1024.0 # peak gpu memory for this iteration
+                    i_pk_ram = max(load['peak_ram'], gen['peak_ram']) / 1024.0 # peak cpu memory for this iteration
+                    mems.append(i_pk_ram + i_pk_gpu)
 
-                    en = integrate(series_pwr)
-                    energies.append(en)
+                    pows.append(gen['peak_power'])
+                    energies.append(gen['energy'])
 
                 res_entry = dict()
                 res_entry['conf'] = f'{dev},{pm},{llm},{q}'
@@ -3,115 +3,33 @@ import matplotlib.pyplot as plt
 from matplotlib import cm
 import matplotlib.colors as colors
 import numpy as np
-import os
-import json
+from log_catalog import LogCatalog, device_order, model_params, model_order, device_pm_dict
+from log_summary import SummaryCache
 
-in_folder = os.path.abspath('../tests/out')
 
-# important test naming info
-def m_name(param):
-    return f'pythia-{param}-deduped'
-device_order = ['agx-orin-devkit', 'agx-orin-32gb', 'orin-nx-16gb', 'orin-nx-8gb', 'orin-nano-8gb', 'orin-nano-4gb']
-pm_order = ['7W', '7W-AI', '7W-CPU', '10W', '15W', '20W', '25W', '30W', '40W', '50W', 'MAXN']
-model_params = ['70m', '160m', '410m', '1.4b']
-model_order = [m_name(x) for x in model_params]
-device_pm_dict = {
-    'agx-orin-devkit': ['MAXN', '50W', '30W', '15W'],
-    'agx-orin-32gb': ['MAXN', '40W', '30W', '15W'],
-    'orin-nx-16gb': ['MAXN', '25W', '15W', '10W'],
-    'orin-nx-8gb': ['MAXN', '20W', '15W', '10W'],
-    'orin-nano-8gb': ['15W', '7W'],
-    'orin-nano-4gb': ['10W', '7W-AI', '7W-CPU']
-}
-
-
-def get_times_between_stamps(data: dict, prefix: str) -> tuple[float, float]:
-    start = -1
-    end = -1
-    for entry in data['timestamps']:
-        t = entry['time']
-        v = entry['value']
-        if prefix in v:
-            if 'START' in v:
-                start = t
-            elif 'END' in v:
-                end = t
-    assert start >= 0
-    assert end >= 0
-    return start, end
-
-def load_log(path: str) -> dict:
-    with open(path, 'r') as fp:
-        return json.load(fp)
-    
-def integrate(lst: list[tuple]) -> float:
-    acc = 0
-    for j in range(len(lst) - 1):
-        t0 = lst[j][0]
-        v0 = lst[j][1]
-        t1 = lst[j+1][0]
-        v1 = lst[j+1][1]
-        t_delta = t1 - t0
-        v_avg = (v0 + v1) / 2
-        acc += (v_avg * t_delta)
-    return acc
-
-
-# get all logs
-print('Searching...')
-
-log_paths = list()
-for p, _, fs in list(os.walk(in_folder)):
-    for f in fs:
-        if f.startswith('log_') and f.endswith('json'):
-            log_paths.append(os.path.join(p, f))
-
-print(f'Found {len(log_paths)} logs\nLoading details...')
-
-# begin
-existing = list()
-max_iterations = 0
-
-for path in log_paths:
-    data = os.path.basename(path)[4:-5].split('_')
-    tags = list()
-    tags.append(data.pop(-2)) # device
-    tags.append(data.pop(-1)) # pm
-    tags.append(data.pop(0)) # model
-    iters = int(data.pop(0))
-    max_iterations = max(max_iterations, iters)
-    tags.append(iters) # iteration
-    if len(data) > 0:
-        tags = tags + data
-    tags.append(path) # add to the end
-    
-    existing.append(tags)
-
-existing.sort()
 
+# get all logs and their summaries
+catalog = LogCatalog()
+cache = SummaryCache()
+cache.update(catalog.records)
 
 
 def plot_data(dev, llm):
     pm = device_pm_dict[dev][0]
 
-    with_all = [x for x in existing if (dev in x) and (pm in x) and (llm in x)]
-    quant = [load_log(x[-1]) for x in with_all if 'no-quant' not in x]
-    noquant = [load_log(x[-1]) for x in with_all if 'no-quant' in x]
+    quant = cache.get_many(catalog.find(dev, pm, llm, quant=True))
+    noquant = cache.get_many(catalog.find(dev, pm, llm, quant=False))
 
     lats_load_q = list()
     lats_gen_q = list()
     lats_load_nq = list()
     lats_gen_nq = list()
-    for log in quant:
-        t_start, t_end = get_times_between_stamps(log, 'MODEL_LOAD')
-        lats_load_q.append(t_end - t_start)
-        t_start, t_end = get_times_between_stamps(log, 'GENERATE')
-        lats_gen_q.append(t_end - t_start)
-    for log in noquant:
-        t_start, t_end = get_times_between_stamps(log, 'MODEL_LOAD')
-        lats_load_nq.append(t_end - t_start)
-        t_start, t_end = get_times_between_stamps(log, 'GENERATE')
-        lats_gen_nq.append(t_end - t_start)
+    for summary in quant:
+        lats_load_q.append(summary['MODEL_LOAD']['latency'])
+        lats_gen_q.append(summary['GENERATE']['latency'])
+    for summary in noquant:
+        lats_load_nq.append(summary['MODEL_LOAD']['latency'])
+        lats_gen_nq.append(summary['GENERATE']['latency'])
     lat_load_q = np.median(lats_load_q)
     lat_gen_q = np.median(lats_gen_q)
     lat_load_nq = np.median(lats_load_nq)
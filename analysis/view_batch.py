@@ -0,0 +1,55 @@
+import pandas as pd
+import matplotlib.pyplot as plt
+import numpy as np
+from log_catalog import LogCatalog, device_order, model_params, model_order, device_pm_dict
+from log_summary import SummaryCache
+
+
+
+# get all logs and their summaries
+catalog = LogCatalog()
+cache = SummaryCache()
+cache.update(catalog.records)
+
+# batch sizes tested, from the 'bs<N>' tags of logs (logs without one have a batch size of 1)
+def batch_tag(bs):
+    return () if bs == 1 else (f'bs{bs}',)
+batch_sizes = sorted({1} | {int(t[2:]) for key in catalog.configs() for t in key[4] if t.startswith('bs') and t[2:].isdigit()})
+
+# median throughput (tokens/s) for every device, power mode, model and batch size
+rows = list()
+for dev in device_order:
+    for pm in device_pm_dict[dev]:
+        for m in model_order:
+            for bs in batch_sizes:
+                tps = [x['GENERATE']['tokens_per_second'] for x in cache.get_many(catalog.find(dev, pm, m, quant=True, tags=batch_tag(bs)))]
+                if len(tps) > 0:
+                    rows.append({'device': dev, 'pm': pm, 'model': m, 'batch_size': bs, 'tokens_per_second': np.median(tps)})
+
+df = pd.DataFrame(rows)
+if len(df) == 0:
+    print('No logs with generation throughput found')
+    exit(0)
+print(df.pivot_table(index=['device', 'pm', 'model'], columns='batch_size', values='tokens_per_second'))
+
+# throughput-optimal batch size of each configuration
+best = df.loc[df.groupby(['device', 'pm', 'model'])['tokens_per_second'].idxmax()]
+print('\nThroughput-optimal batch size:')
+print(best.set_index(['device', 'pm', 'model']))
+
+
+# throughput against batch size for each model, at the max power mode of each device
+fig, axs = plt.subplots(1, len(model_order), sharey=False, figsize=(4 * len(model_order), 4))
+for im, m in enumerate(model_order):
+    ax = axs[im]
+    for dev in device_order:
+        pm = device_pm_dict[dev][0]
+        sel = df[(df['device'] == dev) & (df['pm'] == pm) & (df['model'] == m)]
+        if len(sel) > 0:
+            ax.plot(sel['batch_size'], sel['tokens_per_second'], 'o-', label=dev)
+    ax.set_xscale('log', base=2)
+    ax.set_title(f'Pythia {model_params[im]}')
+    ax.set_xlabel('Batch Size')
+axs[0].set_ylabel('Throughput (tokens/s)')
+axs[0].legend()
+plt.show()
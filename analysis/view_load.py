@@ -0,0 +1,67 @@
+import pandas as pd
+import matplotlib.pyplot as plt
+import numpy as np
+from log_catalog import LogCatalog, device_order, model_params, model_order, device_pm_dict
+from log_summary import LOAD_PHASES, SummaryCache
+
+
+
+# get all logs and their summaries
+catalog = LogCatalog()
+cache = SummaryCache()
+cache.update(catalog.records)
+
+# logs of models loaded in phases are tagged with their load mode (i.e. 'load-mmap')
+load_modes = sorted({t[5:] for key in catalog.configs() for t in key[4] if t.startswith('load-')})
+
+# median latency of each load phase for every device, power mode, model and load mode
+rows = list()
+for dev in device_order:
+    for pm in device_pm_dict[dev]:
+        for m in model_order:
+            for mode in load_modes:
+                summaries = cache.get_many(catalog.find(dev, pm, m, quant=True, tags=(f'load-{mode}',)))
+                if len(summaries) == 0:
+                    continue
+                row = {'device': dev, 'pm': pm, 'model': m, 'mode': mode}
+                row['MODEL_LOAD'] = np.median([x['MODEL_LOAD']['latency'] for x in summaries])
+                for phase in LOAD_PHASES:
+                    lats = [x[phase]['latency'] for x in summaries if phase in x]
+                    row[phase] = np.median(lats) if len(lats) > 0 else 0.0
+                # the transfer is split into copying the weights and quantizing the linear layers
+                quantize = [x['LOAD_TRANSFER'].get('quantize_time', 0.0) for x in summaries if 'LOAD_TRANSFER' in x]
+                row['LOAD_TRANSFER_QUANTIZE'] = np.median(quantize) if len(quantize) > 0 else 0.0
+                row['LOAD_TRANSFER_COPY'] = row['LOAD_TRANSFER'] - row['LOAD_TRANSFER_QUANTIZE']
+                rows.append(row)
+
+# load phases with the transfer split into its copy and quantization, in order
+parts = [y for x in LOAD_PHASES for y in (['LOAD_TRANSFER_COPY', 'LOAD_TRANSFER_QUANTIZE'] if x == 'LOAD_TRANSFER' else [x])]
+
+df = pd.DataFrame(rows)
+if len(df) == 0:
+    print('No logs of models loaded in phases found (see the --load-mode option of tests/run_tests.py)')
+    exit(0)
+print(df.set_index(['device', 'pm', 'model', 'mode']))
+
+# phase that takes the longest in each configuration (with the copy and quantization counted separately)
+df['slowest'] = df[parts].idxmax(axis=1)
+print('\nSlowest load phase:')
+print(df.pivot_table(index=['device', 'pm', 'model'], columns='mode', values='slowest', aggfunc='first'))
+
+
+# stacked load phases for each model and load mode, at the max power mode of each device
+fig, axs = plt.subplots(1, len(model_order), sharey=False, figsize=(4 * len(model_order), 4))
+for im, m in enumerate(model_order):
+    ax = axs[im]
+    sel = df[(df['model'] == m) & (df['pm'] == df['device'].map(lambda x: device_pm_dict[x][0]))]
+    labels = [f'{d}\n{mode}' for d, mode in zip(sel['device'], sel['mode'])]
+    bottom = np.zeros(len(sel))
+    for phase in parts:
+        ax.bar(labels, sel[phase], bottom=bottom, label=phase)
+        bottom += sel[phase].to_numpy()
+    ax.set_title(f'Pythia {model_params[im]}')
+    ax.tick_params(axis='x', labelrotation=90)
+axs[0].set_ylabel('Latency (s)')
+axs[0].legend()
+plt.tight_layout()
+plt.show()
@@ -1,121 +1,51 @@
 import pandas as pd
 import matplotlib.pyplot as plt
 from matplotlib import cm
+from matplotlib.lines import Line2D
 from matplotlib.patches import Patch
 import numpy as np
-import os
-import json
-
-in_folder = os.path.abspath('../tests/out')
-
-# important test naming info
-def m_name(param):
-    return f'pythia-{param}-deduped'
-device_order = ['agx-orin-devkit', 'agx-orin-32gb', 'orin-nx-16gb', 'orin-nx-8gb', 'orin-nano-8gb', 'orin-nano-4gb']
-pm_order = ['7W', '7W-AI', '7W-CPU', '10W', '15W', '20W', '25W', '30W', '40W', '50W', 'MAXN']
-model_params = ['70m', '160m', '410m', '1.4b']
-model_order = [m_name(x) for x in model_params]
-device_pm_dict = {
-    'agx-orin-devkit': ['MAXN', '50W', '30W', '15W'],
-    'agx-orin-32gb': ['MAXN', '40W', '30W', '15W'],
-    'orin-nx-16gb': ['MAXN', '25W', '15W', '10W'],
-    'orin-nx-8gb': ['MAXN', '20W', '15W', '10W'],
-    'orin-nano-8gb': ['15W', '7W'],
-    'orin-nano-4gb': ['10W', '7W-AI', '7W-CPU']
-}
-
-
-
-def get_times_between_stamps(data: dict, prefix: str) -> tuple[float, float]:
-    start = -1
-    end = -1
-    for entry in data['timestamps']:
-        t = entry['time']
-        v = entry['value']
-        if prefix in v:
-            if 'START' in v:
-                start = t
-            elif 'END' in v:
-                end = t
-    assert start >= 0
-    assert end >= 0
-    return start, end
-
-def load_log(path: str) -> dict:
-    with open(path, 'r') as fp:
-        return json.load(fp)
-    
-def integrate(lst: list[tuple]) -> float:
-    acc = 0
-    for j in range(len(lst) - 1):
-        t0 = lst[j][0]
-        v0 = lst[j][1]
-        t1 = lst[j+1][0]
-        v1 = lst[j+1][1]
-        t_delta = t1 - t0
-        v_avg = (v0 + v1) / 2
-        acc += (v_avg * t_delta)
-    return acc
-
-
-# get all logs
-print('Searching...')
-
-log_paths = list()
-for p, _, fs in list(os.walk(in_folder)):
-    for f in fs:
-        if f.startswith('log_') and f.endswith('json'):
-            log_paths.append(os.path.join(p, f))
-
-print(f'Found {len(log_paths)} logs\nLoading details...')
-
-# begin
-existing = list()
-max_iterations = 0
-
-for path in log_paths:
-    data = os.path.basename(path)[4:-5].split('_')
-    tags = list()
-    tags.append(data.pop(-2)) # device
-    tags.append(data.pop(-1)) # pm
-    tags.append(data.pop(0)) # model
-    iters = int(data.pop(0))
-    max_iterations = max(max_iterations, iters)
-    tags.append(iters) # iteration
-    if len(data) > 0:
-        tags = tags + data
-    tags.append(path) # add to the end
-    
-    existing.append(tags)
-
-existing.sort()
+from log_catalog import LogCatalog, device_order, model_params, model_order, device_pm_dict
+from log_summary import SummaryCache
 
 
+
+# get all logs and their summaries
+catalog = LogCatalog()
+cache = SummaryCache()
+cache.update(catalog.records)
+
+# time per token estimated from the whole generation (available for every log, but includes the prefill),
+# and the measured inter-token latency (only in logs with per-token times, see tests/hf_models.TokenTimer)
 d = dict()
+d_itl = dict()
 
 for dev in device_order:
     d[dev] = dict()
+    d_itl[dev] = dict()
 
-    with_dev = [x for x in existing if (dev in x) and ('no-quant' not in x)]
     pm = device_pm_dict[dev][0]
-    with_pm = [x for x in with_dev if pm in x]
 
     for m in model_order:
-        iters = [x for x in with_pm if m in x]
-        iter_logs = [load_log(x[-1]) for x in iters]
+        iter_summaries = cache.get_many(catalog.find(dev, pm, m, quant=True))
 
         tpts = list()
-        for log in iter_logs:
-            t_start, t_end = get_times_between_stamps(log, 'GENERATE')
-            t_gen = t_end - t_start
-            num_tokens = log['tokens_generated']
-            tpts.append(t_gen / num_tokens) # append the amount of time taken divided by the number of tokens
-        tpt = np.mean(tpts) # average tpt
-
-        d[dev][m] = tpt
+        itls = list()
+        for summary in iter_summaries:
+            t_gen = summary['GENERATE']['latency']
+            num_tokens = summary['tokens_generated']
+            if num_tokens > 0:
+                tpts.append(t_gen / num_tokens) # append the amount of time taken divided by the number of tokens
+            if 'itl_mean' in summary['GENERATE'].get('tokens', dict()):
+                itls.append(summary['GENERATE']['tokens']['itl_mean']) # measured time between tokens
+        d[dev][m] = np.mean(tpts) if len(tpts) > 0 else np.nan # average tpt
+        d_itl[dev][m] = np.mean(itls) if len(itls) > 0 else np.nan
 
 df = pd.DataFrame(d)
+df_itl = pd.DataFrame(d_itl)
+print('Estimated time per token (s):')
 print(df)
+print('\nMeasured inter-token latency (s):')
+print(df_itl)
 
 
 # runs_cols = [(0.85, 0.15, 0.15), (0.55, 0.15, 0.15), (0.15, 0.85, 0.15), (0.15, 0.55, 0.15), (0.15, 0.15, 0.85), (0.15, 0.15, 0.55)]
@@ -128,17 +58,19 @@ for idev in range(len(device_order)):
     dev = device_order[idev]
     xi = [(j*bspace)+idev for j in range(len(model_order))]
     ax.bar(x=xi, height=df[dev], color=cmap(idev), width=1)
+    ax.scatter(x=xi, y=df_itl[dev], color='black', marker='_', s=60, zorder=3)
 
 # tmp2 = [Patch(edgecolor='black', fill=False, label='RAM'), 
 #         Patch(edgecolor='black', fill=False, label='VRAM')]
 leg = [Patch(facecolor=cmap(j), label=device_order[j]) for j in range(len(device_order))]
+leg.append(Line2D([], [], color='black', marker='_', linestyle='None', markersize=10, label='Measured ITL'))
 ax.legend(handles=leg)
 
 ax.set_xticks([(j*bspace)+2.5 for j in range(len(model_order))])
 ax.set_xticklabels(model_params, rotation=0)
 ax.set_xlabel('Pythia Model')
 # ax.set_title(f'Estimated Average Time per Token\n(median run, max power model, with quantization)', fontsize=12)
-ax.set_ylabel('Time per Token (s)')
+ax.set_ylabel('Estimated Time per Token (s)')
 plt.show()
 
 
@@ -1,6 +1,8 @@
 #!/bin/bash
 
 # Removes all models stored in the huggingface cache.
+# To only evict least recently used models when the cache is over a disk budget, use
+# tests/model_cache.py instead (i.e. python model_cache.py --budget=20G --keep=models.txt).
 # 
 # Liam Seymour 6/12/24
 
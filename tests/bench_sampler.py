@@ -0,0 +1,115 @@
+# Benchmark for the sampling overhead of the telemetry backends.
+#
+# Runs a sampler at decreasing intervals and reports the achieved sample rate, the time taken by
+# each reading and the CPU load of the sampler thread. By default, the sysfs sampler reads from a
+# fake sysfs tree (with INA3221 rails, a GPU devfreq device and a pt_main_thread process) created in
+# a temporary folder, so this can be run on any machine. With --check-ticks, the tick statistics of
+# the logs are checked against simulated samplers instead, including ones whose timer runs slightly
+# fast or slow (as jtop's can), which should not be reported as jitter or missed ticks.
+# Use 'bench_sampler.py --help' for a summary of usage options.
+
+import os
+import sys
+import tempfile
+from time import sleep
+
+import samplers
+from statlog import Log, TickStats
+
+duration = 2.0
+sampler_spec = ''
+intervals = [0.1, 0.01, 0.001]
+check_ticks = False
+
+for arg in sys.argv[1:]:
+    tmp = arg.split('=')
+    match tmp[0]:
+        case '--duration':
+            duration = float(tmp[1])
+        case '--sampler':
+            sampler_spec = tmp[1]
+        case '--intervals':
+            intervals = [float(x) for x in tmp[1].split(',')]
+        case '--check-ticks':
+            check_ticks = True
+        case _:
+            print('Usage: bench_sampler.py [--duration=2.0] [--intervals=0.1,0.01,0.001] [--sampler=sysfs[:<root>]|jtop|replay:<log path>]')
+            print('  Without --sampler, the sysfs sampler is run against a fake sysfs tree')
+            print('       bench_sampler.py --check-ticks')
+            print('  Checks the tick statistics against simulated samplers, including ones with slightly-off periods')
+            exit(0 if tmp[0] == '--help' else 1)
+
+
+def make_fake_sysfs(root: str):
+    '''Creates a fake sysfs/procfs tree like that of a Jetson Orin under the given root.'''
+    def write(path: str, data: str):
+        path = os.path.join(root, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as fp:
+            fp.write(data + '\n')
+    rails = [('VDD_IN', 5000, 1500), ('VDD_CPU_GPU_CV', 5000, 600), ('VDD_SOC', 5000, 300)]
+    write('sys/class/hwmon/hwmon1/name', 'ina3221')
+    for n, (label, volt, curr) in enumerate(rails, 1):
+        write(f'sys/class/hwmon/hwmon1/in{n}_label', label)
+        write(f'sys/class/hwmon/hwmon1/in{n}_input', str(volt))
+        write(f'sys/class/hwmon/hwmon1/curr{n}_input', str(curr))
+    write('sys/class/devfreq/17000000.ga10b/cur_freq', '918000000')
+    write('proc/1000/comm', samplers.PROCESS_NAME)
+    write('proc/1000/status', 'Name:\tpt_main_thread\nState:\tR (running)\nVmPeak:\t 2000000 kB\nVmRSS:\t  1234567 kB\nThreads:\t12')
+    write('sys/kernel/debug/nvmap/iovmm/clients', 'CLIENT    PROCESS    PID    SIZE\nuser    pt_main_thread    1000    654321K')
+
+
+def bench(sampler: samplers.Sampler):
+    print('Interval (ms) | Samples/s | Read mean (us) | Read max (us) | CPU load')
+    for interval in intervals:
+        log = Log()
+        log.begin(interval=interval, sampler=sampler)
+        sleep(duration)
+        log.end()
+        info = log.sampler_info
+        rate = len(log.power) / (log.time_log_end - log.time_log_start)
+        read_mean = info.get('read_time_mean', float('nan')) * 1e6
+        read_max = info.get('read_time_max', float('nan')) * 1e6
+        cpu_load = info.get('cpu_load', float('nan')) * 100
+        print(f'{interval * 1000:>13g} | {rate:>9.1f} | {read_mean:>14.1f} | {read_max:>13.1f} | {cpu_load:>7.2f}%')
+
+
+def simulate_ticks(interval: float, period: float, scheduled: bool, count: int = 1200, skip: list[int] = list()) -> dict:
+    '''Returns the tick summary of a simulated sampler ticking every period seconds (except on the ticks in skip).'''
+    stats = TickStats(interval, scheduled)
+    for i in range(count):
+        if i not in skip:
+            stats.tick(100 + i * period)
+    return stats.summary()
+
+def check_tick_stats():
+    # (description, period, scheduled, skipped ticks, expected missed ticks, maximum p99 jitter)
+    cases = [
+        ('exact period', 0.1, False, [], 0, 1e-4),
+        ('timer 0.5% slow', 0.1005, False, [], 0, 1e-3),
+        ('timer 1% fast', 0.099, False, [], 0, 2e-3),
+        ('timer 1% fast, 2 ticks skipped', 0.099, False, [500, 501], 2, 2e-3),
+        ('scheduled, exact period', 0.1, True, [], 0, 1e-4),
+        ('scheduled, 3 ticks skipped', 0.1, True, [10, 11, 700], 3, 1e-4)
+    ]
+    failed = 0
+    for desc, period, scheduled, skip, missed, p99 in cases:
+        summary = simulate_ticks(0.1, period, scheduled, skip=skip)
+        ok = summary['missed_ticks'] == missed and summary['jitter_p99'] <= p99
+        failed += 0 if ok else 1
+        print(f'{"ok  " if ok else "FAIL"} {desc}: {summary["missed_ticks"]} missed, jitter p99 {summary["jitter_p99"] * 1000:.3f} ms')
+    if failed > 0:
+        print(f'{failed} of {len(cases)} checks failed!')
+        exit(1)
+
+
+if check_ticks:
+    check_tick_stats()
+elif len(sampler_spec) > 0:
+    bench(samplers.get_sampler(sampler_spec))
+else:
+    with tempfile.TemporaryDirectory() as root:
+        make_fake_sysfs(root)
+        sampler = samplers.SysfsSampler(root)
+        bench(sampler)
+        sampler.close()
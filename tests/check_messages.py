@@ -0,0 +1,177 @@
+# Check of the messages between the test runner and its test process, without a GPU or any model.
+#
+# Runs stub test processes that follow the protocol of run_tests.py (see messages.py), but only pretend
+# to load a model and generate, against the runner's messages.receive_messages() over a Pipe. Checks that
+# in warm mode the first request is sent once the model has loaded, each next one once the token times
+# of the previous one arrive, and None after the last one; that a stray IDLE_STEADY from an idle period
+# that ended on its own is skipped; that power stops being checked once the idle period ends; and that
+# the runner returns, instead of waiting forever, when the test process exits in the middle of a test.
+# Use 'check_messages.py --help' for a summary of usage options.
+
+import os
+import sys
+import threading
+from multiprocessing import Pipe, Process
+from multiprocessing.connection import Connection
+from time import sleep
+
+import messages
+import statlog
+from messages import receive_messages, receive_requests, send
+from samplers import ReplaySampler
+from statlog import Channel, Log, get_time
+
+timeout = 10.0
+load_time = 1.0
+
+for arg in sys.argv[1:]:
+    tmp = arg.split('=')
+    match tmp[0]:
+        case '--timeout':
+            timeout = float(tmp[1])
+        case '--load-time':
+            load_time = float(tmp[1])
+        case _:
+            print('Usage: check_messages.py [--timeout=10.0] [--load-time=1.0]')
+            print('  Runs stub test processes against the test runner and checks the messages between them')
+            exit(0 if tmp[0] == '--help' else 1)
+
+
+REQUESTS = ['the quick brown fox', 'jumps over', 'the lazy dog']
+
+def _send(conn: Connection, message: str, exit_after: str):
+    # sends a message, then exits without any cleanup if it is the one to exit after (ignoring any value)
+    send(conn, message)
+    if message.split(':')[0] == exit_after:
+        os._exit(1)
+
+def _stub_test(conn: Connection, idle: float, exit_after: str):
+    # follows _warm_test() in run_tests.py, 'generating' one token per word of each input
+    if idle > 0:
+        _send(conn, 'IDLE_START', exit_after)
+        # the idle period ends on its own without reading the pipe, so an IDLE_STEADY may be left in it
+        sleep(idle)
+        _send(conn, 'IDLE_END', exit_after)
+        if conn.poll(0.1):
+            _send(conn, 'IDLE_STEADY_PENDING', exit_after)
+    _send(conn, 'MODEL_LOAD_START', exit_after)
+    sleep(load_time)
+    # (nothing but an IDLE_STEADY may arrive before the model has loaded)
+    if idle == 0 and conn.poll(0.1):
+        _send(conn, 'EARLY_REQUEST_0', exit_after)
+    _send(conn, 'MODEL_LOAD_END', exit_after)
+    for r, in_data in receive_requests(conn):
+        _send(conn, f'RECEIVED_{r}:{in_data}', exit_after)
+        _send(conn, f'GENERATE_{r}_START', exit_after)
+        time_start = get_time()
+        token_times = [get_time() for _ in in_data.split()]
+        _send(conn, f'GENERATE_{r}_END', exit_after)
+        _send(conn, f'TOKENS_{r}:{len(token_times)}', exit_after)
+        # the next request must only be sent once the token times have arrived
+        if conn.poll(0.1):
+            _send(conn, f'EARLY_REQUEST_{r}', exit_after)
+        _send(conn, f'TOKEN_TIMES_{r}:' + ','.join([str(t) for t in [time_start] + token_times]), exit_after)
+    _send(conn, 'REQUESTS_DONE', exit_after)
+    conn.close()
+
+late_checks = 0
+'''Number of times power was checked for an idle period that had already ended'''
+
+def _counting_idle_is_steady(test_log: Log, threshold: float) -> bool:
+    global late_checks
+    if test_log.get_timestamp('IDLE_END') != -1:
+        late_checks += 1
+    return idle_is_steady(test_log, threshold)
+
+idle_is_steady = messages.idle_is_steady
+messages.idle_is_steady = _counting_idle_is_steady
+# a shorter window, so the power of the stub's idle period is steady within a second
+messages.IDLE_WINDOW = 0.3
+
+def run(idle: float = 0, idle_threshold: float = -1, exit_after: str = '') -> tuple[Log, int, bool]:
+    '''Runs the stub test process against the runner, returning the log, the process's exit code, and
+    whether the runner returned within the timeout.'''
+    global late_checks
+    late_checks = 0
+    source = Log()
+    source.power = Channel.from_entries([statlog.LogEntry(i * 0.01, 5.0) for i in range(1000)])
+    log = Log()
+    log.begin(0.01, sampler=ReplaySampler(source))
+    msg_recv, msg_send = Pipe()
+    proc = Process(target=_stub_test, args=[msg_send, idle, exit_after])
+    proc.start()
+    runner = threading.Thread(target=receive_messages, args=[log, msg_recv, proc, idle_threshold, REQUESTS], daemon=True)
+    runner.start()
+    runner.join(timeout)
+    returned = not runner.is_alive()
+    # (a test process that is still running once the runner returns or gives up is killed)
+    if proc.is_alive():
+        proc.kill()
+    proc.join()
+    runner.join()
+    msg_send.close()
+    msg_recv.close()
+    log.end()
+    return log, proc.exitcode, returned
+
+def received(log: Log) -> list[str]:
+    '''Returns the requests the stub test process received, in order.'''
+    return [entry.value.split(':', 1)[1] for entry in log.timestamps if entry.value.startswith('RECEIVED_')]
+
+def check(desc: str, ok: bool) -> bool:
+    print(f'{"ok  " if ok else "FAIL"} {desc}')
+    return ok
+
+
+failed = 0
+
+print('Warm requests:')
+log, exitcode, returned = run()
+checks = [
+    ('runner returned once the test process exited', returned),
+    ('test process ended cleanly on None after the last request', exitcode == 0 and log.get_timestamp('REQUESTS_DONE') != -1),
+    (f'requests received in order ({len(received(log))} of {len(REQUESTS)})', received(log) == REQUESTS),
+    ('first request received after MODEL_LOAD_END', log.get_timestamp('RECEIVED_1:' + REQUESTS[0]) >= log.get_timestamp('MODEL_LOAD_END')),
+    ('no request sent before the model loaded or the previous token times arrived',
+     not any([entry.value.startswith('EARLY_REQUEST') for entry in log.timestamps])),
+    (f'{log.tokens_generated} tokens counted over all requests', log.tokens_generated == sum([len(x.split()) for x in REQUESTS])),
+    ('a GENERATE period for each request', all([log.period(f'GENERATE_{r + 1}')[0] != -1 for r in range(len(REQUESTS))]))
+]
+failed += sum([0 if check(desc, ok) else 1 for desc, ok in checks])
+
+print('\nAdaptive idle period that ends on its own before the runner\'s IDLE_STEADY is read:')
+log, exitcode, returned = run(idle=1.5, idle_threshold=0.05)
+checks = [
+    ('IDLE_STEADY was left in the pipe', log.get_timestamp('IDLE_STEADY_PENDING') != -1),
+    ('stray IDLE_STEADY skipped, every request served', returned and exitcode == 0 and received(log) == REQUESTS),
+    (f'power not checked after the idle period ended ({late_checks} checks)', late_checks == 0)
+]
+failed += sum([0 if check(desc, ok) else 1 for desc, ok in checks])
+
+print('\nAdaptive idle period that runs out without steady power:')
+log, exitcode, returned = run(idle=1.5, idle_threshold=0.0)
+checks = [
+    ('no IDLE_STEADY sent', log.get_timestamp('IDLE_STEADY_PENDING') == -1),
+    ('every request served', returned and exitcode == 0 and received(log) == REQUESTS),
+    (f'power not checked after the idle period ended ({late_checks} checks)', late_checks == 0)
+]
+failed += sum([0 if check(desc, ok) else 1 for desc, ok in checks])
+
+# (the last message sent before exiting, and the last timestamp it leaves in the log)
+for exit_after, last, desc in [('MODEL_LOAD_START', 'MODEL_LOAD_START', 'while loading the model'),
+                               ('GENERATE_2_START', 'GENERATE_2_START', 'in the middle of a request'),
+                               ('TOKEN_TIMES_2', 'DECODE_2_END', 'before reading the next request')]:
+    print(f'\nTest process exiting {desc}:')
+    log, exitcode, returned = run(exit_after=exit_after)
+    checks = [
+        ('runner returned instead of waiting for the test process', returned),
+        (f'test process exit code {exitcode} is an error', exitcode != 0),
+        (f'messages up to the exit recorded ({last})', log.get_timestamp(last) != -1),
+        ('no requests after the exit received', len(received(log)) <= (0 if exit_after == 'MODEL_LOAD_START' else 2))
+    ]
+    failed += sum([0 if check(desc, ok) else 1 for desc, ok in checks])
+
+if failed > 0:
+    print(f'\n{failed} checks failed!')
+    exit(1)
+print('\nAll checks passed')
@@ -0,0 +1,120 @@
+# Check of log checkpointing and recovery, without a Jetson.
+#
+# Runs a log in a separate process (sampling a synthetic log with the replay sampler), kills the
+# process at different points of a test, then recovers the log with statlog.recover() and checks
+# that no samples were lost or duplicated. This includes a streamed log killed during its idle period,
+# whose samples are held out of the stream (see Log.hold_stream()) and only in the checkpoint.
+# Also checks that taking a checkpoint on the sampler thread costs the same for a long log as a short one.
+# Use 'check_recovery.py --help' for a summary of usage options.
+
+import os
+import sys
+import tempfile
+from multiprocessing import Event, Process
+from time import perf_counter, sleep
+
+import statlog
+from samplers import ReplaySampler
+from statlog import Channel, Log, LogCheckpoint
+
+interval = 0.01
+
+for arg in sys.argv[1:]:
+    tmp = arg.split('=')
+    match tmp[0]:
+        case '--interval':
+            interval = float(tmp[1])
+        case _:
+            print('Usage: check_recovery.py [--interval=0.01]')
+            print('  Interrupts logs at different points of a test and checks the recovered logs')
+            exit(0 if tmp[0] == '--help' else 1)
+
+
+def make_source(duration: float) -> Log:
+    '''Returns a synthetic log with a slowly changing power reading, for the replay sampler.'''
+    source = Log()
+    source.power = Channel.from_entries([statlog.LogEntry(i * 0.01, 5 + (i % 100) / 100) for i in range(int(duration / 0.01))])
+    return source
+
+def _run_log(path: str, stream: bool, stage: str, ready):
+    # runs a log up to the given stage of a test ('idle' or 'load'), then waits to be killed
+    log = Log()
+    sampler = ReplaySampler(make_source(60))
+    # small chunks and frequent checkpoints, so both happen many times within a second
+    log.begin(interval, stream_path=path if stream else None, stream_chunk_size=20,
+              checkpoint_path=path + statlog.CHECKPOINT_SUFFIX, checkpoint_interval=0.1, sampler=sampler)
+    log.hold_stream(True)
+    sleep(0.2)
+    log.add_timestamp('IDLE_START')
+    sleep(1.0)
+    if stage != 'idle':
+        log.add_timestamp('IDLE_END')
+        log.hold_stream(False)
+        log.add_timestamp('MODEL_LOAD_START')
+        sleep(1.0)
+    ready.set()
+    sleep(60)
+
+def interrupt(path: str, stream: bool, stage: str) -> tuple[Log, float]:
+    '''Runs a log until the given stage and kills its process, returning the recovered log and how long the process ran.'''
+    ready = Event()
+    proc = Process(target=_run_log, args=[path, stream, stage, ready])
+    time_start = perf_counter()
+    proc.start()
+    ready.wait()
+    # let the last checkpoint be written, then kill the process without any cleanup
+    sleep(0.3)
+    proc.kill()
+    proc.join()
+    return statlog.recover(path), perf_counter() - time_start
+
+def check(desc: str, ok: bool) -> bool:
+    print(f'{"ok  " if ok else "FAIL"} {desc}')
+    return ok
+
+
+failed = 0
+with tempfile.TemporaryDirectory() as folder:
+    for stream, stage in [(True, 'idle'), (True, 'load'), (False, 'idle'), (False, 'load')]:
+        path = os.path.join(folder, f'log_{stage}.{"ndjson" if stream else "json"}')
+        print(f'\n{"Streamed" if stream else "JSON"} log interrupted during {"the idle period" if stage == "idle" else "the model load"}:')
+        log, run_time = interrupt(path, stream, stage)
+        times = list(log.power.times())
+        t_idle = log.get_timestamp('IDLE_START')
+        idle_samples = len([t for t in times if t >= t_idle and (stage == 'idle' or t <= log.get_timestamp('IDLE_END'))])
+        expected_idle = 1.0 / interval
+        checks = [
+            ('log is marked as truncated', log.truncated),
+            ('timestamps were recovered', t_idle != -1 and (stage == 'idle' or log.get_timestamp('MODEL_LOAD_START') != -1)),
+            (f'{len(times)} samples, none duplicated', len(times) > 0 and len(set(times)) == len(times)),
+            ('samples are in order', times == sorted(times)),
+            (f'{idle_samples} samples in the idle period (~{expected_idle:.0f} expected)', idle_samples >= 0.8 * expected_idle),
+            (f'samples cover the run up to the last checkpoint ({times[-1] if len(times) > 0 else 0:.2f} of {run_time:.2f} s)',
+             len(times) > 0 and times[-1] >= run_time - 1.0)
+        ]
+        failed += sum([0 if check(desc, ok) else 1 for desc, ok in checks])
+
+    # a snapshot only copies the samples added since the last one, so its cost doesn't grow with the log
+    print('\nCheckpoint snapshot cost:')
+    snapshot_times = dict()
+    for minutes in [1, 20]:
+        log = Log()
+        log.time_log_start = 0
+        checkpoint = LogCheckpoint(os.path.join(folder, f'snapshot_{minutes}.partial'))
+        for i in range(int(minutes * 60 / 0.1)):
+            for ch in [log.power, log.freq_gpu, log.tick_delay, log.tick_duration]:
+                ch.append(i * 0.1, 1.0)
+        checkpoint.snapshot(log)
+        for i in range(300):
+            log.power.append(minutes * 60 + i * 0.1, 1.0)
+        time_start = perf_counter()
+        checkpoint.snapshot(log)
+        snapshot_times[minutes] = perf_counter() - time_start
+        checkpoint.close()
+        print(f'  {minutes:>2} minute log: {snapshot_times[minutes] * 1000:.3f} ms')
+    failed += 0 if check('snapshot of a 20 minute log costs about the same as a 1 minute log', snapshot_times[20] < max(5 * snapshot_times[1], 0.002)) else 1
+
+if failed > 0:
+    print(f'\n{failed} checks failed!')
+    exit(1)
+print('\nAll checks passed')
@@ -0,0 +1,89 @@
+# Check of the per-token timing path, without a GPU or any downloaded model.
+#
+# Builds a tiny, randomly initialized Pythia-style model (GPT-NeoX) and a word-level tokenizer in
+# memory, generates from them on the CPU through hf_models.generate_batch() with a TokenTimer, and
+# checks that a time was recorded for every token (at batch sizes 1 and 2), that the prefill and
+# decode times add up, and that the times survive being stored in a Log and saved.
+# Use 'check_token_timer.py --help' for a summary of usage options.
+
+import sys
+
+import torch
+from tokenizers import Tokenizer
+from tokenizers.models import WordLevel
+from tokenizers.pre_tokenizers import Whitespace
+from transformers import GPTNeoXConfig, GPTNeoXForCausalLM, PreTrainedTokenizerFast
+
+import hf_models
+from statlog import Log, get_time
+
+num_tokens = 16
+batch_sizes = [1, 2]
+
+for arg in sys.argv[1:]:
+    tmp = arg.split('=')
+    match tmp[0]:
+        case '--tokens':
+            num_tokens = int(tmp[1])
+        case '--batch-sizes':
+            batch_sizes = [int(x) for x in tmp[1].split(',')]
+        case _:
+            print('Usage: check_token_timer.py [--tokens=16] [--batch-sizes=1,2]')
+            print('  Generates with a tiny random model on the CPU and checks the recorded token times')
+            exit(0 if tmp[0] == '--help' else 1)
+
+
+INPUT_TEXT = 'the quick brown fox jumps over the lazy dog while the cat sleeps in the sun'
+
+def make_tokenizer() -> PreTrainedTokenizerFast:
+    '''Returns a word-level tokenizer over the words of the input text, padded on the left.'''
+    words = sorted(set(INPUT_TEXT.split()))
+    vocab = {'[UNK]': 0, '[EOS]': 1} | {w: i + 2 for i, w in enumerate(words)}
+    tokenizer = Tokenizer(WordLevel(vocab, unk_token='[UNK]'))
+    tokenizer.pre_tokenizer = Whitespace()
+    return PreTrainedTokenizerFast(tokenizer_object=tokenizer, unk_token='[UNK]', eos_token='[EOS]', padding_side='left')
+
+def make_model(tokenizer: PreTrainedTokenizerFast) -> GPTNeoXForCausalLM:
+    '''Returns a tiny, randomly initialized GPT-NeoX model on the CPU that never ends a generation early.'''
+    torch.manual_seed(0)
+    config = GPTNeoXConfig(vocab_size=len(tokenizer), hidden_size=32, num_hidden_layers=2, num_attention_heads=4,
+                           intermediate_size=64, max_position_embeddings=128,
+                           bos_token_id=tokenizer.eos_token_id, eos_token_id=tokenizer.eos_token_id)
+    model = GPTNeoXForCausalLM(config).eval()
+    model.generation_config.min_new_tokens = num_tokens
+    return model
+
+def check(desc: str, ok: bool) -> bool:
+    print(f'{"ok  " if ok else "FAIL"} {desc}')
+    return ok
+
+
+tokenizer = make_tokenizer()
+model = make_model(tokenizer)
+failed = 0
+for batch_size in batch_sizes:
+    print(f'\nBatch size {batch_size}:')
+    log = Log()
+    # the log isn't sampled, only its start time is needed to store token times
+    log.time_log_start = get_time()
+    timer = hf_models.TokenTimer()
+    outputs, new_tokens = hf_models.generate_batch(model, tokenizer, [INPUT_TEXT] * batch_size, max_new_tokens=num_tokens, timer=timer)
+    log.add_token_times(timer.time_start, timer.token_times)
+    itl = timer.inter_token_latencies()
+
+    checks = [
+        (f'{len(new_tokens)} sequences of {[len(x) for x in new_tokens]} new tokens', [len(x) for x in new_tokens] == [num_tokens] * batch_size),
+        (f'{len(timer.token_times)} token times (one per generation step)', len(timer.token_times) == num_tokens),
+        (f'time to first token {timer.ttft() * 1000:.2f} ms', timer.ttft() > 0),
+        (f'{len(itl)} inter-token latencies, all positive', len(itl) == num_tokens - 1 and all([x > 0 for x in itl])),
+        (f'decode time {timer.decode_time() * 1000:.2f} ms is the sum of the latencies', abs(timer.decode_time() - sum(itl)) < 1e-9),
+        (f'{len(log.token_latency)} token latencies stored in the log', len(log.token_latency) == num_tokens),
+        ('first stored latency is the time to first token', abs(log.token_latency[0].value - timer.ttft()) < 1e-9),
+        ('token latencies are kept when the log is saved', len(Log.from_json(log.to_json()).token_latency) == num_tokens)
+    ]
+    failed += sum([0 if check(desc, ok) else 1 for desc, ok in checks])
+
+if failed > 0:
+    print(f'\n{failed} checks failed!')
+    exit(1)
+print('\nAll checks passed')
@@ -3,17 +3,29 @@
 # Liam Seymour 6/17/24
 
 from huggingface_hub import login
-from torch import float16
-from transformers import AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig, CONFIG_NAME
+from torch import float16, full, tensor, zeros
+from transformers import AutoModelForCausalLM, AutoTokenizer, BatchEncoding, BitsAndBytesConfig, CONFIG_NAME
+from transformers import __version__ as transformers_version
+from transformers.generation.streamers import BaseStreamer
 from transformers.utils.hub import cached_file
 
+import hashlib
+import json
+from importlib.metadata import version
 from multiprocessing import Process
-from os import listdir
-from os.path import expanduser
+from os import listdir, rename
+from os.path import isdir
 from shutil import rmtree
+from time import perf_counter
+from weakref import WeakKeyDictionary
 
-CACHE_DIR = expanduser('~/.cache/huggingface/hub/')
-'''Cache directory for HF Hub'''
+from model_cache import ModelCache, parse_size, quantized_folder
+from prefetch import CACHE_DIR, Source, prefetch
+
+_tokenizer_hashes = WeakKeyDictionary()
+'''Hash of each tokenizer used for encoding (see tokenizer_hash())'''
+_encodings: dict[tuple[str, str], list[int]] = dict()
+'''Token IDs of each text encoded in this process, by tokenizer hash and text (see encode_texts())'''
 
 def login_by_token(token_file="access_token", token=None) -> bool:
     '''Attempts to login to HuggingFace Hub with a given token or token file.'''
@@ -44,28 +56,30 @@ def check_model_in_cache(model_name: str) -> bool:
     )
     return check != None
 
-def _dl_model_proc(model_name: str):
-    # Note: there is probably a better way to do this. I'm just loading the model/tokenizer and 
-    # immediately unloading them, since there is built-in downloading set up and models have different
-    # files. However, I haven't seen any straightforward methods provided in the source for only
-    # downloading the models without loading them.
-    bnb_conf = BitsAndBytesConfig(load_in_4bit=True, bnb_4bit_compute_dtype=float16)
-    model = AutoModelForCausalLM.from_pretrained(model_name, device_map="auto", quantization_config=bnb_conf)
-    tokenizer = AutoTokenizer.from_pretrained(model_name, padding_side="left")
-    del model
-    del tokenizer
-
-def download_model(model_name: str):
-    '''Downloads the given model from the HF Hub, unless it already exists in the HF local cache.
-    
-    Uses the multiprocessing library to isolate the loading process and release memory after downloading'''
-
-    if not check_model_in_cache(model_name):
-        print("Downloading model: " + model_name)
-        pr = Process(target=_dl_model_proc, args=[model_name])
-        pr.start()
-        pr.join()
-        del pr
+def download_model(model_name: str, source: Source = None):
+    '''Downloads the given model from the HF Hub (or the given source), unless it already exists in the HF local cache.'''
+    download_models([model_name], source)
+
+def download_models(model_names: list[str], source: Source = None, workers: int = 4) -> list[str]:
+    '''Downloads the given models from the HF Hub (or the given source), skipping any that already exist in the HF local cache.
+    The files of every model are fetched concurrently, and only the files needed to load them (see prefetch.py).
+    Returns the names of the models that failed to download.'''
+    missing = [x for x in model_names if not check_model_in_cache(x)]
+    if len(missing) == 0:
+        return list()
+    print("Downloading models: " + ", ".join(missing))
+    done = prefetch(missing, source, CACHE_DIR, workers)
+    cache = ModelCache(CACHE_DIR)
+    for model_name in done:
+        cache.touch(model_name)
+    return [x for x in missing if x not in done]
+
+def trim_cached_models(budget: str, keep: list[str]):
+    '''Evicts the least recently used models from the HF local cache until it fits within the given budget, either a size
+    (i.e. 20G) or a percentage of the disk (see model_cache.py). The models in keep, and their partial downloads, are kept.'''
+    cache = ModelCache(CACHE_DIR)
+    cache.clear_incomplete(keep)
+    cache.enforce_budget(parse_size(budget, CACHE_DIR), keep)
 
 def erase_cached_models():
     '''Removes all cached models in the HF local cache.'''
@@ -75,24 +89,176 @@ def erase_cached_models():
             print("Erasing " + model_dir)
             rmtree(model_dir, True)
 
-def load_model(model_name: str, bnb_conf=None):
-    '''Load an LLM model from HF from the given string. Always loads to the GPU.'''
-    print("Loading model: " + model_name)
+def quantization_config() -> BitsAndBytesConfig:
+    '''Returns the quantization settings used for quantized models (4-bit, with float16 compute).'''
+    return BitsAndBytesConfig(load_in_4bit=True, bnb_4bit_compute_dtype=float16)
+
+def quantized_model_path(model_name: str, bnb_conf: BitsAndBytesConfig) -> str:
+    '''Returns the folder of the pre-quantized copy of the cached snapshot of a model, for the given quantization settings
+    (whether or not it exists yet). Returns an empty string if the model isn't in the HF local cache.'''
+    commit = ModelCache(CACHE_DIR).current_commit(model_name)
+    if len(commit) == 0:
+        return ''
+    # the library versions are part of the key, since they decide the layout of the quantized weights
+    settings = dict(bnb_conf.to_dict(), transformers=transformers_version, bitsandbytes=version('bitsandbytes'))
+    key = hashlib.sha1(json.dumps(settings, sort_keys=True, default=str).encode()).hexdigest()[:12]
+    return quantized_folder(model_name, commit, key, CACHE_DIR)
+
+def _quantize_model_proc(model_name: str, path: str):
+    bnb_conf = quantization_config()
     model = AutoModelForCausalLM.from_pretrained(model_name, device_map="auto", quantization_config=bnb_conf)
-    tokenizer = AutoTokenizer.from_pretrained(model_name, padding_side="left")
+    # saved to a temporary folder first, so a partially saved model is never loaded
+    rmtree(path + ".tmp", True)
+    model.save_pretrained(path + ".tmp", safe_serialization=True)
+    rmtree(path, True)
+    rename(path + ".tmp", path)
+
+def quantize_models(model_names: list[str]):
+    '''Saves a pre-quantized copy of each of the given models (with the settings from quantization_config()) next to it
+    in the HF local cache, unless one already exists. Load these copies (see prepare_load()) instead of quantizing the model again.
+
+    Uses the multiprocessing library to isolate the loading process and release memory after quantizing'''
+    for model_name in model_names:
+        path = quantized_model_path(model_name, quantization_config())
+        if len(path) == 0 or isdir(path):
+            continue
+        print("Quantizing model: " + model_name)
+        pr = Process(target=_quantize_model_proc, args=[model_name, path])
+        pr.start()
+        pr.join()
+        if pr.exitcode != 0:
+            print("Failed to quantize model: " + model_name)
+        del pr
+
+def prepare_load(model_name: str, bnb_conf=None, use_quantized_cache=True) -> str:
+    '''Prepares to load a model, outside of the time measured for the load: records that the model was used (see
+    model_cache.py) and finds its pre-quantized copy. Returns the folder of the copy if quantization settings are given
+    and the model has a copy with those settings (see quantize_models()), unless use_quantized_cache is False.
+    Otherwise returns an empty string, and the model is quantized as it is loaded.'''
+    ModelCache(CACHE_DIR).touch(model_name)
+    path = quantized_model_path(model_name, bnb_conf) if bnb_conf is not None and use_quantized_cache else ''
+    return path if len(path) > 0 and isdir(path) else ''
+
+def load_model(model_name: str, bnb_conf=None, quantized_path=''):
+    '''Load an LLM model from HF from the given string. Always loads to the GPU.
+    If the folder of a pre-quantized copy of the model is given (see prepare_load()), the copy is loaded instead of
+    quantizing the model with the given settings.'''
+    print("Loading model: " + model_name)
+    if len(quantized_path) > 0:
+        print("Using pre-quantized model: " + quantized_path)
+        # the quantization settings are stored in the copy's config
+        model = AutoModelForCausalLM.from_pretrained(quantized_path, device_map="auto")
+    else:
+        model = AutoModelForCausalLM.from_pretrained(model_name, device_map="auto", quantization_config=bnb_conf)
+    tokenizer = load_tokenizer(model_name)
     return model, tokenizer
 
-def load_model_quantized(model_name: str):
-    '''Load an LLM model from HF with quantization enabled.'''
-    return load_model(model_name=model_name, bnb_conf=BitsAndBytesConfig(load_in_4bit=True, bnb_4bit_compute_dtype=float16))
+def load_tokenizer(model_name: str, path: str = None):
+    '''Loads the tokenizer of an LLM model from HF (from the given path, if any), padded on the left.'''
+    tokenizer = AutoTokenizer.from_pretrained(path if path is not None else model_name, padding_side="left")
+    # the files of a model don't change within a process, so the hash doesn't need to be made from the whole vocabulary
+    _tokenizer_hashes[tokenizer] = hashlib.sha1(f'{model_name}@{path}:{type(tokenizer).__name__}'.encode()).hexdigest()
+    return tokenizer
+
+def tokenizer_hash(tokenizer) -> str:
+    '''Returns a hash identifying how a tokenizer encodes text.
+    Tokenizers from load_tokenizer() are identified by the model they were loaded from, others by their serialized vocabulary and settings.'''
+    if tokenizer not in _tokenizer_hashes:
+        data = tokenizer.backend_tokenizer.to_str() if tokenizer.is_fast else json.dumps(tokenizer.get_vocab(), sort_keys=True)
+        settings = json.dumps(tokenizer.special_tokens_map, sort_keys=True, default=str)
+        _tokenizer_hashes[tokenizer] = hashlib.sha1(f'{type(tokenizer).__name__}:{settings}:{data}'.encode()).hexdigest()
+    return _tokenizer_hashes[tokenizer]
+
+def encode_texts(tokenizer, texts: list[str]) -> BatchEncoding:
+    '''Encodes several texts as a batch, padded on the tokenizer's padding side (like calling the tokenizer with padding=True).
+    The token IDs of each text are kept once encoded, so the same text (i.e. the input repeated to fill a batch, or given
+    again in the next request) is only tokenized once per process.'''
+    h = tokenizer_hash(tokenizer)
+    ids = list()
+    for text in texts:
+        if (h, text) not in _encodings:
+            _encodings[(h, text)] = tokenizer(text)['input_ids']
+        ids.append(_encodings[(h, text)])
+    length = max([len(x) for x in ids])
+    input_ids = full((len(ids), length), tokenizer.pad_token_id)
+    attention_mask = zeros((len(ids), length), dtype=input_ids.dtype)
+    for i, x in enumerate(ids):
+        cols = slice(length - len(x), length) if tokenizer.padding_side == "left" else slice(0, len(x))
+        input_ids[i, cols] = tensor(x)
+        attention_mask[i, cols] = 1
+    return BatchEncoding({'input_ids': input_ids, 'attention_mask': attention_mask})
+
+def load_model_quantized(model_name: str, quantized_path=''):
+    '''Load an LLM model from HF with quantization enabled (from its pre-quantized copy, if the folder is given).'''
+    return load_model(model_name=model_name, bnb_conf=quantization_config(), quantized_path=quantized_path)
+
+class TokenTimer(BaseStreamer):
+    '''Streamer that records the time each token is generated, for measuring per-token latency.
+
+    model.generate() passes the prompt to the streamer once before generating, then each new token
+    (or batch of tokens) as it is produced. Times are taken with perf_counter, the same clock as
+    statlog.get_time(), so they can be added to a log with Log.add_token_times() (even from another process).
+    Note that using a streamer synchronizes with the GPU after every token.'''
+    time_start: float
+    '''Time that generation started, i.e. when the prompt was passed to the streamer'''
+    token_times: list[float]
+    '''Time that each token was generated'''
+
+    def __init__(self):
+        self.time_start = -1
+        self.token_times = list()
 
-def generate_from_input(model, tokenizer, input_text: str, max_new_tokens=64) -> tuple[str, list]:
+    def put(self, value):
+        t = perf_counter()
+        if self.time_start == -1:
+            self.time_start = t
+        else:
+            self.token_times.append(t)
+
+    def end(self):
+        pass
+
+    def ttft(self) -> float:
+        '''Returns the time to first token (the prefill time), or -1 if no tokens were generated.'''
+        if len(self.token_times) == 0:
+            return -1
+        return self.token_times[0] - self.time_start
+
+    def inter_token_latencies(self) -> list[float]:
+        '''Returns the time between each pair of consecutive tokens (the decode steps).'''
+        return [b - a for a, b in zip(self.token_times[:-1], self.token_times[1:])]
+
+    def decode_time(self) -> float:
+        '''Returns the time from the first token to the last.'''
+        if len(self.token_times) == 0:
+            return 0
+        return self.token_times[-1] - self.token_times[0]
+
+def generate_from_input(model, tokenizer, input_text: str, max_new_tokens=64, timer: TokenTimer = None) -> tuple[str, list]:
     '''Generates text from a given input, model, and tokenizer.
-    Returns the generated text and a list of the generated tokens.'''
-    model_inputs = tokenizer([input_text], return_tensors="pt").to("cuda")
-    print("Generating tokens...")
-    generated_ids = model.generate(**model_inputs, max_new_tokens=max_new_tokens, do_sample=True)
+    Returns the generated text and a list of the generated tokens.
+    If a TokenTimer is given, the time each token is generated is recorded in it.'''
+    decoded, new_tokens = generate_batch(model, tokenizer, [input_text], max_new_tokens, timer)
+    return decoded[0], new_tokens[0]
+
+def generate_batch(model, tokenizer, input_texts: list[str], max_new_tokens=64, timer: TokenTimer = None) -> tuple[list[str], list]:
+    '''Generates text from several inputs at once, as a single batch.
+    Inputs are padded on the left (the tokenizer is loaded with padding_side="left"), so every sequence in the
+    batch continues from the end of its own input. Returns the generated texts and lists of the generated tokens
+    of each input (up to and including the end-of-sequence token, if one was generated).
+    If a TokenTimer is given, the time each batch of tokens is generated is recorded in it.'''
+    if tokenizer.pad_token is None:
+        # i.e. Pythia models have no padding token, padding is masked out anyway
+        tokenizer.pad_token = tokenizer.eos_token
+    model_inputs = encode_texts(tokenizer, input_texts).to(model.device)
+    print(f"Generating tokens (batch size {len(input_texts)})...")
+    generated_ids = model.generate(**model_inputs, max_new_tokens=max_new_tokens, do_sample=True, streamer=timer,
+                                   pad_token_id=tokenizer.pad_token_id)
     print("Decoding tokens...")
-    decoded = tokenizer.batch_decode(generated_ids, skip_special_tokens=True)[0]
-    new_tokens = generated_ids[0][len(model_inputs['input_ids'][0]):]
+    decoded = tokenizer.batch_decode(generated_ids, skip_special_tokens=True)
+    new_tokens = list()
+    for row in generated_ids[:, model_inputs['input_ids'].shape[1]:]:
+        # sequences that finish early are padded to the length of the longest
+        eos = (row == tokenizer.eos_token_id).nonzero()
+        new_tokens.append(row[:int(eos[0]) + 1] if len(eos) > 0 else row)
     return decoded, new_tokens
\ No newline at end of file
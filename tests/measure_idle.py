@@ -0,0 +1,87 @@
+# Measures the idle-baseline power drawn while the test runner waits on its test process.
+#
+# The runner used to busy-poll the message pipe (spinning a CPU core for the whole test), and now
+# blocks on the pipe and the process sentinel with multiprocessing.connection.wait(). This script
+# runs an idle test process (which only sleeps, like the idle baseline period) with each method of
+# waiting, and compares the mean power and the CPU time used by the runner.
+# Use 'measure_idle.py --help' for a summary of usage options.
+
+import sys
+from multiprocessing import Pipe, Process
+from multiprocessing.connection import Connection, wait
+from time import process_time, sleep
+
+import samplers
+from statlog import Log
+
+duration = 15.0
+sampler_spec = ''
+
+for arg in sys.argv[1:]:
+    tmp = arg.split('=')
+    match tmp[0]:
+        case '--duration':
+            duration = float(tmp[1])
+        case '--sampler':
+            sampler_spec = tmp[1]
+        case _:
+            print('Usage: measure_idle.py [--duration=15.0] [--sampler=jtop|sysfs[:<root>]|replay:<log path>]')
+            exit(0 if tmp[0] == '--help' else 1)
+
+
+def _idle_test(conn: Connection, duration: float):
+    conn.send('IDLE_START')
+    sleep(duration)
+    conn.send('IDLE_END')
+    conn.close()
+
+def _receive_poll(log: Log, msg_recv: Connection, proc: Process):
+    # the old busy-polling loop
+    while proc.is_alive():
+        if msg_recv.poll():
+            log.add_timestamp(msg_recv.recv())
+    # (messages sent just before the process exited were dropped by the old loop, read them here)
+    while msg_recv.poll():
+        log.add_timestamp(msg_recv.recv())
+
+def _receive_wait(log: Log, msg_recv: Connection, proc: Process):
+    # the event-driven loop used by run_tests.py
+    while True:
+        ready = wait([msg_recv, proc.sentinel])
+        if msg_recv in ready:
+            log.add_timestamp(msg_recv.recv())
+        elif not msg_recv.poll():
+            break
+
+def measure(receive) -> tuple[float, float]:
+    '''Returns the mean power (W) during the idle period and the CPU time (s) used by this process while waiting.'''
+    log = Log()
+    log.begin(interval=0.1, sampler=sampler)
+    msg_recv, msg_send = Pipe()
+    proc = Process(target=_idle_test, args=[msg_send, duration])
+    cpu_start = process_time()
+    proc.start()
+    receive(log, msg_recv, proc)
+    cpu_time = process_time() - cpu_start
+    proc.join()
+    msg_send.close()
+    msg_recv.close()
+    log.end()
+
+    t_start, t_end = log.period('IDLE')
+    powers = [entry.value for entry in log.power if t_start <= entry.time <= t_end]
+    return sum(powers) / max(len(powers), 1), cpu_time
+
+
+sampler = samplers.get_sampler(sampler_spec) if len(sampler_spec) > 0 else None
+print(f'Measuring {duration} s idle periods...')
+results = dict()
+for name, receive in [('poll', _receive_poll), ('wait', _receive_wait)]:
+    results[name] = measure(receive)
+    sleep(3) # buffer time
+if sampler is not None:
+    sampler.close()
+print('Receiver | Mean power (W) | Runner CPU time (s)')
+for name, (power, cpu_time) in results.items():
+    print(f'{name:>8} | {power:>14.3f} | {cpu_time:>19.3f}')
+print(f'Idle power drop: {results["poll"][0] - results["wait"][0]:.3f} W')
@@ -0,0 +1,123 @@
+# Messages between the test runner (run_tests.py) and its test process.
+#
+# The test process sends each event of a test (i.e. 'MODEL_LOAD_START') over a pipe, along with the
+# time it was sent (see send()). The runner records them in the log as they arrive (see receive_messages()).
+# Most messages become timestamps, except for a few that carry values after a colon:
+#
+#   TOKENS<request>:<count>          - the number of tokens generated (recorded in Log.tokens_generated)
+#   TOKEN_TIMES<request>:<times>     - the start of generation and the time of each token, the last message
+#                                      of a request (recorded in Log.token_latency, with PREFILL and DECODE timestamps)
+#   LOAD_QUANTIZE_TIME:<seconds>     - the time spent quantizing during LOAD_TRANSFER (see mmap_loader.py)
+#
+# The runner sends the test process 'IDLE_STEADY' once the power is steady during an adaptive idle period.
+# In warm mode, it also sends the test process each request as a (number, input) tuple, numbered from 1:
+# the first once the model has loaded ('MODEL_LOAD_END'), and each next one once the token times of the
+# previous one have arrived ('TOKEN_TIMES_<n>:'). None is sent after the last request. The test process
+# reads them with receive_requests(), and always sends the token times of a request last (or exits if
+# generating fails), so the runner never waits on a request that the test process has finished.
+
+from multiprocessing import Process
+from multiprocessing.connection import Connection, wait
+from typing import Iterator
+
+from statlog import Log, get_time
+
+IDLE_WINDOW = 3.0
+'''Time (in seconds) that power must be steady for before an adaptive idle period ends'''
+
+
+def send(conn: Connection, message: str):
+    '''Sends a message from the test process, along with the time it was sent.
+    Messages are timestamped here rather than when they are received, since perf_counter
+    shares the same clock across processes.'''
+    conn.send((message, get_time()))
+
+def receive_requests(conn: Connection) -> Iterator[tuple[int, str]]:
+    '''Yields the (number, input) requests sent to the test process in warm mode, until None is received.'''
+    while True:
+        request = conn.recv()
+        if request == 'IDLE_STEADY':
+            continue # the idle period ended on its own before the runner's message arrived
+        if request is None:
+            return
+        yield request
+
+def record_message(test_log: Log, message: str, time_sent: float = -1):
+    '''Records a message from the test process in the log.
+    If the time the message was sent is given (see send()), any timestamp is added at that time instead of now.'''
+    if time_sent != -1:
+        test_log.add_message_delay(time_sent)
+    msg_var = message.split(':')
+    if msg_var[0].startswith('TOKEN_TIMES'):
+        # per-token times go in the log's token_latency channel instead of the timestamps
+        request = msg_var[0][len('TOKEN_TIMES'):]
+        times = [float(x) for x in msg_var[1].split(',')]
+        test_log.add_token_times(times[0], times[1:])
+        # generation is split into the prefill (up to the first token) and decode (the rest) phases
+        if len(times) > 1:
+            test_log.add_timestamp(f'PREFILL{request}_START', times[0])
+            test_log.add_timestamp(f'PREFILL{request}_END', times[1])
+            test_log.add_timestamp(f'DECODE{request}_START', times[1])
+            test_log.add_timestamp(f'DECODE{request}_END', times[-1])
+        return
+    test_log.add_timestamp(message, time_sent)
+    if message == 'IDLE_END':
+        # streamed logs hold their samples in memory until the idle period ends (see Log.hold_stream()),
+        # so the baseline is measured now, before they are written out
+        t_start, t_end = test_log.period('IDLE')
+        power, power_std, _ = test_log.power_stats(t_start, t_end)
+        test_log.baseline = {'power': power, 'power_std': power_std, 'duration': t_end - t_start, 'shared': False}
+        test_log.hold_stream(False)
+    if len(msg_var) > 1:
+        if msg_var[0].startswith('TOKENS'):
+            # tokens are counted over all requests in warm mode
+            test_log.tokens_generated = max(test_log.tokens_generated, 0) + int(msg_var[1])
+
+def idle_is_steady(test_log: Log, threshold: float) -> bool:
+    '''Returns True if the log is in an idle period, and power has been steady for the last IDLE_WINDOW seconds.
+    The window must be covered by samples (at least 90% of the ticks expected at the sampling interval).'''
+    t_start = test_log.get_timestamp('IDLE_START')
+    if t_start == -1 or test_log.get_timestamp('IDLE_END') != -1 or len(test_log.power) == 0:
+        return False
+    t_end = test_log.power[-1].time
+    if t_end - IDLE_WINDOW < t_start:
+        return False
+    _, power_std, n = test_log.power_stats(t_end - IDLE_WINDOW, t_end)
+    min_samples = max(int(0.9 * IDLE_WINDOW / test_log.sampler_info['interval']), 2)
+    return n >= min_samples and power_std < threshold
+
+def receive_messages(test_log: Log, msg_recv: Connection, proc: Process, idle_threshold: float = -1, requests: list = None):
+    '''Records messages from the test process until it exits.
+    Blocks until either a message arrives or the process exits, instead of polling the pipe.
+    If an idle threshold is given, the test process is told to end its idle period once power is steady (adaptive idle).
+    If requests are given (warm mode), they are sent to the test process one at a time, numbered from 1: the first once
+    the model has loaded, and each one after the previous one has finished. None is sent after the last one.'''
+    if requests is None:
+        requests = list()
+    idle_signalled = idle_threshold == -1
+    next_request = 0
+    while True:
+        # while waiting for the power to be steady, wake up to check it every half second
+        ready = wait([msg_recv, proc.sentinel], None if idle_signalled else 0.5)
+        if not idle_signalled and idle_is_steady(test_log, idle_threshold):
+            msg_recv.send('IDLE_STEADY')
+            idle_signalled = True
+        if msg_recv in ready:
+            data = msg_recv.recv()
+            if isinstance(data, tuple):
+                message = str(data[0])
+                record_message(test_log, message, data[1])
+            else:
+                # plain messages are timestamped on receipt
+                message = str(data)
+                record_message(test_log, message)
+            # once the idle period is over (or the model load starts without one), power no longer needs checking
+            if message == 'IDLE_END' or message == 'MODEL_LOAD_START':
+                idle_signalled = True
+            # a request is finished once its token times arrive (the last message of _generate_request() in run_tests.py)
+            if len(requests) > 0 and (message == 'MODEL_LOAD_END' or message.startswith(f'TOKEN_TIMES_{next_request}:')):
+                msg_recv.send((next_request + 1, requests[next_request]) if next_request < len(requests) else None)
+                next_request += 1
+        elif proc.sentinel in ready and not msg_recv.poll():
+            # the process has exited and every message it sent has been recorded
+            break
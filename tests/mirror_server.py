@@ -0,0 +1,108 @@
+# Local stand-in for the HF Hub, for testing prefetch.py without network access.
+#
+# Serves a mirror folder (holding each repo's files under <root>/<org>/<name>/, see
+# prefetch.MirrorSource) over HTTP, with the parts of the Hub API used by prefetch.HubSource:
+# repo info with file checksums, and file downloads with Range requests. To test resuming, the
+# --drop-after option cuts off the first download of each file after the given number of bytes.
+# Use 'mirror_server.py --help' for a summary of usage options.
+
+import json
+import os
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote, urlparse
+
+from prefetch import MirrorSource
+
+root = '.'
+port = 8080
+drop_after = -1
+
+for arg in sys.argv[1:]:
+    tmp = arg.split('=', 1)
+    match tmp[0]:
+        case '--root':
+            root = tmp[1]
+        case '--port':
+            port = int(tmp[1])
+        case '--drop-after':
+            drop_after = int(tmp[1])
+        case _:
+            print('Usage: mirror_server.py [--root=.] [--port=8080] [--drop-after=<bytes>]')
+            print('  Then run: prefetch.py --source=http://localhost:8080')
+            exit(0 if tmp[0] == '--help' else 1)
+
+
+mirror = MirrorSource(root)
+listings: dict[str, tuple] = dict()
+'''Files of each repo, listed once (since listing a mirror hashes every file)'''
+dropped = set()
+'''Files whose first download has already been cut off'''
+lock = threading.Lock()
+
+def _listing(repo_id: str) -> tuple:
+    with lock:
+        if repo_id not in listings:
+            listings[repo_id] = mirror.list_files(repo_id, 'main')
+        return listings[repo_id]
+
+
+class MirrorHandler(BaseHTTPRequestHandler):
+    def _send_json(self, data: dict):
+        body = json.dumps(data).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _repo_info(self, repo_id: str):
+        commit, files = _listing(repo_id)
+        siblings = [{'rfilename': x.name, 'size': x.size, 'lfs': {'sha256': x.blob_id, 'size': x.size}} for x in files]
+        self._send_json({'id': repo_id, 'sha': commit, 'siblings': siblings})
+
+    def _file(self, repo_id: str, name: str):
+        path = os.path.join(root, repo_id, name)
+        size = os.path.getsize(path)
+        start = 0
+        if 'Range' in self.headers:
+            start = int(self.headers['Range'].split('=')[1].split('-')[0])
+            if start >= size:
+                self.send_error(416)
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{size - 1}/{size}')
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(size - start))
+        self.end_headers()
+
+        limit = size - start
+        with lock:
+            if drop_after >= 0 and path not in dropped:
+                dropped.add(path)
+                limit = min(limit, drop_after)
+        with open(path, 'rb') as fp:
+            fp.seek(start)
+            self.wfile.write(fp.read(limit))
+        if limit < size - start:
+            self.close_connection = True
+
+    def do_GET(self):
+        path = unquote(urlparse(self.path).path).strip('/').split('/')
+        try:
+            # /api/models/<org>/<name>/revision/<revision>
+            if len(path) == 6 and path[:2] == ['api', 'models'] and path[4] == 'revision':
+                self._repo_info('/'.join(path[2:4]))
+            # /<org>/<name>/resolve/<commit>/<file...>
+            elif len(path) > 4 and path[2] == 'resolve':
+                self._file('/'.join(path[:2]), '/'.join(path[4:]))
+            else:
+                self.send_error(404)
+        except FileNotFoundError:
+            self.send_error(404)
+
+
+print(f'Serving mirror {os.path.abspath(root)} on http://localhost:{port}')
+ThreadingHTTPServer(('', port), MirrorHandler).serve_forever()
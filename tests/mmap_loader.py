@@ -0,0 +1,184 @@
+# Step-by-step model loading from memory-mapped safetensors files.
+#
+# from_pretrained() loads a model in one call, so a log can only show how long the whole load took.
+# This loader does the same work in separate phases, reporting the start and end of each one:
+#
+#   LOAD_CONFIG    - parsing the model config and building the model without allocating its weights
+#   LOAD_WEIGHTS   - opening the safetensors shards (memory-mapped, or read into memory)
+#   LOAD_TRANSFER  - copying the weights to the GPU (and quantizing the linear layers, for quantized models)
+#   LOAD_TOKENIZER - loading the tokenizer
+#
+# In 'mmap' mode, tensors are zero-copy views of the memory-mapped shards, so no data is read until
+# the transfer touches each page (and on the unified memory of a Jetson, the copy to the GPU is the
+# only copy made). In 'read' mode, the shards are read into memory first, so the time taken to read
+# them from disk is measured on its own. Only models with safetensors weights can be loaded.
+#
+# Quantized models have each linear layer quantized as its weights are copied to the GPU, so only one
+# layer is ever on the GPU unquantized, and the peak GPU memory is close to that of the quantized model
+# (as with from_pretrained()). The time spent quantizing is added up over the layers and reported at the
+# end of LOAD_TRANSFER (as 'LOAD_QUANTIZE_TIME:<seconds>'), so the rest of the phase is the copy itself.
+
+import json
+import mmap
+import os
+from time import perf_counter
+from typing import Callable
+
+import torch
+from accelerate import init_empty_weights
+from accelerate.utils import set_module_tensor_to_device
+from transformers import AutoConfig, AutoModelForCausalLM, BitsAndBytesConfig
+from transformers.integrations import get_keys_to_not_convert
+
+from hf_models import load_tokenizer
+from model_cache import ModelCache
+from prefetch import CACHE_DIR, repo_folder
+
+_DTYPES = {
+    'F64': torch.float64, 'F32': torch.float32, 'F16': torch.float16, 'BF16': torch.bfloat16,
+    'I64': torch.int64, 'I32': torch.int32, 'I16': torch.int16, 'I8': torch.int8, 'U8': torch.uint8, 'BOOL': torch.bool
+}
+
+
+def open_safetensors(path: str, mode: str = 'mmap') -> dict[str, torch.Tensor]:
+    '''Returns the tensors in a safetensors file, on the CPU.
+    In 'mmap' mode the tensors are views of the memory-mapped file, and in 'read' mode the file is read into memory first.
+    The file is mapped copy-on-write, so writing to a tensor never changes the file.'''
+    with open(path, 'rb') as fp:
+        if mode == 'mmap':
+            buf = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_COPY)
+        elif mode == 'read':
+            buf = bytearray(os.path.getsize(path))
+            fp.readinto(buf)
+        else:
+            raise ValueError(f'Unknown load mode: {mode}')
+    # layout: header size (8 byte little-endian), JSON header, then the data of every tensor
+    header_size = int.from_bytes(buf[:8], 'little')
+    header = json.loads(bytes(buf[8:8 + header_size]))
+    header.pop('__metadata__', None)
+    tensors = dict()
+    for name, info in header.items():
+        dtype = _DTYPES[info['dtype']]
+        start, end = info['data_offsets']
+        itemsize = torch.tensor([], dtype=dtype).element_size()
+        if end == start:
+            tensors[name] = torch.empty(info['shape'], dtype=dtype)
+            continue
+        tensors[name] = torch.frombuffer(buf, dtype=dtype, count=(end - start) // itemsize, offset=8 + header_size + start).view(info['shape'])
+    return tensors
+
+def snapshot_weights(model_name: str) -> tuple[str, list[str]]:
+    '''Returns the snapshot folder of a model in the HF local cache, and the paths of its safetensors shards.'''
+    commit = ModelCache(CACHE_DIR).current_commit(model_name)
+    if len(commit) == 0:
+        raise RuntimeError(f'Model {model_name} is not in the HF local cache, download it first!')
+    folder = os.path.join(repo_folder(model_name, CACHE_DIR), 'snapshots', commit)
+    index_path = os.path.join(folder, 'model.safetensors.index.json')
+    if os.path.exists(index_path):
+        with open(index_path, 'r') as fp:
+            shards = sorted(set(json.load(fp)['weight_map'].values()))
+        return folder, [os.path.join(folder, x) for x in shards]
+    if os.path.exists(os.path.join(folder, 'model.safetensors')):
+        return folder, [os.path.join(folder, 'model.safetensors')]
+    raise RuntimeError(f'Model {model_name} has no safetensors weights, load it with from_pretrained() instead!')
+
+def _quantized_linear_names(model: torch.nn.Module) -> set[str]:
+    # names of the linear layers to quantize (all but the output head, as transformers does)
+    skip = get_keys_to_not_convert(model)
+    return {name for name, module in model.named_modules()
+            if isinstance(module, torch.nn.Linear) and not any([name == x or name.endswith('.' + x) for x in skip])}
+
+def _quantize_linear(model: torch.nn.Module, name: str, weight: torch.Tensor, bnb_conf: BitsAndBytesConfig, device: torch.device) -> float:
+    # replaces a linear layer with a 4-bit layer, copying its weight to the device and quantizing it there,
+    # and returns the time taken to quantize (not counting the copy)
+    import bitsandbytes as bnb
+    module = model.get_submodule(name)
+    layer = bnb.nn.Linear4bit(module.in_features, module.out_features, module.bias is not None,
+                              compute_dtype=bnb_conf.bnb_4bit_compute_dtype, compress_statistics=bnb_conf.bnb_4bit_use_double_quant,
+                              quant_type=bnb_conf.bnb_4bit_quant_type, device='meta')
+    weight = weight.to(device)
+    torch.cuda.synchronize(device)
+    time_start = perf_counter()
+    # (cuda() quantizes the weight, which is already on the device)
+    layer.weight = bnb.nn.Params4bit(weight, requires_grad=False, compress_statistics=bnb_conf.bnb_4bit_use_double_quant,
+                                     quant_type=bnb_conf.bnb_4bit_quant_type).cuda(device)
+    torch.cuda.synchronize(device)
+    quantize_time = perf_counter() - time_start
+    if module.bias is not None:
+        # (still on the meta device if it comes after the weight in the checkpoint, it is set on the new layer then)
+        layer.bias = module.bias
+    parent_name, _, child_name = name.rpartition('.')
+    setattr(model.get_submodule(parent_name), child_name, layer)
+    return quantize_time
+
+def load_model(model_name: str, bnb_conf: BitsAndBytesConfig = None, mode: str = 'mmap', phase: Callable[[str], None] = None):
+    '''Loads an LLM model and its tokenizer from the HF local cache, in phases (see the top of this file). Always loads to the GPU.
+    If quantization settings are given, each linear layer is quantized as its weights are copied to the GPU (4-bit only).
+    If a phase function is given, it is called with '<phase>_START' and '<phase>_END' around each phase, and for quantized
+    models with 'LOAD_QUANTIZE_TIME:<seconds>' (the part of LOAD_TRANSFER spent quantizing) before LOAD_TRANSFER_END.'''
+    if phase is None:
+        phase = lambda x: None
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    if bnb_conf is not None and (not bnb_conf.load_in_4bit or device.type != 'cuda'):
+        raise RuntimeError('Only 4-bit quantization on the GPU is supported when loading in phases!')
+    # the same default types as from_pretrained()
+    dtype = torch.float16 if bnb_conf is not None else torch.float32
+    print(f"Loading model in phases ({mode}): {model_name}")
+
+    phase('LOAD_CONFIG_START')
+    folder, shards = snapshot_weights(model_name)
+    config = AutoConfig.from_pretrained(folder)
+    with init_empty_weights():
+        model = AutoModelForCausalLM.from_config(config, torch_dtype=dtype)
+    phase('LOAD_CONFIG_END')
+
+    phase('LOAD_WEIGHTS_START')
+    weights = dict()
+    for shard in shards:
+        weights.update(open_safetensors(shard, mode))
+    phase('LOAD_WEIGHTS_END')
+
+    phase('LOAD_TRANSFER_START')
+    expected = set(model.state_dict().keys())
+    quantized = _quantized_linear_names(model) if bnb_conf is not None else set()
+    prefix = model.base_model_prefix + '.'
+    unexpected = 0
+    quantize_time = 0.0
+    for name, tensor in weights.items():
+        # checkpoints of base models don't have the prefix of the model's submodule
+        if name not in expected and prefix + name in expected:
+            name = prefix + name
+        if name not in expected:
+            unexpected += 1
+            continue
+        module_name, _, tensor_name = name.rpartition('.')
+        if module_name in quantized and tensor_name == 'weight':
+            quantize_time += _quantize_linear(model, module_name, tensor.to(dtype), bnb_conf, device)
+        else:
+            set_module_tensor_to_device(model, name, device, value=tensor, dtype=dtype if tensor.is_floating_point() else None)
+        expected.discard(name)
+    del weights
+    model.tie_weights()
+    state = model.state_dict()
+    missing = [x for x in expected if state[x].is_meta]
+    if len(missing) > 0:
+        raise RuntimeError(f'Weights missing from the checkpoint of {model_name}: {", ".join(missing)}')
+    if unexpected > 0:
+        print(f"Skipped {unexpected} unused tensors in the checkpoint")
+    # buffers (i.e. rotary embeddings) are made on the CPU when the model is built
+    for name, buffer in list(model.named_buffers()):
+        if buffer.device != device:
+            set_module_tensor_to_device(model, name, device)
+    if bnb_conf is not None:
+        model.config.quantization_config = bnb_conf
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    if bnb_conf is not None:
+        phase(f'LOAD_QUANTIZE_TIME:{quantize_time}')
+    phase('LOAD_TRANSFER_END')
+    model.eval()
+
+    phase('LOAD_TOKENIZER_START')
+    tokenizer = load_tokenizer(model_name, folder)
+    phase('LOAD_TOKENIZER_END')
+    return model, tokenizer
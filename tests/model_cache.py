@@ -0,0 +1,257 @@
+# Disk budget management for the HF local cache.
+#
+# Rather than erasing every cached model before each test run, the cache is kept between runs and
+# only trimmed when it grows past a disk budget. The size and last use of every model snapshot in
+# the cache are tracked, and the least recently used snapshots are evicted first. Snapshots of the
+# models being tested (i.e. the ones in models.txt) are never evicted.
+#
+# Last use times are kept in a small JSON file in the cache folder, and are updated whenever a model
+# is downloaded or loaded (see touch()). Snapshots with no recorded use fall back to the modification
+# time of their folder. Blobs shared by several snapshots of a model are only removed once no
+# remaining snapshot links to them. Pre-quantized copies of a snapshot (see quantized_folder()) are
+# kept in the model's folder too, so they count towards the budget and are evicted along with it.
+# Use 'model_cache.py --help' for a summary of usage options.
+
+import json
+import os
+import shutil
+from time import time
+
+from prefetch import CACHE_DIR, INCOMPLETE_SUFFIX, repo_folder
+
+USAGE_FILENAME = '.model_cache.json'
+'''Name of the file in the cache folder holding the last use time of each snapshot'''
+QUANTIZED_FOLDER = 'quantized'
+'''Name of the folder in each model's cache folder holding pre-quantized copies of its snapshots'''
+
+
+class CachedSnapshot:
+    '''Simple "struct" for a snapshot of a model in the HF cache.'''
+    repo_id: str
+    '''Name of the model (i.e. EleutherAI/pythia-70m-deduped)'''
+    commit: str
+    '''Commit hash of the snapshot'''
+    size: int
+    '''Total size of the blobs linked from the snapshot (in bytes), including blobs shared with other snapshots,
+    and any pre-quantized copies of it'''
+    last_used: float
+    '''Time the snapshot was last downloaded or loaded (seconds since the epoch)'''
+    blobs: set[str]
+    '''Paths of the blobs linked from the snapshot'''
+
+    def __init__(self, repo_id: str, commit: str, size: int, last_used: float, blobs: set[str]):
+        self.repo_id = repo_id
+        self.commit = commit
+        self.size = size
+        self.last_used = last_used
+        self.blobs = blobs
+
+
+def parse_size(spec: str, cache_dir: str = CACHE_DIR) -> int:
+    '''Returns the size (in bytes) described by a spec: a number of bytes with an optional K/M/G/T suffix
+    (i.e. 20G), or a percentage of the size of the disk that the cache is on (i.e. 50%).'''
+    spec = spec.strip().upper()
+    if spec.endswith('%'):
+        path = cache_dir
+        while not os.path.exists(path):
+            path = os.path.dirname(path)
+        return int(shutil.disk_usage(path).total * float(spec[:-1]) / 100)
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+    if spec[-1:] in units:
+        return int(float(spec[:-1]) * units[spec[-1]])
+    return int(spec)
+
+def quantized_folder(repo_id: str, commit: str, key: str, cache_dir: str = CACHE_DIR) -> str:
+    '''Returns the folder of a pre-quantized copy of a model snapshot, identified by a key of the quantization settings.'''
+    return os.path.join(repo_folder(repo_id, cache_dir), QUANTIZED_FOLDER, f'{commit}-{key}')
+
+def _folder_size(folder: str) -> int:
+    total = 0
+    for p, _, fs in os.walk(folder):
+        for f in fs:
+            path = os.path.join(p, f)
+            if not os.path.islink(path):
+                total += os.path.getsize(path)
+    return total
+
+def format_size(size: int) -> str:
+    '''Returns a size in bytes as a human-readable string.'''
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if size < 1024:
+            return f'{size:.1f} {unit}'
+        size /= 1024
+    return f'{size:.1f} TB'
+
+
+class ModelCache:
+    '''Tracks the model snapshots in the HF cache, and evicts the least recently used ones to stay within a disk budget.'''
+    cache_dir: str
+    '''HF cache folder'''
+
+    def __init__(self, cache_dir: str = CACHE_DIR):
+        self.cache_dir = cache_dir
+
+    def _usage_path(self) -> str:
+        return os.path.join(self.cache_dir, USAGE_FILENAME)
+
+    def _load_usage(self) -> dict[str, float]:
+        try:
+            with open(self._usage_path(), 'r') as fp:
+                return json.load(fp)
+        except (OSError, ValueError):
+            return dict()
+
+    def _save_usage(self, usage: dict[str, float]):
+        # written atomically, since the test process may touch a model while the runner reads the file
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_path = self._usage_path() + '.tmp'
+        with open(tmp_path, 'w') as fp:
+            json.dump(usage, fp, indent=1)
+        os.replace(tmp_path, self._usage_path())
+
+    def current_commit(self, repo_id: str, revision: str = 'main') -> str:
+        '''Returns the commit hash that a revision of a cached model points to, or an empty string if it isn't cached.'''
+        try:
+            with open(os.path.join(repo_folder(repo_id, self.cache_dir), 'refs', revision), 'r') as fp:
+                return fp.read().strip()
+        except OSError:
+            return ''
+
+    def touch(self, repo_id: str, revision: str = 'main'):
+        '''Records that the current snapshot of a model was just used.'''
+        commit = self.current_commit(repo_id, revision)
+        if len(commit) == 0:
+            return
+        usage = self._load_usage()
+        usage[f'{repo_id}@{commit}'] = time()
+        self._save_usage(usage)
+
+    def snapshots(self) -> list[CachedSnapshot]:
+        '''Returns every model snapshot in the cache, least recently used first.'''
+        if not os.path.isdir(self.cache_dir):
+            return list()
+        usage = self._load_usage()
+        snapshots = list()
+        for d in os.listdir(self.cache_dir):
+            if not d.startswith('models--'):
+                continue
+            repo_id = d[8:].replace('--', '/')
+            snapshots_dir = os.path.join(self.cache_dir, d, 'snapshots')
+            if not os.path.isdir(snapshots_dir):
+                continue
+            for commit in os.listdir(snapshots_dir):
+                snapshot_dir = os.path.join(snapshots_dir, commit)
+                blobs = set()
+                for p, _, fs in os.walk(snapshot_dir):
+                    for f in fs:
+                        path = os.path.realpath(os.path.join(p, f))
+                        if os.path.exists(path):
+                            blobs.add(path)
+                size = sum([os.path.getsize(x) for x in blobs])
+                size += sum([_folder_size(x) for x in self._quantized(repo_id, commit)])
+                last_used = usage.get(f'{repo_id}@{commit}', os.path.getmtime(snapshot_dir))
+                snapshots.append(CachedSnapshot(repo_id, commit, size, last_used, blobs))
+        snapshots.sort(key=lambda x: x.last_used)
+        return snapshots
+
+    def _quantized(self, repo_id: str, commit: str) -> list[str]:
+        folder = os.path.join(repo_folder(repo_id, self.cache_dir), QUANTIZED_FOLDER)
+        if not os.path.isdir(folder):
+            return list()
+        return [os.path.join(folder, x) for x in os.listdir(folder) if x.startswith(commit + '-')]
+
+    def total_size(self) -> int:
+        '''Returns the disk space used by every model in the cache (in bytes), including partial downloads.'''
+        if not os.path.isdir(self.cache_dir):
+            return 0
+        return sum([_folder_size(os.path.join(self.cache_dir, d)) for d in os.listdir(self.cache_dir) if d.startswith('models--')])
+
+    def evict(self, snapshot: CachedSnapshot):
+        '''Removes a snapshot from the cache, along with any blobs that no other snapshot of its model links to.
+        The model is removed completely once it has no snapshots left.'''
+        folder = repo_folder(snapshot.repo_id, self.cache_dir)
+        shutil.rmtree(os.path.join(folder, 'snapshots', snapshot.commit), True)
+        for quantized in self._quantized(snapshot.repo_id, snapshot.commit):
+            shutil.rmtree(quantized, True)
+        remaining = [x for x in self.snapshots() if x.repo_id == snapshot.repo_id]
+        if len(remaining) == 0:
+            shutil.rmtree(folder, True)
+        else:
+            still_used = set().union(*[x.blobs for x in remaining])
+            for blob in snapshot.blobs:
+                if blob not in still_used and os.path.exists(blob):
+                    os.remove(blob)
+            # refs to the removed snapshot would point from_pretrained() at a missing folder
+            refs_dir = os.path.join(folder, 'refs')
+            for ref in os.listdir(refs_dir) if os.path.isdir(refs_dir) else list():
+                if self.current_commit(snapshot.repo_id, ref) == snapshot.commit:
+                    os.remove(os.path.join(refs_dir, ref))
+        usage = self._load_usage()
+        usage.pop(f'{snapshot.repo_id}@{snapshot.commit}', None)
+        self._save_usage(usage)
+
+    def enforce_budget(self, budget: int, keep: list[str] = list()) -> list[CachedSnapshot]:
+        '''Evicts the least recently used snapshots until the cache fits within the budget (in bytes).
+        The current snapshots of the models in keep (and any of their partial downloads) are never evicted,
+        even if the cache can't fit within the budget without them. Returns the evicted snapshots.'''
+        protected = {f'{x}@{self.current_commit(x)}' for x in keep}
+        evicted = list()
+        total = self.total_size()
+        for snapshot in self.snapshots():
+            if total <= budget:
+                break
+            if f'{snapshot.repo_id}@{snapshot.commit}' in protected or (snapshot.repo_id in keep and len(self.current_commit(snapshot.repo_id)) == 0):
+                continue
+            print(f'Evicting {snapshot.repo_id} ({snapshot.commit[:8]}, {format_size(snapshot.size)})')
+            self.evict(snapshot)
+            evicted.append(snapshot)
+            total = self.total_size()
+        if total > budget:
+            print(f'Model cache is over budget ({format_size(total)} of {format_size(budget)}) with only the models in use left')
+        return evicted
+
+    def clear_incomplete(self, keep: list[str] = list()):
+        '''Removes partial downloads of models that aren't in keep.'''
+        for d in os.listdir(self.cache_dir) if os.path.isdir(self.cache_dir) else list():
+            if not d.startswith('models--') or d[8:].replace('--', '/') in keep:
+                continue
+            blobs_dir = os.path.join(self.cache_dir, d, 'blobs')
+            for f in os.listdir(blobs_dir) if os.path.isdir(blobs_dir) else list():
+                if f.endswith(INCOMPLETE_SUFFIX):
+                    os.remove(os.path.join(blobs_dir, f))
+
+
+if __name__ == '__main__':
+    import sys
+    from datetime import datetime
+
+    cache_dir = CACHE_DIR
+    budget_spec = ''
+    keep_filepath = ''
+    for arg in sys.argv[1:]:
+        tmp = arg.split('=', 1)
+        match tmp[0]:
+            case '--cache-dir':
+                cache_dir = tmp[1]
+            case '--budget':
+                budget_spec = tmp[1]
+            case '--keep':
+                keep_filepath = tmp[1]
+            case _:
+                print('Usage: model_cache.py [--cache-dir=<HF cache>] [--budget=<size>|<percent of disk>] [--keep=<models file>]')
+                print('  Lists the cached model snapshots, and evicts the least recently used ones if a budget is given')
+                exit(0 if tmp[0] == '--help' else 1)
+
+    keep = list()
+    if len(keep_filepath) > 0:
+        with open(keep_filepath, 'r') as keep_file:
+            keep = [x.strip() for x in keep_file.readlines() if len(x.strip()) > 0]
+    cache = ModelCache(cache_dir)
+    if len(budget_spec) > 0:
+        cache.clear_incomplete(keep)
+        cache.enforce_budget(parse_size(budget_spec, cache_dir), keep)
+    print('Last used           | Size      | Model')
+    for snapshot in reversed(cache.snapshots()):
+        used = datetime.fromtimestamp(snapshot.last_used).strftime('%Y-%m-%d %H:%M:%S')
+        print(f'{used} | {format_size(snapshot.size):>9} | {snapshot.repo_id} ({snapshot.commit[:8]}){" (kept)" if snapshot.repo_id in keep else ""}')
+    print(f'Total: {format_size(cache.total_size())}')
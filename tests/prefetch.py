@@ -0,0 +1,391 @@
+# Parallel, resumable prefetching of model files into the HF local cache.
+#
+# Instead of loading each model to download it, the files of every model are listed up front and
+# fetched concurrently with a pool of worker threads, straight into the HF Hub cache layout
+# (models--<org>--<name>/blobs, snapshots and refs), so from_pretrained() finds them as if they were
+# downloaded by huggingface_hub. Only the files that are needed to load a model are fetched: its
+# configuration and tokenizer files, and its weights in a single format (safetensors if available).
+#
+# Files are downloaded to "<blob>.incomplete" and resumed from where they stopped if interrupted.
+# Every file is checked against the size and checksum listed by the source (the SHA-256 of LFS files
+# and the git blob SHA-1 of others) before it is moved into place. Files can be fetched from:
+#
+#   HubSource    - the HF Hub, or any server with the same API (i.e. a mirror or mirror_server.py)
+#   MirrorSource - a local folder holding each repo's files under <root>/<org>/<name>/
+#
+# Use 'prefetch.py --help' for a summary of usage options.
+
+import importlib.util
+hf_hub_exists = importlib.util.find_spec('huggingface_hub') is not None
+if hf_hub_exists:
+    from huggingface_hub import get_token
+
+import hashlib
+import json
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from fnmatch import fnmatch
+from http.client import HTTPException
+from typing import BinaryIO, Callable
+from urllib.error import HTTPError
+from urllib.parse import quote
+from urllib.request import Request, urlopen
+
+CACHE_DIR = os.path.expanduser('~/.cache/huggingface/hub/')
+'''Cache directory for HF Hub'''
+DEFAULT_ENDPOINT = os.environ.get('HF_ENDPOINT', 'https://huggingface.co')
+'''Endpoint of the HF Hub (can be set with the HF_ENDPOINT environment variable)'''
+INCOMPLETE_SUFFIX = '.incomplete'
+'''Suffix of partially downloaded blobs (the same as huggingface_hub, so either can resume the other's downloads)'''
+CHUNK_SIZE = 1024 * 1024
+'''Size of the chunks that files are downloaded in (in bytes)'''
+
+WEIGHT_FORMATS = {
+    'safetensors': ['*.safetensors', '*.safetensors.index.json'],
+    'pytorch': ['*.bin', '*.bin.index.json']
+}
+'''Filename patterns of the weight files of each supported format'''
+OTHER_WEIGHT_PATTERNS = ['*.pt', '*.pth', '*.ckpt', '*.h5', '*.msgpack', '*.ot', '*.onnx', '*.onnx_data', '*.gguf', '*.tflite']
+'''Filename patterns of weights in formats that are never loaded'''
+SUPPORT_PATTERNS = ['*.json', '*.txt', '*.model', '*.tiktoken']
+'''Filename patterns of the configuration and tokenizer files needed to load a model'''
+
+
+class RemoteFile:
+    '''Simple "struct" for a file listed by a source.'''
+    name: str
+    '''Path of the file in the repo'''
+    size: int
+    '''Size of the file (in bytes)'''
+    blob_id: str
+    '''Checksum of the file, also used as its blob name in the cache'''
+    lfs: bool
+    '''True if blob_id is the SHA-256 of the file, otherwise it is the git blob SHA-1 (as for small files on the Hub)'''
+
+    def __init__(self, name: str, size: int, blob_id: str, lfs: bool):
+        self.name = name
+        self.size = size
+        self.blob_id = blob_id
+        self.lfs = lfs
+
+class Source:
+    '''Base class for places that model files can be fetched from.'''
+    name: str = 'none'
+    '''Name of the source'''
+
+    def list_files(self, repo_id: str, revision: str, select: Callable[[list[RemoteFile]], list[RemoteFile]] = None) -> tuple[str, list[RemoteFile]]:
+        '''Returns the commit hash of the given revision of a repo, and every file in it.
+        If a select function is given (see select_files()), only the files it returns are listed.'''
+        raise NotImplementedError()
+
+    def open(self, repo_id: str, commit: str, file: RemoteFile, offset: int) -> tuple[BinaryIO, int]:
+        '''Opens a file for reading, starting from the given offset if the source supports it.
+        Returns the file object and the offset it actually starts from (0 if the source can't resume).'''
+        raise NotImplementedError()
+
+class HubSource(Source):
+    '''Fetches files from the HF Hub, or any server implementing the same API:
+      GET <endpoint>/api/models/<repo>/revision/<revision>?blobs=true - repo info (commit hash and files)
+      GET <endpoint>/<repo>/resolve/<commit>/<file>                 - file contents (with Range support)'''
+    name = 'hub'
+    endpoint: str
+    '''URL of the Hub'''
+
+    def __init__(self, endpoint: str = DEFAULT_ENDPOINT, token: str = None, timeout: float = 30.0):
+        self.endpoint = endpoint.rstrip('/')
+        self._timeout = timeout
+        # uses the token from login_by_token() if none is given
+        self._token = token if token is not None or not hf_hub_exists else get_token()
+
+    def _request(self, url: str, headers: dict = None):
+        req = Request(url, headers=headers or dict())
+        if self._token is not None:
+            req.add_header('Authorization', f'Bearer {self._token}')
+        return urlopen(req, timeout=self._timeout)
+
+    def list_files(self, repo_id: str, revision: str, select: Callable[[list[RemoteFile]], list[RemoteFile]] = None) -> tuple[str, list[RemoteFile]]:
+        with self._request(f'{self.endpoint}/api/models/{repo_id}/revision/{quote(revision, safe="")}?blobs=true') as resp:
+            info = json.load(resp)
+        files = list()
+        for sibling in info['siblings']:
+            if 'lfs' in sibling:
+                files.append(RemoteFile(sibling['rfilename'], sibling['lfs']['size'], sibling['lfs']['sha256'], True))
+            else:
+                files.append(RemoteFile(sibling['rfilename'], sibling['size'], sibling['blobId'], False))
+        return info['sha'], select(files) if select is not None else files
+
+    def open(self, repo_id: str, commit: str, file: RemoteFile, offset: int) -> tuple[BinaryIO, int]:
+        headers = {'Range': f'bytes={offset}-'} if offset > 0 else dict()
+        try:
+            resp = self._request(f'{self.endpoint}/{repo_id}/resolve/{commit}/{quote(file.name)}', headers)
+        except HTTPError as e:
+            if e.code != 416:
+                raise
+            # the partial file is invalid (i.e. longer than the file), start over
+            return self._request(f'{self.endpoint}/{repo_id}/resolve/{commit}/{quote(file.name)}'), 0
+        # servers that don't support ranges send the whole file
+        return resp, offset if resp.status == 206 else 0
+
+class MirrorSource(Source):
+    '''Fetches files from a local folder (i.e. a network share or a copy of the Hub), with the files of each
+    repo under <root>/<org>/<name>/. Mirrors have no commit hashes or checksums, so the commit hash is made from
+    the names and sizes of every file, and the listed files are hashed (after selecting them, so unused weights aren't read).'''
+    name = 'mirror'
+    root: str
+    '''Folder holding the mirrored repos'''
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def list_files(self, repo_id: str, revision: str, select: Callable[[list[RemoteFile]], list[RemoteFile]] = None) -> tuple[str, list[RemoteFile]]:
+        repo_dir = os.path.join(self.root, repo_id)
+        if not os.path.isdir(repo_dir):
+            raise FileNotFoundError(f'Repo {repo_id} not found in mirror {self.root}')
+        files = list()
+        for p, ds, fs in os.walk(repo_dir):
+            ds[:] = [d for d in ds if not d.startswith('.')]
+            for f in fs:
+                path = os.path.join(p, f)
+                files.append(RemoteFile(os.path.relpath(path, repo_dir).replace(os.sep, '/'), os.path.getsize(path), '', True))
+        files.sort(key=lambda x: x.name)
+        commit = hashlib.sha1(''.join([f'{x.name}:{x.size}\n' for x in files]).encode()).hexdigest()
+        if select is not None:
+            files = select(files)
+        for file in files:
+            file.blob_id = _sha256(os.path.join(repo_dir, file.name))
+        return commit, files
+
+    def open(self, repo_id: str, commit: str, file: RemoteFile, offset: int) -> tuple[BinaryIO, int]:
+        fp = open(os.path.join(self.root, repo_id, file.name), 'rb')
+        fp.seek(offset)
+        return fp, offset
+
+
+def select_files(files: list[RemoteFile], formats: list[str] = ['safetensors', 'pytorch']) -> list[RemoteFile]:
+    '''Returns only the files needed to load a model: its configuration and tokenizer files, and its weights
+    in the first of the given formats (see WEIGHT_FORMATS) that the repo has.'''
+    def matches(name: str, patterns: list[str]) -> bool:
+        base = name.rsplit('/', 1)[-1]
+        return any([fnmatch(base, x) for x in patterns])
+
+    weight_patterns = [x for patterns in WEIGHT_FORMATS.values() for x in patterns] + OTHER_WEIGHT_PATTERNS
+    selected = [x for x in files if matches(x.name, SUPPORT_PATTERNS) and not matches(x.name, weight_patterns)]
+    for fmt in formats:
+        weights = [x for x in files if matches(x.name, WEIGHT_FORMATS[fmt])]
+        if any([not x.name.endswith('.index.json') for x in weights]):
+            return selected + weights
+    return selected
+
+def get_source(spec: str) -> Source:
+    '''Returns the source described by a command-line spec: a URL of a Hub (or mirror server), or a mirror folder.
+    An empty spec is the HF Hub.'''
+    if len(spec) == 0:
+        return HubSource()
+    if re.match(r'^https?://', spec):
+        return HubSource(spec)
+    if os.path.isdir(spec):
+        return MirrorSource(spec)
+    raise ValueError(f'Unknown download source: {spec} (expected a URL or a folder)')
+
+
+def repo_folder(repo_id: str, cache_dir: str = CACHE_DIR) -> str:
+    '''Returns the folder of a model repo in the HF cache.'''
+    return os.path.join(cache_dir, 'models--' + repo_id.replace('/', '--'))
+
+def _sha256(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, 'rb') as fp:
+        while chunk := fp.read(CHUNK_SIZE):
+            h.update(chunk)
+    return h.hexdigest()
+
+def _new_hash(file: RemoteFile):
+    if file.lfs:
+        return hashlib.sha256()
+    # git blob hash, for files that aren't stored with LFS
+    h = hashlib.sha1()
+    h.update(f'blob {file.size}\0'.encode())
+    return h
+
+def _hash_prefix(h, path: str):
+    with open(path, 'rb') as fp:
+        while chunk := fp.read(CHUNK_SIZE):
+            h.update(chunk)
+
+def _link(src: str, dst: str):
+    # snapshot files are relative links to blobs (like huggingface_hub), so the cache can be moved
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    rel = os.path.relpath(src, os.path.dirname(dst))
+    if os.path.islink(dst) and os.readlink(dst) == rel:
+        return
+    tmp = dst + INCOMPLETE_SUFFIX
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+    os.symlink(rel, tmp)
+    os.replace(tmp, dst)
+
+
+class Prefetcher:
+    '''Downloads the files of several models concurrently into the HF cache.'''
+    source: Source
+    '''Where files are fetched from'''
+    cache_dir: str
+    '''HF cache folder that files are saved to'''
+    workers: int
+    '''Number of files downloaded at once'''
+    formats: list[str]
+    '''Weight formats to download, in order of preference (see select_files())'''
+    retries: int
+    '''Number of times to retry a file that fails to download or verify'''
+
+    def __init__(self, source: Source = None, cache_dir: str = CACHE_DIR, workers: int = 4,
+                 formats: list[str] = ['safetensors', 'pytorch'], retries: int = 2):
+        self.source = source if source is not None else HubSource()
+        self.cache_dir = cache_dir
+        self.workers = max(workers, 1)
+        self.formats = formats
+        self.retries = retries
+        self._print_lock = threading.Lock()
+        self._blob_locks: dict[str, threading.Lock] = dict()
+
+    def _print(self, text: str):
+        with self._print_lock:
+            print(text)
+
+    def _fetch_blob(self, repo_id: str, commit: str, file: RemoteFile, blob_path: str) -> int:
+        '''Downloads a file to its blob (resuming a partial download), and verifies it. Returns the bytes downloaded.'''
+        tmp_path = blob_path + INCOMPLETE_SUFFIX
+        offset = os.path.getsize(tmp_path) if os.path.exists(tmp_path) else 0
+        if offset > file.size:
+            offset = 0
+        stream, offset = self.source.open(repo_id, commit, file, offset)
+        h = _new_hash(file)
+        with stream, open(tmp_path, 'r+b' if offset > 0 else 'wb') as fp:
+            if offset > 0:
+                _hash_prefix(h, tmp_path)
+                fp.seek(offset)
+                fp.truncate()
+            size = offset
+            while chunk := stream.read(CHUNK_SIZE):
+                fp.write(chunk)
+                h.update(chunk)
+                size += len(chunk)
+            fp.flush()
+            os.fsync(fp.fileno())
+        if size < file.size:
+            # the partial file is kept, so the next attempt resumes from here
+            raise RuntimeError(f'Download of {repo_id}/{file.name} ended early ({size} of {file.size} bytes)')
+        if size != file.size or h.hexdigest() != file.blob_id:
+            # a corrupt partial file would never verify, so it is removed to start over
+            os.remove(tmp_path)
+            raise RuntimeError(f'Integrity check failed for {repo_id}/{file.name}: '
+                               f'expected {file.size} bytes ({file.blob_id}), got {size} bytes ({h.hexdigest()})')
+        os.replace(tmp_path, blob_path)
+        return size - offset
+
+    def _fetch_file(self, repo_id: str, commit: str, file: RemoteFile) -> int:
+        '''Makes sure a file is in the cache, downloading it if needed. Returns the bytes downloaded.'''
+        folder = repo_folder(repo_id, self.cache_dir)
+        blob_path = os.path.join(folder, 'blobs', file.blob_id)
+        downloaded = 0
+        with self._print_lock:
+            # files with the same contents share a blob, so only one of them downloads it
+            blob_lock = self._blob_locks.setdefault(blob_path, threading.Lock())
+        with blob_lock:
+            # blobs are only moved into place once verified, so an existing blob of the right size is complete
+            if not os.path.exists(blob_path) or os.path.getsize(blob_path) != file.size:
+                os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+                for attempt in range(self.retries + 1):
+                    try:
+                        downloaded = self._fetch_blob(repo_id, commit, file, blob_path)
+                        break
+                    except (OSError, HTTPException, RuntimeError) as e:
+                        if attempt == self.retries:
+                            raise
+                        self._print(f'Retrying {repo_id}/{file.name} ({e})')
+        _link(blob_path, os.path.join(folder, 'snapshots', commit, *file.name.split('/')))
+        return downloaded
+
+    def fetch(self, repo_ids: list[str], revision: str = 'main') -> dict[str, str]:
+        '''Downloads the given models, skipping files that are already cached.
+        Returns the snapshot folder of each model that was downloaded completely (failures are printed).'''
+        snapshots = dict()
+        with ThreadPoolExecutor(self.workers) as pool:
+            select = lambda files: select_files(files, self.formats)
+            listings = {pool.submit(self.source.list_files, x, revision, select): x for x in repo_ids}
+            tasks = dict()
+            pending: dict[str, int] = dict()
+            commits: dict[str, str] = dict()
+            for future in as_completed(listings):
+                repo_id = listings[future]
+                try:
+                    commit, files = future.result()
+                except Exception as e:
+                    self._print(f'Failed to list files of {repo_id}: {e}')
+                    continue
+                self._print(f'Prefetching {repo_id} ({len(files)} files, {sum([x.size for x in files]) / 1e6:.1f} MB)')
+                commits[repo_id] = commit
+                pending[repo_id] = len(files)
+                for file in files:
+                    tasks[pool.submit(self._fetch_file, repo_id, commit, file)] = (repo_id, file)
+
+            failed = set()
+            for future in as_completed(tasks):
+                repo_id, file = tasks[future]
+                try:
+                    downloaded = future.result()
+                except Exception as e:
+                    self._print(f'Failed to download {repo_id}/{file.name}: {e}')
+                    failed.add(repo_id)
+                    continue
+                if downloaded > 0:
+                    self._print(f'Downloaded {repo_id}/{file.name} ({downloaded / 1e6:.1f} MB)')
+                pending[repo_id] -= 1
+                if pending[repo_id] == 0 and repo_id not in failed:
+                    snapshots[repo_id] = self._finish(repo_id, revision, commits[repo_id])
+        return snapshots
+
+    def _finish(self, repo_id: str, revision: str, commit: str) -> str:
+        # the ref is only updated once every file is in the snapshot, so from_pretrained() never sees a partial model
+        folder = repo_folder(repo_id, self.cache_dir)
+        if revision != commit:
+            os.makedirs(os.path.join(folder, 'refs'), exist_ok=True)
+            with open(os.path.join(folder, 'refs', revision), 'w') as fp:
+                fp.write(commit)
+        self._print(f'Prefetched {repo_id}')
+        return os.path.join(folder, 'snapshots', commit)
+
+def prefetch(repo_ids: list[str], source: Source = None, cache_dir: str = CACHE_DIR, workers: int = 4, revision: str = 'main') -> dict[str, str]:
+    '''Downloads the given models into the HF cache (see Prefetcher.fetch()).'''
+    return Prefetcher(source, cache_dir, workers).fetch(repo_ids, revision)
+
+
+if __name__ == '__main__':
+    import sys
+
+    models_filepath = './models.txt'
+    source_spec = ''
+    cache_dir = CACHE_DIR
+    workers = 4
+    for arg in sys.argv[1:]:
+        tmp = arg.split('=', 1)
+        match tmp[0]:
+            case '--modelsfile':
+                models_filepath = tmp[1]
+            case '--source':
+                source_spec = tmp[1]
+            case '--cache-dir':
+                cache_dir = tmp[1]
+            case '--workers':
+                workers = int(tmp[1])
+            case _:
+                print('Usage: prefetch.py [--modelsfile=./models.txt] [--source=<Hub URL>|<mirror folder>] [--cache-dir=<HF cache>] [--workers=4]')
+                exit(0 if tmp[0] == '--help' else 1)
+
+    with open(models_filepath, 'r') as models_file:
+        models = [x.strip() for x in models_file.readlines() if len(x.strip()) > 0]
+    done = prefetch(models, get_source(source_spec), cache_dir, workers)
+    print(f'Prefetched {len(done)} of {len(models)} models')
+    exit(0 if len(done) == len(models) else 1)
@@ -21,7 +21,7 @@ print('Searching...')
 log_paths = list()
 for p, _, fs in list(os.walk('./out')):
     for f in fs:
-        if f.startswith('log_') and f.endswith('json'):
+        if f.startswith('log_') and os.path.splitext(f)[1] in ['.json', '.npz', '.ndjson']:
             log_paths.append(os.path.join(p, f))
 
 print(f'Found {len(log_paths)} logs\nLoading details...')
@@ -31,7 +31,7 @@ existing = list()
 max_iterations = 0
 
 for path in log_paths:
-    data = os.path.basename(path)[4:-5].split('_')
+    data = os.path.splitext(os.path.basename(path))[0][4:].split('_')
     tags = list()
     tags.append(data.pop(-2)) # device
     tags.append(data.pop(-1)) # pm
@@ -17,26 +17,71 @@ iterations = 5
 output_dir = 'out'
 tags = list()
 opt_no_erase = False
+opt_erase = False
+cache_budget = '50%'
 opt_no_quant = False
+opt_no_quant_cache = False
+load_mode = 'hf'
 num_tokens_to_gen = 64
+batch_sizes = [1]
+opt_warm = False
 is_dry = False
+log_format = 'json'
+sampler_spec = ''
+idle_time = 15.0
+buffer_time = 3.0
+opt_adaptive_idle = False
+idle_threshold = 0.05
+opt_shared_idle = False
+download_source = ''
+download_workers = 4
 
 # function for printing the usage text
 def print_usage_help():
     print("Usage: run_tests.py [--OPTION[=...]]...\n")
+    print("  --cache-budget=... Sets the disk budget of the model cache, as a size (i.e. 20G) or a percentage of the disk")
+    print("                     (Default: 50%). Least recently used models are evicted when it is exceeded")
+    print("  --dl-workers=...   Sets the number of model files downloaded at once (Default: 4)")
     print("  --dry              Don't run tests, just show test configuration")
+    print("  --format=...       Sets the log file format, either 'json', 'npz' or 'ndjson' (Default: json)")
+    print("                     ndjson logs are streamed to disk during the test instead of kept in memory")
+    print("  --adaptive-idle    Ends the idle period early once the power has reached a steady state")
+    print("  --batch-size=...   Sets the number of inputs to generate from at once, or a comma-separated list of")
+    print("                     batch sizes to test each model with (Default: 1)")
+    print("  --buffer-time=...  Sets the buffer time between test phases in seconds (Default: 3)")
     print("  --help             Shows this help")
+    print("  --idle-time=...    Sets the length of the idle period for the power baseline in seconds, or the")
+    print("                     longest it can be with --adaptive-idle (Default: 15)")
+    print("  --idle-threshold=. Sets the standard deviation of power (in W) over the last 3 seconds below which the")
+    print("                     power is considered steady with --adaptive-idle (Default: 0.05)")
+    print("  --load-mode=...    Sets how models are loaded, either 'hf' (from_pretrained), or 'mmap' or 'read' to load them")
+    print("                     in phases from memory-mapped or read safetensors files, with a timestamp for each phase")
+    print("                     (Default: hf)")
+    print("  --mirror=...       Downloads models from the given mirror instead of the HF Hub, either the URL of a server")
+    print("                     with the same API (i.e. mirror_server.py) or a folder with the files of each model")
     print("  --modelsfile=...   Uses the given file to look for LLM model names (Default: ./models.txt)")
     print("  --inputfile=...    Uses the given file as input for text generation (Default: ./input.txt)")
     print("  --iterations=...   Sets the number of iterationsto repeat individual tests (Default: 5)")
-    print("  --no-erase         Prevents the script from erasing previously cached models")
+    print("  --erase            Erases every previously cached model before downloading, instead of only evicting")
+    print("                     least recently used models when the cache is over budget")
+    print("  --no-erase         Prevents the script from erasing or evicting any previously cached models")
     print("  --no-quant         Forces the models to be loaded without quantization")
+    print("  --no-quant-cache   Quantizes the models while loading them in every test, instead of quantizing them")
+    print("                     once before testing and loading the pre-quantized models")
     print("  --outputdir=...    Outputs log files to the given directory (Default: ./out)")
+    print("  --sampler=...      Sets the telemetry backend, either 'jtop', 'sysfs[:<root>]' or 'replay:<log path>'")
+    print("                     (Default: jtop if installed, otherwise sysfs)")
+    print("  --shared-idle      Only measures the idle baseline in the first iteration of each model, and shares it")
+    print("                     with the rest of the iterations")
     print("  --tag=...          Adds the given tag to the generated log files, can be called multiple times")
     print("  --tokens=...       Sets the number of tokens to generate (Default: 64)")
+    print("  --warm             Loads each model once in a worker process, sending it one generation request per iteration,")
+    print("                     saving a single log of all iterations per model")
     print("\nExamples:")
     print("  run_tests.py --iterations=3 --tag=fewer-iterations --tag=hello")
-    print("  run_tests.py --no-erase --outputdir=./logs\n")
+    print("  run_tests.py --no-erase --outputdir=./logs")
+    print("  run_tests.py --batch-size=1,2,4,8 --tag=batch-sweep")
+    print("  run_tests.py --adaptive-idle --idle-time=30 --shared-idle --buffer-time=1\n")
 
 # process command-line arguments
 for arg in sys.argv[1:]:
@@ -47,13 +92,23 @@ for arg in sys.argv[1:]:
         case "--help":
             print_usage_help()
             exit(0)
+        case "--erase":
+            opt_erase = True
         case "--no-erase":
             opt_no_erase = True
         case "--no-quant":
             opt_no_quant = True
+        case "--no-quant-cache":
+            opt_no_quant_cache = True
+        case "--warm":
+            opt_warm = True
+        case "--adaptive-idle":
+            opt_adaptive_idle = True
+        case "--shared-idle":
+            opt_shared_idle = True
         case _:
             # key-value args
-            tmp = arg.split('=')
+            tmp = arg.split('=', 1)
             if len(tmp) != 2:
                 print(f'Unknown option: {arg}\n')
                 print_usage_help()
@@ -61,8 +116,35 @@ for arg in sys.argv[1:]:
             opt_var = tmp[0]
             opt_data = tmp[1]
             match opt_var:
+                case "--batch-size":
+                    batch_sizes = [int(x) for x in opt_data.split(',')]
+                    if min(batch_sizes) < 1:
+                        print('Batch sizes must be at least 1!')
+                        exit(1)
+                case "--cache-budget":
+                    cache_budget = opt_data
+                case "--load-mode":
+                    if opt_data not in ['hf', 'mmap', 'read']:
+                        print(f'Unknown load mode: {opt_data}')
+                        exit(1)
+                    load_mode = opt_data
+                case "--mirror":
+                    download_source = opt_data
+                case "--dl-workers":
+                    download_workers = int(opt_data)
+                case "--buffer-time":
+                    buffer_time = float(opt_data)
+                case "--idle-time":
+                    idle_time = float(opt_data)
+                case "--idle-threshold":
+                    idle_threshold = float(opt_data)
                 case "--modelsfile":
                     models_filepath = os.path.abspath(opt_data)
+                case "--format":
+                    if opt_data not in ['json', 'npz', 'ndjson']:
+                        print(f'Unknown log format: {opt_data}')
+                        exit(1)
+                    log_format = opt_data
                 case "--inputfile":
                     input_filepath = os.path.abspath(opt_data)
                 case "--iterations":
@@ -72,6 +154,8 @@ for arg in sys.argv[1:]:
                     iterations = int(opt_data)
                 case "--outputdir":
                     output_dir = os.path.abspath(opt_data)
+                case "--sampler":
+                    sampler_spec = opt_data
                 case "--tag":
                     tags.append(opt_data)
                 case "--tokens":
@@ -104,18 +188,30 @@ suffix = '_'.join(tags)
 if is_dry:
     print(f'Output directory: {os.path.abspath(output_dir)}')
     print(f'# of tokens to generate: {num_tokens_to_gen}')
+    print(f'Batch size(s): {", ".join([str(x) for x in batch_sizes])}')
     print(f'# of iterations: {iterations}')
-    print(f'Erase model cache? {"NO" if opt_no_erase else "YES"}')
-    print(f'4-bit quantize? {"NO" if opt_no_quant else "YES"}')
+    print(f'Model cache: {"keep all" if opt_no_erase else "erase all" if opt_erase else f"evict LRU over {cache_budget}"}')
+    print(f'4-bit quantize? {"NO" if opt_no_quant else "YES (on load)" if opt_no_quant_cache else "YES (pre-quantized)"}')
+    print(f'Load mode: {load_mode}')
+    print(f'Warm mode? {"YES" if opt_warm else "NO"}')
+    print(f'Idle time: {idle_time} s{f" (adaptive, threshold {idle_threshold} W)" if opt_adaptive_idle else ""}')
+    print(f'Shared idle baseline? {"YES" if opt_shared_idle else "NO"}')
+    print(f'Buffer time: {buffer_time} s')
+    print(f'Download source: {download_source if len(download_source) > 0 else "HF Hub"} ({download_workers} workers)')
     print(f'Models file: {os.path.abspath(models_filepath)}')
     print(f'Input file: {os.path.abspath(input_filepath)}')
+    print(f'Log format: {log_format}')
+    print(f'Sampler: {sampler_spec if len(sampler_spec) > 0 else "default"}')
     print(f'Suffix: {suffix}')
     exit(0)
 
 
 # post-argument-checking imports (to prevent time delay)
 import hf_models
-from statlog import Log
+from messages import receive_messages, receive_requests, send
+from prefetch import get_source
+from samplers import get_sampler
+from statlog import CHECKPOINT_SUFFIX, Log
 
 from datetime import datetime
 from multiprocessing import Pipe, Process
@@ -123,6 +219,9 @@ from multiprocessing.connection import Connection
 from pathlib import Path
 from time import sleep
 
+# set up the telemetry backend (before downloading, so a bad sampler fails early)
+sampler = get_sampler(sampler_spec) if len(sampler_spec) > 0 else None
+
 # set up datestring for subfolder
 date_str = datetime.now().strftime('%Y-%m-%d_%H%M%S')
 
@@ -131,95 +230,215 @@ hf_models.login_by_token()
 
 # ensure models are loaded in the cache
 # we do not want to benchmark network download times!
-if not opt_no_erase:
+if opt_erase:
     print("Erasing cached models...")
     hf_models.erase_cached_models()
+elif not opt_no_erase:
+    print("Trimming model cache...")
+    hf_models.trim_cached_models(cache_budget, models)
 print("Downloading models...")
-for m in models:
-    hf_models.download_model(m)
+failed = hf_models.download_models(models, get_source(download_source), download_workers)
+if len(failed) > 0:
+    print("Failed to download: " + ", ".join(failed))
 print("Download(s) complete")
+if not opt_no_quant and not opt_no_quant_cache:
+    # quantization is done once here, so the model load in each test doesn't include it
+    hf_models.quantize_models(models)
+if not opt_erase and not opt_no_erase:
+    # the models just downloaded (and quantized) may have put the cache over budget
+    hf_models.trim_cached_models(cache_budget, models)
 sleep(3)
 
 
 # The following function is used in a separate process to run the generation test.
 # Add/change any desired testing functionality in this function to ensure it is tested on each model!
-def _individual_test(model_name: str, in_data, conn: Connection, do_quantize: bool, tokens_to_gen: int):
+def _individual_test(model_name: str, in_data, conn: Connection, do_quantize: bool, quantized_path: str, load_mode: str,
+                     tokens_to_gen: int, batch_size: int, idle: float, adaptive_idle: bool, buffer: float):
     '''Test method content, performed on a separate process.'''
     # Change any content within TEST BEGIN and TEST END to change the testing behavior!
     # TEST BEGIN
 
-    conn.send('IDLE_START')
-    print('Running idle period for power baseline')
-    sleep(15)
-    conn.send('IDLE_END')
+    _idle_period(conn, idle, adaptive_idle)
 
-    sleep(3) # buffer time
+    sleep(buffer) # buffer time
 
-    conn.send('MODEL_LOAD_START')
-    mdl = None
-    tk = None
-    if do_quantize:
-        mdl, tk = hf_models.load_model_quantized(model_name)
-    else:
-        mdl, tk = hf_models.load_model(model_name)
-    conn.send('MODEL_LOAD_END')
+    send(conn, 'MODEL_LOAD_START')
+    mdl, tk = _load_model(model_name, conn, do_quantize, quantized_path, load_mode)
+    send(conn, 'MODEL_LOAD_END')
 
-    sleep(3) # buffer time
+    sleep(buffer) # buffer time
 
-    conn.send('GENERATE_START')
-    output, new_tokens = hf_models.generate_from_input(mdl, tk, in_data, max_new_tokens=tokens_to_gen)
-    conn.send('GENERATE_END')
+    outputs = _generate_request(mdl, tk, in_data, conn, tokens_to_gen, batch_size)
 
     # TEST END
-    conn.send(f'TOKENS:{len(new_tokens)}')
-    print(output)
+    print(outputs[0])
+    conn.close()
+
+# Same as above, but the model is loaded once and then serves generation requests sent by the runner (warm mode).
+def _warm_test(model_name: str, conn: Connection, do_quantize: bool, quantized_path: str, load_mode: str,
+               tokens_to_gen: int, batch_size: int, idle: float, adaptive_idle: bool, buffer: float):
+    '''Warm test method content, performed on a separate process.
+    Each request is a (number, input) tuple received over the pipe, until None is received.'''
+    _idle_period(conn, idle, adaptive_idle)
+
+    sleep(buffer) # buffer time
+
+    send(conn, 'MODEL_LOAD_START')
+    mdl, tk = _load_model(model_name, conn, do_quantize, quantized_path, load_mode)
+    send(conn, 'MODEL_LOAD_END')
+
+    sleep(buffer) # buffer time
+
+    # each request is generated with its own numbered periods (i.e. GENERATE_1)
+    outputs = list()
+    for r, in_data in receive_requests(conn):
+        print(f'Request {r}')
+        outputs = _generate_request(mdl, tk, in_data, conn, tokens_to_gen, batch_size, f'_{r}')
+
+    if len(outputs) > 0:
+        print(outputs[0])
     conn.close()
 
+def _load_model(model_name: str, conn: Connection, do_quantize: bool, quantized_path: str, load_mode: str):
+    '''Loads a model and its tokenizer. Unless the load mode is 'hf', the model is loaded in phases (see mmap_loader.py),
+    and the start and end of each phase is sent as a message. Otherwise, a quantized model is loaded from the folder of
+    its pre-quantized copy if one is given (see hf_models.prepare_load()).'''
+    if load_mode != 'hf':
+        import mmap_loader
+        bnb_conf = hf_models.quantization_config() if do_quantize else None
+        return mmap_loader.load_model(model_name, bnb_conf, load_mode, lambda x: send(conn, x))
+    if do_quantize:
+        return hf_models.load_model_quantized(model_name, quantized_path)
+    return hf_models.load_model(model_name)
+
+def _idle_period(conn: Connection, idle: float, adaptive: bool):
+    '''Runs the idle period for the power baseline, for the given time (skipped if 0, i.e. when the baseline is shared).
+    If adaptive, the period ends early when the runner sends a message once the power is steady.'''
+    if idle <= 0:
+        return
+    send(conn, 'IDLE_START')
+    print('Running idle period for power baseline')
+    if adaptive:
+        if conn.poll(idle):
+            conn.recv()
+    else:
+        sleep(idle)
+    send(conn, 'IDLE_END')
+
+def _generate_request(mdl, tk, in_data, conn: Connection, tokens_to_gen: int, batch_size: int, request: str = '') -> list[str]:
+    '''Generates from the input, sending the GENERATE<request> timestamps, the number of tokens
+    generated and the time of each token over the pipe. Returns the generated texts.'''
+    send(conn, f'GENERATE{request}_START')
+    timer = hf_models.TokenTimer()
+    outputs, new_tokens = hf_models.generate_batch(mdl, tk, [in_data] * batch_size, max_new_tokens=tokens_to_gen, timer=timer)
+    send(conn, f'GENERATE{request}_END')
+    send(conn, f'TOKENS{request}:{sum([len(x) for x in new_tokens])}')
+    send(conn, f'TOKEN_TIMES{request}:' + ','.join([str(t) for t in [timer.time_start] + timer.token_times]))
+    return outputs
+
 
 # run tests
-for m in models:
-    for i in range(iterations):
+for m, batch_size in [(x, bs) for x in models for bs in batch_sizes]:
+    shared_baseline = dict()
+    # in warm mode, all iterations are run as requests in a single test
+    for i in range(1 if opt_warm else iterations):
         m_subname = m.split('/')[-1]
-        print(f'\n### Beginning test of {m_subname} ({i+1}/{iterations})')
+        if opt_warm:
+            print(f'\n### Beginning warm test of {m_subname} ({iterations} requests, batch size {batch_size})')
+        else:
+            print(f'\n### Beginning test of {m_subname} ({i+1}/{iterations}, batch size {batch_size})')
 
+        # the model's cache use is recorded and its pre-quantized copy found here, so neither is part of the model load
+        quantized_path = hf_models.prepare_load(m, None if opt_no_quant else hf_models.quantization_config(), not opt_no_quant_cache)
+        quantize_on_load = not opt_no_quant and load_mode == 'hf' and len(quantized_path) == 0
+        if quantize_on_load and not opt_no_quant_cache:
+            print(f'### No pre-quantized copy of {m_subname} found, it will be quantized on load')
+
+        # set up the output file for the log
+        outfolder = os.path.join(os.path.abspath(output_dir), date_str)
+        Path(outfolder).mkdir(parents=True, exist_ok=True)
+        log_name_parts = ['log', m_subname, str(i+1)]
+        if opt_no_quant:
+            log_name_parts.append('no-quant')
+        if quantize_on_load:
+            log_name_parts.append('quant-on-load')
+        if batch_size > 1:
+            log_name_parts.append(f'bs{batch_size}')
+        if opt_warm:
+            log_name_parts.append('warm')
+        if load_mode != 'hf':
+            log_name_parts.append(f'load-{load_mode}')
+        if len(suffix) > 0:
+            log_name_parts.append(suffix)
+        outfilename = '_'.join(log_name_parts) + '.' + log_format
+        outfilepath = os.path.join(outfolder, outfilename)
+
+        # the log is checkpointed during the test, so it can be salvaged by validate.py if the test is interrupted
+        checkpoint_path = outfilepath + CHECKPOINT_SUFFIX
         test_log = Log()
-        test_log.begin(interval=0.1)
-        sleep(3) # buffer time
+        test_log.batch_size = batch_size
+        # the idle baseline is only measured in the first iteration when shared
+        share_idle = opt_shared_idle and i > 0 and len(shared_baseline) > 0
+        if share_idle:
+            test_log.baseline = dict(shared_baseline, shared=True)
+        if log_format == 'ndjson':
+            # stream samples to the log file during the test
+            test_log.begin(interval=0.1, stream_path=outfilepath, checkpoint_path=checkpoint_path, sampler=sampler)
+        else:
+            test_log.begin(interval=0.1, checkpoint_path=checkpoint_path, sampler=sampler)
+        # keep the samples of the idle period in memory for its baseline (see messages.record_message())
+        test_log.hold_stream(not share_idle and idle_time > 0)
+        sleep(buffer_time) # buffer time
 
         # here we put all of the model loading and usage in a separate process
         # this allows us to cleanly release all memory, both CPU and GPU
         # additionally, a pipe is used to send back timestamped messages for the log
         msg_recv, msg_send = Pipe()
-        proc = Process(target=_individual_test, args=[m, input_data, msg_send, not opt_no_quant, num_tokens_to_gen])
+        test_args = [msg_send, not opt_no_quant, quantized_path, load_mode, num_tokens_to_gen, batch_size, 0 if share_idle else idle_time, opt_adaptive_idle, buffer_time]
+        requests = list()
+        if opt_warm:
+            # the input of each request is sent over the pipe once the model has loaded (see messages.receive_messages())
+            proc = Process(target=_warm_test, args=[m] + test_args)
+            requests = [input_data] * iterations
+        else:
+            proc = Process(target=_individual_test, args=[m, input_data] + test_args)
         proc.start()
-        while proc.is_alive():
-            if msg_recv.poll():
-                message = str(msg_recv.recv())
-                test_log.add_timestamp(message)
-                msg_var = message.split(':')
-                if len(msg_var) > 1:
-                    if msg_var[0] == 'TOKENS':
-                        test_log.tokens_generated = int(msg_var[1])
+        receive_messages(test_log, msg_recv, proc, idle_threshold if opt_adaptive_idle and not share_idle else -1, requests)
         proc.join()
+        if proc.exitcode != 0:
+            # i.e. the test process was killed for running out of memory
+            print(f'### Test process exited with code {proc.exitcode}, log will be marked as truncated')
+            test_log.truncated = True
         if not msg_send.closed:
             msg_send.close()
         msg_recv.close()
 
-        sleep(3) # buffer time
+        sleep(buffer_time) # buffer time
         test_log.end()
-        print(f'### Finished test of {m_subname} ({i+1}/{iterations}), generated {test_log.tokens_generated} tokens')
+        if test_log.sampler_info.get('read_errors', 0) > 0:
+            print(f'### Sampler failed {test_log.sampler_info["read_errors"]} readings ({test_log.sampler_info["read_error"]}), log is marked as truncated')
+        if i == 0:
+            shared_baseline = test_log.baseline
+        if opt_warm:
+            served = len([x for x in test_log.periods() if x.startswith('GENERATE_') and x[9:].isdigit()])
+            print(f'### Finished warm test of {m_subname} ({served}/{iterations} requests served), generated {test_log.tokens_generated} tokens')
+        else:
+            print(f'### Finished test of {m_subname} ({i+1}/{iterations}), generated {test_log.tokens_generated} tokens')
+        t_gen_start, t_gen_end = test_log.period('GENERATE_1' if opt_warm else 'GENERATE')
+        if opt_warm:
+            t_gen_end = test_log.period(f'GENERATE_{iterations}')[1]
+        if t_gen_start != -1 and t_gen_end > t_gen_start:
+            print(f'### Throughput: {test_log.tokens_generated / (t_gen_end - t_gen_start):.2f} tokens/s')
 
-        # save the log to a file for analysis
-        outfolder = os.path.join(os.path.abspath(output_dir), date_str)
-        Path(outfolder).mkdir(parents=True, exist_ok=True)
-        log_name_parts = ['log', m_subname, str(i+1)]
-        if opt_no_quant:
-            log_name_parts.append('no-quant')
-        if len(suffix) > 0:
-            log_name_parts.append(suffix)
-        outfilename = '_'.join(log_name_parts) + '.json'
-        outfilepath = os.path.join(outfolder, outfilename)
-        print(f'### Saving log to {outfilepath}')
-        json_str = test_log.to_json()
-        with open(outfilepath, 'w') as fp:
-            fp.write(json_str)
\ No newline at end of file
+        # save the log to a file for analysis (streamed logs are already saved)
+        if log_format == 'ndjson':
+            print(f'### Log streamed to {outfilepath}')
+        else:
+            print(f'### Saving log to {outfilepath}')
+            test_log.save(outfilepath)
+        if os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+
+# release the shared telemetry backend (i.e. the sensor files of the sysfs sampler)
+if sampler is not None:
+    sampler.close()
@@ -0,0 +1,392 @@
+# Telemetry backends for statlog.Log.
+#
+# A sampler takes a reading of the board at a fixed interval and passes it to a callback as a
+# Sample. Log.begin() uses jtop by default, but any Sampler can be given instead:
+#
+#   JtopSampler   - readings from the jtop service (requires jtop, Jetson only)
+#   SysfsSampler  - reads the INA3221 power rails (hwmon), GPU devfreq and /proc directly
+#   ReplaySampler - replays the measurements of an existing log, for testing capture without a Jetson
+#
+# The sysfs and replay samplers run in their own thread, so they can be used on any machine.
+
+import importlib.util
+jtop_exists = importlib.util.find_spec('jtop') is not None
+if jtop_exists:
+    from jtop import jtop
+
+import os
+import threading
+from bisect import bisect_right
+from time import perf_counter, thread_time
+from typing import Callable
+
+PROCESS_NAME = 'pt_main_thread'
+'''Name of the processes to measure memory usage of (the pytorch process running the model)'''
+
+
+class Sample:
+    '''Simple "struct" for a single reading of the board.'''
+    power: float
+    '''Total power (in watts)'''
+    freq_gpu: float
+    '''GPU frequency (in MHz)'''
+    processes: dict[int, tuple[float, float]]
+    '''(RAM, GPU memory) usage of each measured process (in KB), indexed by PID'''
+
+    def __init__(self, power: float, freq_gpu: float, processes: dict[int, tuple[float, float]]):
+        self.power = power
+        self.freq_gpu = freq_gpu
+        self.processes = processes
+
+class Sampler:
+    '''Base class for telemetry backends.'''
+    name: str = 'none'
+    '''Name of the backend'''
+    scheduled: bool = False
+    '''Whether the sampler schedules its own ticks every interval from the first one (rather than following
+    a timer of its own, whose rate may differ slightly from perf_counter()), see statlog.TickStats'''
+
+    def start(self, interval: float, callback: Callable[[Sample], None]):
+        '''Begins taking samples every interval seconds, passing each one to the callback.'''
+        raise NotImplementedError()
+
+    def stop(self):
+        '''Stops taking samples. The callback is not called again after this returns.'''
+        raise NotImplementedError()
+
+    def overhead(self) -> dict:
+        '''Returns measurements of the sampler's own overhead during the last run, if the backend can measure it.'''
+        return dict()
+
+    def close(self):
+        '''Releases any resources held by the sampler (i.e. open files). The sampler can't be started again after this.'''
+        pass
+
+class ThreadSampler(Sampler):
+    '''Base class for samplers that take readings in a thread of their own.
+    Subclasses only need to implement read().
+
+    The time spent taking readings and the CPU time used by the sampler thread (including the
+    callback) are measured, see overhead(). If a reading fails, its tick is skipped (so the log counts
+    it as missed) and the sampler keeps going; failed readings are counted in overhead() too.'''
+    scheduled = True
+
+    error: Exception = None
+    '''First exception raised by read() during the last run, or None if every reading succeeded'''
+
+    def read(self) -> Sample:
+        '''Takes a single reading.'''
+        raise NotImplementedError()
+
+    def start(self, interval: float, callback: Callable[[Sample], None]):
+        self._interval = interval
+        self._callback = callback
+        self._stop_event = threading.Event()
+        self._reads = 0
+        self._read_errors = 0
+        self.error = None
+        self._read_time = 0
+        self._read_time_max = 0
+        self._cpu_time = 0
+        self._run_time = 0
+        self._thread = threading.Thread(target=self._run, name=f'{self.name}-sampler', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        cpu_start = thread_time()
+        run_start = perf_counter()
+        next_time = run_start
+        while not self._stop_event.is_set():
+            read_start = perf_counter()
+            try:
+                sample = self.read()
+            except Exception as e:
+                # i.e. a sensor file that can no longer be read, which would otherwise end the thread silently
+                sample = None
+                self._read_errors += 1
+                if self.error is None:
+                    self.error = e
+            read_time = perf_counter() - read_start
+            self._reads += 1
+            self._read_time += read_time
+            self._read_time_max = max(self._read_time_max, read_time)
+            if sample is not None:
+                self._callback(sample)
+            # schedule from the previous tick instead of the end of this one, so the interval doesn't drift
+            next_time += self._interval
+            delay = next_time - perf_counter()
+            if delay < 0:
+                # fell behind, skip the missed ticks instead of sampling back to back (keeping the same schedule)
+                missed = int(-delay / self._interval) + 1
+                next_time += missed * self._interval
+                delay += missed * self._interval
+            self._stop_event.wait(delay)
+        self._cpu_time = thread_time() - cpu_start
+        self._run_time = perf_counter() - run_start
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def overhead(self) -> dict:
+        '''Returns the number of readings taken ('samples'), the mean and maximum time taken by a
+        reading ('read_time_mean', 'read_time_max', in seconds), the CPU time used by the sampler thread
+        ('cpu_time', in seconds) and that CPU time as a fraction of the time the sampler ran ('cpu_load'),
+        along with the number of readings that failed ('read_errors') and the first error ('read_error', if any).
+        CPU times are only available after the sampler stops.'''
+        overhead = {
+            'samples': self._reads,
+            'read_errors': self._read_errors,
+            'read_time_mean': self._read_time / self._reads if self._reads > 0 else 0,
+            'read_time_max': self._read_time_max,
+            'cpu_time': self._cpu_time,
+            'cpu_load': self._cpu_time / self._run_time if self._run_time > 0 else 0
+        }
+        if self.error is not None:
+            overhead['read_error'] = f'{type(self.error).__name__}: {self.error}'
+        return overhead
+
+
+class JtopSampler(Sampler):
+    '''Readings from the jtop service. Requires jtop.'''
+    name = 'jtop'
+
+    def __init__(self):
+        if not jtop_exists:
+            raise ImportError('Cannot use jtop sampler, jtop is not installed!')
+
+    def _jtop_cb(self, jetson):
+        processes = dict()
+        for proc in jetson.processes:
+            # pytorch process we want is always called 'pt_main_thread', GPU mem usage reflects model loading
+            if proc[9] == PROCESS_NAME:
+                processes[proc[0]] = (proc[7], proc[8])
+        self._callback(Sample(jetson.power['tot']['power'] / 1000, jetson.gpu['gpu']['freq']['cur'] / 1000, processes))
+
+    def start(self, interval: float, callback: Callable[[Sample], None]):
+        self._callback = callback
+        self._jtop = jtop(interval=interval)
+        self._jtop.attach(self._jtop_cb)
+        self._jtop.start()
+
+    def stop(self):
+        self._jtop.close()
+        del self._jtop
+
+
+class SysfsSampler(ThreadSampler):
+    '''Reads sensors directly from /sys and /proc, without the jtop service.
+
+    Power is read from the INA3221 monitors through hwmon. If one of the rails is a total input rail
+    (see TOTAL_RAILS), it is used as the total power, otherwise all rails are summed. The GPU frequency
+    is read from its devfreq device, and process RAM usage from /proc/<pid>/status. GPU memory usage
+    is read from the nvmap debugfs (if readable, it usually requires root), and is 0 otherwise.
+
+    Every sensor file is opened once and re-read with os.pread(), so a reading only costs a few
+    system calls and intervals of a few milliseconds are possible. /proc is only searched for new
+    processes every rescan_interval seconds. Call close() to release the file descriptors.
+
+    All paths are relative to the given root, so the sampler can be tested against a fake sysfs tree.'''
+    name = 'sysfs'
+
+    TOTAL_RAILS = ('VDD_IN',)
+    '''Labels of INA3221 rails that measure the total input power of the board'''
+    GPU_DEVFREQ_NAMES = ('gpu', 'ga10b', 'gv11b', 'gp10b')
+    '''devfreq device names (or parts of names) that belong to the GPU'''
+    READ_SIZE = 4096
+    '''Maximum number of bytes read from a sensor file (/proc/<pid>/status is the largest, at ~1.5 KB)'''
+
+    rails: dict[str, tuple[str, str]]
+    '''(voltage, current) file paths of each power rail, indexed by label'''
+    freq_path: str
+    '''Path of the GPU's devfreq cur_freq file, or an empty string if it wasn't found'''
+    rescan_interval: float
+    '''Time between searches of /proc for new processes (in seconds)'''
+
+    def __init__(self, root: str = '/', rescan_interval: float = 1.0):
+        '''Finds and opens the sensors under the given root. Raises a RuntimeError if no power rails are found.'''
+        self.root = root
+        self.rescan_interval = rescan_interval
+        self.rails = dict()
+        hwmon_dir = os.path.join(root, 'sys', 'class', 'hwmon')
+        for hwmon in sorted(os.listdir(hwmon_dir)) if os.path.isdir(hwmon_dir) else list():
+            path = os.path.join(hwmon_dir, hwmon)
+            name_path = os.path.join(path, 'name')
+            if not os.path.exists(name_path) or _read_str(name_path) != 'ina3221':
+                continue
+            for f in sorted(os.listdir(path)):
+                # rails are numbered, with in<N>_label, in<N>_input (mV) and curr<N>_input (mA) files
+                if f.startswith('in') and f.endswith('_label'):
+                    n = f[2:-6]
+                    label = _read_str(os.path.join(path, f))
+                    volt_path = os.path.join(path, f'in{n}_input')
+                    curr_path = os.path.join(path, f'curr{n}_input')
+                    if os.path.exists(volt_path) and os.path.exists(curr_path) and not label.lower().startswith('sum of'):
+                        self.rails[label] = (volt_path, curr_path)
+        if len(self.rails) == 0:
+            raise RuntimeError(f'Cannot use sysfs sampler, no INA3221 power rails found in {hwmon_dir}!')
+
+        self.freq_path = ''
+        devfreq_dir = os.path.join(root, 'sys', 'class', 'devfreq')
+        for dev in sorted(os.listdir(devfreq_dir)) if os.path.isdir(devfreq_dir) else list():
+            if any(x in dev for x in self.GPU_DEVFREQ_NAMES):
+                self.freq_path = os.path.join(devfreq_dir, dev, 'cur_freq')
+                break
+
+        self._proc_dir = os.path.join(root, 'proc')
+        self._nvmap_path = os.path.join(root, 'sys', 'kernel', 'debug', 'nvmap', 'iovmm', 'clients')
+
+        # open every file up front, only the total rail is read if there is one
+        total_rail = next((x for x in self.TOTAL_RAILS if x in self.rails), None)
+        rails = [self.rails[total_rail]] if total_rail is not None else self.rails.values()
+        self._rail_fds = [(os.open(v, os.O_RDONLY), os.open(c, os.O_RDONLY)) for v, c in rails]
+        self._freq_fd = os.open(self.freq_path, os.O_RDONLY) if len(self.freq_path) > 0 else -1
+        try:
+            self._nvmap_fd = os.open(self._nvmap_path, os.O_RDONLY)
+        except OSError:
+            self._nvmap_fd = -1
+        self._proc_fds: dict[int, int] = dict()
+        self._rescan_time = -1
+
+    def close(self):
+        '''Closes all open sensor files.'''
+        fds = [fd for pair in self._rail_fds for fd in pair] + [self._freq_fd, self._nvmap_fd] + list(self._proc_fds.values())
+        for fd in fds:
+            if fd != -1:
+                os.close(fd)
+        self._rail_fds = list()
+        self._freq_fd = -1
+        self._nvmap_fd = -1
+        self._proc_fds = dict()
+
+    def read_power(self) -> float:
+        '''Returns the total power (in watts).'''
+        total = 0
+        for volt_fd, curr_fd in self._rail_fds:
+            total += int(os.pread(volt_fd, 32, 0)) * int(os.pread(curr_fd, 32, 0))
+        return total / 1e6
+
+    def read_freq_gpu(self) -> float:
+        '''Returns the GPU frequency (in MHz), or 0 if the GPU's devfreq device wasn't found.'''
+        if self._freq_fd == -1:
+            return 0
+        return int(os.pread(self._freq_fd, 32, 0)) / 1e6
+
+    def _rescan_processes(self):
+        # open the status file of any new process with the right name
+        for entry in os.listdir(self._proc_dir):
+            if not entry.isdigit() or int(entry) in self._proc_fds:
+                continue
+            try:
+                if _read_str(os.path.join(self._proc_dir, entry, 'comm')) == PROCESS_NAME:
+                    self._proc_fds[int(entry)] = os.open(os.path.join(self._proc_dir, entry, 'status'), os.O_RDONLY)
+            except OSError:
+                continue # process exited while reading
+
+    def read_processes(self) -> dict[int, tuple[float, float]]:
+        '''Returns the (RAM, GPU memory) usage (in KB) of each measured process.'''
+        now = perf_counter()
+        if now - self._rescan_time >= self.rescan_interval:
+            self._rescan_processes()
+            self._rescan_time = now
+        gpu_mem = self._read_nvmap() if len(self._proc_fds) > 0 else dict()
+        processes = dict()
+        for pid, fd in list(self._proc_fds.items()):
+            # status lines look like: "VmRSS:\t  123456 kB"
+            try:
+                status = os.pread(fd, self.READ_SIZE, 0)
+            except OSError:
+                status = b''
+            i = status.find(b'VmRSS:')
+            if i == -1:
+                # the process has exited (or is a zombie without any memory)
+                os.close(fd)
+                del self._proc_fds[pid]
+                continue
+            processes[pid] = (int(status[i + 6:status.index(b'kB', i)]), gpu_mem.get(pid, 0))
+        return processes
+
+    def _read_nvmap(self) -> dict[int, float]:
+        # lines look like: "user    pt_main_thread    1234    567890K"
+        usage = dict()
+        if self._nvmap_fd == -1:
+            return usage
+        try:
+            lines = os.pread(self._nvmap_fd, 16 * self.READ_SIZE, 0).decode().splitlines()
+        except OSError:
+            return usage
+        for line in lines[1:]:
+            data = line.split()
+            if len(data) >= 4 and data[2].isdigit() and data[3].endswith('K'):
+                usage[int(data[2])] = usage.get(int(data[2]), 0) + int(data[3][:-1])
+        return usage
+
+    def read(self) -> Sample:
+        return Sample(self.read_power(), self.read_freq_gpu(), self.read_processes())
+
+
+class ReplaySampler(ThreadSampler):
+    '''Replays the measurements of an existing log, for testing capture without a Jetson.
+
+    Each reading returns the most recent measurement of the source log at the time elapsed since
+    the sampler started (scaled by speed). Once the end of the source log is reached, its last
+    measurements are repeated.'''
+    name = 'replay'
+
+    def __init__(self, source, speed: float = 1.0):
+        '''Source can be either a Log or the path of a log file.'''
+        if isinstance(source, str):
+            import statlog
+            source = statlog.load(source)
+        self.source = source
+        self.speed = speed
+        self._pids = [int(pid) for pid in source.memory_ram.keys()]
+
+    def _value_at(self, ch, t: float) -> float:
+        i = bisect_right(ch.times(), t) - 1
+        if i < 0:
+            return 0
+        return ch.values()[i]
+
+    def start(self, interval: float, callback: Callable[[Sample], None]):
+        self._time_start = perf_counter()
+        super().start(interval, callback)
+
+    def read(self) -> Sample:
+        t = (perf_counter() - self._time_start) * self.speed
+        processes = dict()
+        for pid, ram, gpu in zip(self._pids, self.source.memory_ram.values(), self.source.memory_gpu.values()):
+            # processes are only replayed while they exist in the source log
+            if len(ram) > 0 and ram.times()[0] <= t <= ram.times()[-1]:
+                processes[pid] = (self._value_at(ram, t), self._value_at(gpu, t))
+        return Sample(self._value_at(self.source.power, t), self._value_at(self.source.freq_gpu, t), processes)
+
+
+def default_sampler() -> Sampler:
+    '''Returns the jtop sampler if jtop is installed, otherwise the sysfs sampler.
+    Raises an ImportError if neither can be used.'''
+    if jtop_exists:
+        return JtopSampler()
+    try:
+        return SysfsSampler()
+    except RuntimeError:
+        raise ImportError('Cannot sample telemetry, jtop is not installed and no INA3221 power rails were found!')
+
+def get_sampler(spec: str) -> Sampler:
+    '''Returns a sampler from a command line spec: 'jtop', 'sysfs', 'sysfs:<root>' or 'replay:<log path>'.'''
+    name, _, arg = spec.partition(':')
+    match name:
+        case 'jtop':
+            return JtopSampler()
+        case 'sysfs':
+            return SysfsSampler(arg if len(arg) > 0 else '/')
+        case 'replay':
+            return ReplaySampler(arg)
+        case _:
+            raise ValueError(f'Unknown sampler: {spec}')
+
+
+def _read_str(path: str) -> str:
+    with open(path, 'r') as fp:
+        return fp.read().strip()
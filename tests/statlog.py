@@ -5,22 +5,33 @@
 # function at the proper intervals together, and they will default to 1 s intervals.
 # 
 # Additional stats (either from jtop or another source) can be added in the Log._log_cb()
-# callback method. This method is called by jtop at the interval given in the Log.begin()
+# callback method. This method is called by the sampler at the interval given in the Log.begin()
 # method, but any stats can be added to this function to ensure they are logged at said
-# interval.
+# interval. Readings are taken by jtop by default, other telemetry backends are in samplers.py.
 # 
 # jtop reference: https://rnext.it/jetson_stats/reference/jtop.html 
 # 
 # Liam Seymour 6/18/24
 
 import importlib.util
-jtop_exists = importlib.util.find_spec('jtop') is not None
-if jtop_exists:
-    from jtop import jtop
+numpy_exists = importlib.util.find_spec('numpy') is not None
+if numpy_exists:
+    import numpy as np
 
-from json import dumps, loads, JSONDecoder, JSONEncoder
+import math
+import os
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+from json import dumps, loads, JSONDecodeError, JSONDecoder, JSONEncoder
+from queue import SimpleQueue
 from time import perf_counter, sleep
-from typing import Any
+from typing import Any, Iterator
+
+from samplers import Sample, Sampler, default_sampler
+
+CHECKPOINT_SUFFIX = '.partial'
+'''Suffix added to a log's path for its checkpoint file'''
 
 def get_time() -> float:
     # wrapper for perf_counter, in case we need to use something else or add functionality later
@@ -35,6 +46,96 @@ class LogEntry:
         self.time = time
         self.value = value
 
+class Channel:
+    '''Array-backed column store for a single series of timed measurements.
+
+    Times and values are kept in preallocated `array('d')` buffers that double in size when full,
+    so logging a sample does not allocate any Python objects. Iterating or indexing a channel still
+    yields LogEntry objects, so code written against the old list-of-LogEntry API keeps working.
+    Use Channel.to_numpy() for zero-copy NumPy views of the data.'''
+
+    _INITIAL_CAPACITY = 1024
+
+    def __init__(self, capacity: int = _INITIAL_CAPACITY):
+        capacity = max(capacity, 1)
+        self._times = array('d', bytes(8 * capacity))
+        self._values = array('d', bytes(8 * capacity))
+        self._len = 0
+        self._offset = 0
+
+    def _grow(self):
+        # a new buffer is made instead of resizing in place, so views from to_numpy() taken
+        # before the resize remain valid (they just stop seeing new samples)
+        times = array('d', self._times)
+        times.frombytes(bytes(8 * max(len(self._times), 1)))
+        values = array('d', self._values)
+        values.frombytes(bytes(8 * max(len(self._values), 1)))
+        self._times = times
+        self._values = values
+
+    def append(self, time: float, value: float):
+        '''Adds a measurement to the end of the channel.'''
+        if self._len == len(self._times):
+            self._grow()
+        self._times[self._len] = time
+        self._values[self._len] = value
+        self._len += 1
+
+    def clear(self):
+        '''Removes all measurements from the channel.
+        New buffers are allocated, so views from to_numpy() taken before clearing remain valid.'''
+        offset = self._offset + self._len
+        self.__init__()
+        # measurements removed so far, so the same measurement always has the same index (see LogCheckpoint)
+        self._offset = offset
+
+    def times(self) -> memoryview:
+        '''Returns a read-only view of the recorded times (in seconds).'''
+        return memoryview(self._times)[:self._len].toreadonly()
+
+    def values(self) -> memoryview:
+        '''Returns a read-only view of the recorded values.'''
+        return memoryview(self._values)[:self._len].toreadonly()
+
+    def to_numpy(self) -> tuple:
+        '''Returns zero-copy NumPy views of the (times, values) arrays. Requires numpy.'''
+        if not numpy_exists:
+            raise ImportError('Cannot create NumPy views, numpy is not installed!')
+        return np.frombuffer(self.times(), dtype=np.float64), np.frombuffer(self.values(), dtype=np.float64)
+
+    def from_entries(entries: list[LogEntry]):
+        '''Builds a channel from a list of LogEntry objects.'''
+        ch = Channel(len(entries))
+        for entry in entries:
+            ch.append(entry.time, entry.value)
+        return ch
+
+    def from_buffers(times, values):
+        '''Builds a channel from two buffers of float64 values (i.e. NumPy arrays), copying the data.'''
+        ch = Channel()
+        ch._times = array('d', memoryview(times).tobytes())
+        ch._values = array('d', memoryview(values).tobytes())
+        if len(ch._times) != len(ch._values):
+            raise ValueError('Time and value buffers must be the same length!')
+        ch._len = len(ch._times)
+        return ch
+
+    def __len__(self) -> int:
+        return self._len
+
+    def __iter__(self) -> Iterator[LogEntry]:
+        for i in range(self._len):
+            yield LogEntry(self._times[i], self._values[i])
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [LogEntry(t, v) for t, v in zip(self._times[:self._len][i], self._values[:self._len][i])]
+        if i < 0:
+            i += self._len
+        if not 0 <= i < self._len:
+            raise IndexError('Channel index out of range')
+        return LogEntry(self._times[i], self._values[i])
+
 class Log:
     '''Contains logged data from a logging session.'''
 
@@ -45,80 +146,193 @@ class Log:
     timestamps: list[LogEntry]
     '''List of timestamp entries in the log.
     Useful for storing information on events that take place during logging.'''
-    freq_gpu: list[LogEntry]
-    '''List of GPU frequency measurements (in MHz)'''
-    memory_ram: dict[int, list[LogEntry]]
-    '''Dictionary of lists of RAM measurements (in KB). 
-    The dictionary is indexed by the PID of the pt_main_thread process(es) seen by jtop.
-    Lists in the dictionary store measurements along with the time they are recorded since the log began (in seconds).'''
-    memory_gpu: dict[int, list[LogEntry]]
-    '''Dictionary of lists of GPU memory measurements (in KB). 
-    The dictionary is indexed by the PID of the pt_main_thread process(es) seen by jtop.
-    Lists in the dictionary store measurements along with the time they are recorded since the log began (in seconds).'''
-    power: list[LogEntry]
-    '''List of power measurements (in watts), along with the time they are recorded since the log began (in seconds).'''
+    freq_gpu: Channel
+    '''Channel of GPU frequency measurements (in MHz)'''
+    memory_ram: dict[int, Channel]
+    '''Dictionary of channels of RAM measurements (in KB). 
+    The dictionary is indexed by the PID of the pt_main_thread process(es) seen by the sampler.
+    Channels in the dictionary store measurements along with the time they are recorded since the log began (in seconds).'''
+    memory_gpu: dict[int, Channel]
+    '''Dictionary of channels of GPU memory measurements (in KB). 
+    The dictionary is indexed by the PID of the pt_main_thread process(es) seen by the sampler.
+    Channels in the dictionary store measurements along with the time they are recorded since the log began (in seconds).'''
+    power: Channel
+    '''Channel of power measurements (in watts), along with the time they are recorded since the log began (in seconds).'''
     tokens_generated: int
     '''Number of tokens generated during the test.'''
+    batch_size: int
+    '''Number of inputs generated from at once during the test.'''
     accuracy: float # TODO: Add accuracy measurement
     '''Accuracy of the test (WIP)'''
+    truncated: bool
+    '''True if the log is incomplete, i.e. the test was interrupted or recovered from a checkpoint.'''
+    baseline: dict
+    '''Idle baseline of the test: its mean power ('power', W), the standard deviation of the power ('power_std', W),
+    its duration ('duration', s), and whether it was measured in an earlier test and shared with this one ('shared').
+    Empty if no baseline was recorded.'''
+    sampler_info: dict
+    '''Name and interval of the sampler used for the log, along with its measured overhead (see Sampler.overhead())
+    and a summary of its timing (see TickStats.summary()).'''
+    tick_delay: Channel
+    '''Channel of sampler tick delays (in seconds), i.e. the difference between the time each sample was taken
+    and the time it was scheduled for. Negative if the sample was taken early.'''
+    tick_duration: Channel
+    '''Channel of the time taken by the logging callback on each tick (in seconds).'''
+    message_delay: Channel
+    '''Channel of the delays (in seconds) between messages being sent from another process (i.e. the test process)
+    and being received by the log's process, along with the time each was received. See Log.add_message_delay().'''
+    token_latency: Channel
+    '''Channel of per-token generation latencies (in seconds), along with the time each token was generated.
+    The first token of each generation stores its time to first token (the prefill), the rest store the time
+    since the previous token (the decode). See Log.add_token_times().'''
+
+    _CHANNELS = ('freq_gpu', 'power', 'tick_delay', 'tick_duration', 'token_latency', 'message_delay')
+    '''Names of attributes stored as a single Channel.'''
+    _PID_CHANNELS = ('memory_ram', 'memory_gpu')
+    '''Names of attributes stored as a dictionary of Channels indexed by PID.'''
 
-    if jtop_exists:
-        _jtop: jtop
+    _sampler: Sampler
 
     def __init__(self):
         self.time_log_start = -1
         self.time_log_end = -1
         self.timestamps = list()
-        self.freq_gpu = list()
+        self.freq_gpu = Channel()
         self.memory_ram = dict()
         self.memory_gpu = dict()
-        self.power = list()
+        self.power = Channel()
         self.tokens_generated = -1
+        self.batch_size = 1
         self.accuracy = -1
+        self.truncated = False
+        self.baseline = dict()
+        self.sampler_info = dict()
+        self.tick_delay = Channel()
+        self.tick_duration = Channel()
+        self.token_latency = Channel()
+        self.message_delay = Channel()
+        self._ticks = None
+        self._stream = None
+        self._checkpoint = None
+        self._close_sampler = False
+        self._hold_stream = False
     
     def _t(self) -> float:
         return get_time() - self.time_log_start
 
-    def _log_cb(self, jetson):
-        '''internal logging callback function for jtop'''
+    def _log_cb(self, sample: Sample):
+        '''internal logging callback function for the sampler'''
         # get time since the log began
         t = self._t()
+        self.tick_delay.append(t, self._ticks.tick(t))
 
         # log power data
-        self.power.append(LogEntry(t, (jetson.power['tot']['power'] / 1000)))
+        self.power.append(t, sample.power)
 
         # log gpu frequency data
-        self.freq_gpu.append(LogEntry(t, (jetson.gpu['gpu']['freq']['cur'] / 1000)))
+        self.freq_gpu.append(t, sample.freq_gpu)
 
         # log process-specific data
-        for proc in jetson.processes:
-            # pytorch process we want is always called 'pt_main_thread', GPU mem usage reflects model loading
-            if proc[9] == "pt_main_thread":
-                pid = proc[0]
-                if not pid in self.memory_ram:
-                    self.memory_ram[pid] = list()
-                if not pid in self.memory_gpu:
-                    self.memory_gpu[pid] = list()
-                
-                # log RAM and GPU memory
-                self.memory_ram[pid].append(LogEntry(t, proc[7]))
-                self.memory_gpu[pid].append(LogEntry(t, proc[8]))
+        for pid, (ram, gpu) in sample.processes.items():
+            if not pid in self.memory_ram:
+                self.memory_ram[pid] = Channel()
+            if not pid in self.memory_gpu:
+                self.memory_gpu[pid] = Channel()
+            
+            # log RAM and GPU memory
+            self.memory_ram[pid].append(t, ram)
+            self.memory_gpu[pid].append(t, gpu)
+
+        # write out a chunk of samples if streaming to a file
+        if self._stream is not None and not self._hold_stream and len(self.power) >= self._stream.chunk_size:
+            self._stream.write_chunks(self)
+
+        # checkpoint the log periodically in case the test is interrupted (written out by the checkpoint's own thread)
+        if self._checkpoint is not None and t - self._checkpoint_time >= self._checkpoint_interval:
+            self._checkpoint.snapshot(self)
+            self._checkpoint_time = t
+
+        # time taken by this callback (not including the sampler's reading)
+        duration = self._t() - t
+        self._ticks.add_duration(duration)
+        self.tick_duration.append(t, duration)
     
-    def add_timestamp(self, info: str):
-        '''Adds a timestamped message to the log.'''
+    def _timestamp_index(self) -> dict[str, float]:
+        # name -> time index of the timestamps list, rebuilt if entries were added some other way
+        # (i.e. loaded from a file or appended directly)
+        if self.__dict__.get('_ts_count', -1) != len(self.timestamps):
+            self._ts_index = dict()
+            for entry in self.timestamps:
+                self._ts_index.setdefault(entry.value, entry.time)
+            self._ts_count = len(self.timestamps)
+        return self._ts_index
+
+    def add_timestamp(self, info: str, time: float = -1):
+        '''Adds a timestamped message to the log.
+        By default the message is timestamped now, otherwise at the given time (from get_time(), i.e. taken in
+        another process). Timestamps are kept in order of time.'''
         if self.time_log_start == -1:
             raise RuntimeError('Attempted to add a timestamp to a log before it was started!')
-        if self.get_timestamp(info) != -1:
+        index = self._timestamp_index()
+        if info in index:
             raise RuntimeError('Attempted to add a timestamp to a log when the timestamp name already exists!')
-        self.timestamps.append(LogEntry(self._t(), info))
+        entry = LogEntry(self._t() if time == -1 else time - self.time_log_start, info)
+        self.timestamps.insert(bisect_right(self.timestamps, entry.time, key=lambda x: x.time), entry)
+        index[info] = entry.time
+        self._ts_count += 1
     
+    def add_token_times(self, time_start: float, token_times: list[float]):
+        '''Adds the times (from get_time()) that each token of a generation was produced, given the time the generation started.
+        Times are stored as latencies in the token_latency channel.'''
+        if self.time_log_start == -1:
+            raise RuntimeError('Attempted to add token times to a log before it was started!')
+        prev = time_start
+        for t in token_times:
+            self.token_latency.append(t - self.time_log_start, t - prev)
+            prev = t
+    
+    def add_message_delay(self, time_sent: float):
+        '''Records the delay of a message received now, given the time (from get_time()) it was sent.'''
+        t = self._t()
+        self.message_delay.append(t, t - (time_sent - self.time_log_start))
+
     def get_timestamp(self, flag: str) -> float:
         '''Returns the time for the given timestamp, or -1 if it doesn't exist.'''
-        for entry in self.timestamps:
-            if entry.value == flag:
-                return entry.time
-        return -1
+        return self._timestamp_index().get(flag, -1)
+
+    def period(self, name: str) -> tuple[float, float]:
+        '''Returns the (start, end) times of a period marked by the '<name>_START' and '<name>_END' timestamps,
+        or (-1, -1) if either timestamp doesn't exist.'''
+        index = self._timestamp_index()
+        start = index.get(f'{name}_START', -1)
+        end = index.get(f'{name}_END', -1)
+        if start == -1 or end == -1:
+            return -1, -1
+        return start, end
+
+    def periods(self) -> list[str]:
+        '''Returns the names of all periods in the log with both a start and end timestamp, in order of their start.'''
+        index = self._timestamp_index()
+        return [entry.value[:-6] for entry in self.timestamps if entry.value.endswith('_START') and f'{entry.value[:-6]}_END' in index]
     
+    def power_stats(self, t_start: float, t_end: float) -> tuple[float, float, int]:
+        '''Returns the mean and standard deviation of the power measurements (in W) between t_start and t_end,
+        along with the number of measurements. Returns (-1, -1, 0) if there are none.
+        When streaming, only the measurements that haven't been written to the file yet are used (see hold_stream()).'''
+        times = self.power.times()
+        values = self.power.values()[bisect_left(times, t_start):bisect_right(times, t_end)]
+        n = len(values)
+        if n == 0:
+            return -1, -1, 0
+        mean = sum(values) / n
+        return mean, math.sqrt(sum([(x - mean) ** 2 for x in values]) / n), n
+    
+    def hold_stream(self, hold: bool):
+        '''While hold is True, samples are kept in memory instead of being written to the stream file,
+        so power_stats() can still use them (i.e. until the idle period ends). Held samples are written
+        out with the next chunk once released. Has no effect if the log isn't streamed.'''
+        self._hold_stream = hold
+
     def log_accuracy(self, acc: float):
         '''Stores the determined accuracy of the model during the test. (WIP)'''
         self.accuracy = acc
@@ -127,8 +341,14 @@ class Log:
 
     class _LogJSONEncoder(JSONEncoder):
         def default(self, o: Any) -> Any:
-            if isinstance(o, (Log, LogEntry)):
+            if isinstance(o, Log):
+                # internal attributes (i.e. the jtop instance or timestamp index) are not saved
+                return {k: v for k, v in o.__dict__.items() if not k.startswith('_')}
+            elif isinstance(o, LogEntry):
                 return o.__dict__
+            elif isinstance(o, Channel):
+                # keep the original list-of-entries layout for compatibility with older logs
+                return [{'time': t, 'value': v} for t, v in zip(o.times(), o.values())]
             else:
                 return super().default(o)
     
@@ -150,8 +370,94 @@ class Log:
     def from_json(json_str: str):
         '''Converts json string to Log object.'''
         newlog = Log()
-        newlog.__dict__ = loads(json_str, cls=Log._LogJSONDecoder)
+        newlog.__dict__.update(loads(json_str, cls=Log._LogJSONDecoder))
+        for name in Log._CHANNELS:
+            if name in newlog.__dict__:
+                newlog.__dict__[name] = Channel.from_entries(newlog.__dict__[name])
+        for name in Log._PID_CHANNELS:
+            if name in newlog.__dict__:
+                newlog.__dict__[name] = {pid: Channel.from_entries(entries) for pid, entries in newlog.__dict__[name].items()}
         return newlog
+
+    def to_npz(self, path: str):
+        '''Saves Log object to a compressed NumPy (.npz) file. Requires numpy.
+        
+        Each channel is stored as a pair of float64 columns ('<name>/time', '<name>/value', or
+        '<name>/<pid>/time' for per-PID channels), timestamps as a small time/name table, and every
+        other attribute as a JSON header. Round-trips losslessly with the JSON format.'''
+        if not numpy_exists:
+            raise ImportError('Cannot save log as npz, numpy is not installed!')
+        arrays = dict()
+        header = dict()
+        for name, val in self.__dict__.items():
+            if name.startswith('_'):
+                continue
+            if name in Log._CHANNELS:
+                arrays[f'{name}/time'], arrays[f'{name}/value'] = val.to_numpy()
+            elif name in Log._PID_CHANNELS:
+                header[name] = [str(pid) for pid in val.keys()] # keep PID order
+                for pid, ch in val.items():
+                    arrays[f'{name}/{pid}/time'], arrays[f'{name}/{pid}/value'] = ch.to_numpy()
+            elif name == 'timestamps':
+                arrays['timestamps/time'] = np.array([entry.time for entry in val], dtype=np.float64)
+                arrays['timestamps/value'] = np.array([entry.value for entry in val], dtype=np.str_)
+            else:
+                header[name] = val
+        arrays['header'] = np.array(dumps(header))
+        np.savez_compressed(path, **arrays)
+
+    def from_npz(path: str):
+        '''Loads Log object from a NumPy (.npz) file created with Log.to_npz(). Requires numpy.'''
+        if not numpy_exists:
+            raise ImportError('Cannot load npz log, numpy is not installed!')
+        newlog = Log()
+        with np.load(path, allow_pickle=False) as data:
+            header = loads(str(data['header']))
+            for name in Log._PID_CHANNELS:
+                pids = header.pop(name, list())
+                newlog.__dict__[name] = {pid: Channel.from_buffers(data[f'{name}/{pid}/time'], data[f'{name}/{pid}/value']) for pid in pids}
+            newlog.__dict__.update(header)
+            for name in Log._CHANNELS:
+                if f'{name}/time' in data.files:
+                    newlog.__dict__[name] = Channel.from_buffers(data[f'{name}/time'], data[f'{name}/value'])
+            newlog.timestamps = [LogEntry(float(t), str(v)) for t, v in zip(data['timestamps/time'], data['timestamps/value'])]
+        return newlog
+
+    def from_ndjson(path: str):
+        '''Loads Log object from an NDJSON stream file written by LogStream.
+        Samples are reassembled from every chunk in the file, and the header is applied if it was written.'''
+        newlog = Log()
+        with open(path, 'r') as fp:
+            for line in fp:
+                if len(line.strip()) == 0:
+                    continue
+                try:
+                    data = loads(line, cls=Log._LogJSONDecoder)
+                except JSONDecodeError:
+                    break # partially written line at the end of an interrupted stream
+                if 'channel' in data:
+                    name = data['channel']
+                    if 'pid' in data:
+                        ch = newlog.__dict__[name].setdefault(str(data['pid']), Channel())
+                    else:
+                        ch = newlog.__dict__[name]
+                    for t, v in zip(data['time'], data['value']):
+                        ch.append(t, v)
+                elif 'header' in data:
+                    newlog.__dict__.update(data['header'])
+        return newlog
+
+    def save(self, path: str):
+        '''Saves Log object to a file, using the format matching the file extension (.json, .npz or .ndjson).'''
+        if path.endswith('.npz'):
+            self.to_npz(path)
+        elif path.endswith('.ndjson'):
+            stream = LogStream(path)
+            stream.write_chunks(self, clear=False)
+            stream.finalize(self)
+        else:
+            with open(path, 'w') as fp:
+                fp.write(self.to_json())
     
     def print(self, in_order: bool = False):
         '''Prints log data in the console.
@@ -224,39 +530,340 @@ class Log:
                 print(f'  ({entry.time:.4f} s): {entry.value} MHz')
 
     
-    def begin(self, interval: float = 0.5):
-        '''Begin logging statistics. Raises a RuntimeError if the log is not a new instance.'''
+    def begin(self, interval: float = 0.5, stream_path: str = None, stream_chunk_size: int = 600,
+              checkpoint_path: str = None, checkpoint_interval: float = 30.0, sampler: Sampler = None):
+        '''Begin logging statistics. Raises a RuntimeError if the log is not a new instance.
+        
+        Readings are taken by the given sampler (see samplers.py). By default, jtop is used if it is
+        installed, otherwise sensors are read from sysfs directly. Raises an ImportError if neither is available.
+        The default sampler is closed when the log ends, but a given sampler is only stopped, so it can be reused.
+        
+        If a stream path is given, samples are written to that file (in NDJSON format) in chunks of
+        the given number of samples, instead of being kept in memory until the log is saved. The log
+        header and timestamps are written when the log ends. When streaming, the Log object itself only
+        holds samples that haven't been written yet, so the full log should be loaded from the file.
+        
+        If a checkpoint path is given, the log is checkpointed to that file every checkpoint_interval
+        seconds (see LogCheckpoint), so it can be recovered with recover() if the test is interrupted.'''
         if self.time_log_start != -1:
             raise RuntimeError('Attempted to start a log after it had already been started once!')
-        if not jtop_exists:
-            raise ImportError('Cannot begin log, jtop is not installed!')
-        self._jtop = jtop(interval=interval)
-        self._jtop.attach(self._log_cb)
+        # a sampler made here is closed when the log ends, a given one is left open to be reused
+        self._close_sampler = sampler is None
+        if sampler is None:
+            sampler = default_sampler()
+        if stream_path is not None:
+            self._stream = LogStream(stream_path, stream_chunk_size)
+        if checkpoint_path is not None:
+            self._checkpoint = LogCheckpoint(checkpoint_path)
+        self._checkpoint_interval = checkpoint_interval
+        self._checkpoint_time = 0
+        self._sampler = sampler
+        self.sampler_info = {'name': sampler.name, 'interval': interval}
+        self._ticks = TickStats(interval, sampler.scheduled)
         self.time_log_start = get_time()
         self.add_timestamp('LOG_START')
-        self._jtop.start()
+        self._sampler.start(interval, self._log_cb)
 
     def end(self):
-        '''Ends the log. Raises a RuntimeError if the log has not started or has already finished.'''
+        '''Ends the log. Raises a RuntimeError if the log has not started or has already finished.
+        The log is marked as truncated if the sampler failed to take any of its readings (see Sampler.overhead()).'''
         if self.time_log_start == -1:
             raise RuntimeError('Attempted to end a log when it hasn\'t been started!')
         if self.time_log_end != -1:
             raise RuntimeError('Attempted to end a log after it had already ended!')
-        if not jtop_exists:
-            raise ImportError('Cannot end log, jtop is not installed!')
         
-        self._jtop.close()
+        self._sampler.stop()
         self.add_timestamp('LOG_END')
         self.time_log_end = get_time()
-        del self._jtop
+        self.sampler_info.update(self._sampler.overhead())
+        self.sampler_info.update(self._ticks.summary())
+        if self.sampler_info.get('read_errors', 0) > 0:
+            # samples are missing wherever the sampler failed to take a reading
+            self.truncated = True
+        if self._close_sampler:
+            self._sampler.close()
+        del self._sampler
+
+        if self._stream is not None:
+            self._stream.write_chunks(self)
+            self._stream.finalize(self)
+            self._stream = None
+        if self._checkpoint is not None:
+            self._checkpoint.close()
+            self._checkpoint = None
+
+
+class TickStats:
+    '''Running statistics of the timing of sampler ticks.
+
+    For samplers that schedule their own ticks (see Sampler.scheduled), ticks are expected every interval
+    seconds from the first tick, and a tick that comes later than a whole interval after its scheduled time
+    counts the ticks in between as missed. Other samplers (i.e. jtop) run on a timer of their own, whose rate
+    can differ slightly from perf_counter(), so a fixed schedule would drift away from their ticks. Their ticks
+    are expected an interval after the previous tick instead, and a gap of more than one and a half intervals
+    counts the ticks in between as missed. Delays are counted in a histogram with logarithmic buckets
+    (~9% wide), so memory use is constant even for streamed logs.'''
+
+    BUCKETS_PER_OCTAVE = 8
+    '''Number of histogram buckets per doubling of the delay'''
+    PERCENTILES = (50, 90, 99)
+    '''Jitter percentiles reported by summary()'''
+
+    interval: float
+    scheduled: bool
+    '''Whether ticks are expected on a fixed schedule from the first tick, rather than from the previous tick'''
+    ticks: int
+    '''Number of ticks seen'''
+    missed: int
+    '''Number of expected ticks that were skipped'''
+
+    def __init__(self, interval: float, scheduled: bool = False):
+        self.interval = interval
+        self.scheduled = scheduled
+        self.ticks = 0
+        self.missed = 0
+        self._first = -1
+        self._index = 0
+        self._last = -1
+        self._jitter_hist = list()
+        self._jitter_max = 0
+        self._duration_total = 0
+        self._duration_max = 0
+
+    def tick(self, t: float) -> float:
+        '''Records a tick at the given time, returning its delay from the expected time (in seconds).
+        The delay is negative for ticks that come early.'''
+        self.ticks += 1
+        if self._last == -1:
+            self._first = t
+            delay = 0
+        elif self.scheduled:
+            self._index += 1
+            delay = t - (self._first + self._index * self.interval)
+            if delay >= self.interval:
+                missed = int(delay / self.interval)
+                self.missed += missed
+                self._index += missed
+                delay -= missed * self.interval
+            elif delay <= -self.interval / 2:
+                # the sampler restarted its schedule, follow it from this tick
+                self._first = t
+                self._index = 0
+                delay = 0
+        else:
+            delay = t - self._last - self.interval
+            if delay >= self.interval / 2:
+                missed = int(delay / self.interval + 0.5)
+                self.missed += missed
+                delay -= missed * self.interval
+        self._last = t
+
+        # histogram bucket of the absolute delay in microseconds
+        jitter = abs(delay)
+        bucket = int(math.log2(jitter * 1e6 + 1) * self.BUCKETS_PER_OCTAVE)
+        if bucket >= len(self._jitter_hist):
+            self._jitter_hist.extend([0] * (bucket + 1 - len(self._jitter_hist)))
+        self._jitter_hist[bucket] += 1
+        self._jitter_max = max(self._jitter_max, jitter)
+        return delay
+
+    def add_duration(self, duration: float):
+        '''Records the time taken by the logging callback on a tick (in seconds).'''
+        self._duration_total += duration
+        self._duration_max = max(self._duration_max, duration)
+
+    def jitter_percentile(self, pct: float) -> float:
+        '''Returns the given percentile of the absolute tick delay (in seconds), rounded up to its histogram bucket.'''
+        target = self.ticks * pct / 100
+        count = 0
+        for bucket, n in enumerate(self._jitter_hist):
+            count += n
+            if count >= target and n > 0:
+                return min((2 ** ((bucket + 1) / self.BUCKETS_PER_OCTAVE) - 1) / 1e6, self._jitter_max)
+        return self._jitter_max
+
+    def summary(self) -> dict:
+        '''Returns the number of ticks ('ticks') and missed ticks ('missed_ticks'), the jitter percentiles
+        ('jitter_p<N>') and maximum ('jitter_max'), and the mean and maximum callback durations
+        ('callback_time_mean', 'callback_time_max'). All times are in seconds.'''
+        summary = {'ticks': self.ticks, 'missed_ticks': self.missed}
+        for pct in self.PERCENTILES:
+            summary[f'jitter_p{pct}'] = self.jitter_percentile(pct)
+        summary['jitter_max'] = self._jitter_max
+        summary['callback_time_mean'] = self._duration_total / self.ticks if self.ticks > 0 else 0
+        summary['callback_time_max'] = self._duration_max
+        return summary
+
+
+class LogStream:
+    '''Append-only writer for streaming a Log to an NDJSON file during logging.
+    
+    Each line of the file is a JSON object, either a chunk of samples from one channel:
+      {"channel": "power", "time": [...], "value": [...]}
+      {"channel": "memory_ram", "pid": 1234, "time": [...], "value": [...]}
+    or the log header (all other attributes, including timestamps), written once at the end:
+      {"header": {"time_log_start": ..., "timestamps": [...], ...}}
+    Use Log.from_ndjson() or load() to reassemble the log.'''
+
+    path: str
+    '''Path of the stream file.'''
+    chunk_size: int
+    '''Number of samples buffered in memory (per channel) before they are written to the file.'''
 
+    def __init__(self, path: str, chunk_size: int = 600):
+        self.path = path
+        self.chunk_size = chunk_size
+        self._fp = open(path, 'w')
 
+    def _write_line(self, data: dict):
+        self._fp.write(dumps(data, cls=Log._LogJSONEncoder) + '\n')
+
+    def write_chunks(self, log: Log, clear: bool = True):
+        '''Writes all buffered samples in the log to the file, removing them from the log unless clear is False.'''
+        for name in Log._CHANNELS:
+            ch: Channel = log.__dict__[name]
+            if len(ch) > 0:
+                self._write_line({'channel': name, 'time': ch.times().tolist(), 'value': ch.values().tolist()})
+                if clear:
+                    ch.clear()
+        for name in Log._PID_CHANNELS:
+            for pid, ch in log.__dict__[name].items():
+                if len(ch) > 0:
+                    self._write_line({'channel': name, 'pid': pid, 'time': ch.times().tolist(), 'value': ch.values().tolist()})
+                    if clear:
+                        ch.clear()
+        self._fp.flush()
+        os.fsync(self._fp.fileno())
+
+    def finalize(self, log: Log):
+        '''Writes the log header and timestamps, then closes the file.'''
+        header = {k: v for k, v in log.__dict__.items() if not k.startswith('_') and k not in Log._CHANNELS + Log._PID_CHANNELS}
+        self._write_line({'header': header})
+        self._fp.close()
+
+
+class LogCheckpoint:
+    '''Incremental checkpoint of a Log during logging, written to disk by a thread of its own.
+
+    Each checkpoint appends the samples added to the log since the previous one, followed by the current
+    log header (marked as truncated), to an NDJSON file in the LogStream format. The cost of a checkpoint
+    doesn't grow with the log, and only copying the new samples is done on the thread taking the snapshot
+    (the sampler's), while serializing, writing and syncing the file is done by the writer thread. Reading
+    the file back with Log.from_ndjson() gives every checkpointed sample, with the header of the last
+    complete checkpoint. For streamed logs, samples already written to the stream are not checkpointed.'''
+
+    path: str
+    '''Path of the checkpoint file.'''
+
+    def __init__(self, path: str):
+        self.path = path
+        self._fp = open(path, 'w')
+        self._written = dict()
+        self._queue = SimpleQueue()
+        self._thread = threading.Thread(target=self._run, name='log-checkpoint', daemon=True)
+        self._thread.start()
+
+    def _new_samples(self, key: tuple, ch: Channel, line: dict) -> dict:
+        # samples of a channel not in any earlier snapshot, by their index counting cleared samples
+        n = len(ch)
+        start = max(self._written.get(key, 0) - ch._offset, 0)
+        self._written[key] = ch._offset + n
+        if start >= n:
+            return None
+        line['time'] = ch.times()[start:n].tolist()
+        line['value'] = ch.values()[start:n].tolist()
+        return line
+
+    def snapshot(self, log: Log):
+        '''Queues the samples added to the log since the last snapshot, and a copy of its header, to be written.'''
+        lines = list()
+        for name in Log._CHANNELS:
+            lines.append(self._new_samples((name,), log.__dict__[name], {'channel': name}))
+        for name in Log._PID_CHANNELS:
+            for pid, ch in list(log.__dict__[name].items()):
+                lines.append(self._new_samples((name, pid), ch, {'channel': name, 'pid': pid}))
+        header = dict()
+        for k, v in list(log.__dict__.items()):
+            if not k.startswith('_') and k not in Log._CHANNELS + Log._PID_CHANNELS:
+                header[k] = list(v) if isinstance(v, list) else dict(v) if isinstance(v, dict) else v
+        header['truncated'] = True
+        lines.append({'header': header})
+        self._queue.put([x for x in lines if x is not None])
+
+    def _run(self):
+        while True:
+            lines = self._queue.get()
+            if lines is None:
+                break
+            for line in lines:
+                self._fp.write(dumps(line, cls=Log._LogJSONEncoder) + '\n')
+            self._fp.flush()
+            os.fsync(self._fp.fileno())
+
+    def close(self):
+        '''Writes any queued snapshots, then stops the writer thread and closes the file.'''
+        self._queue.put(None)
+        self._thread.join()
+        self._fp.close()
+
+
+
+def load(path: str) -> Log:
+    '''Loads a Log object from a file, using the format matching the file extension (.json, .npz or .ndjson).'''
+    if path.endswith('.npz'):
+        return Log.from_npz(path)
+    if path.endswith('.ndjson'):
+        return Log.from_ndjson(path)
+    with open(path, 'r') as fp:
+        return Log.from_json(fp.read())
+
+def _merge_channels(a: Channel, b: Channel) -> Channel:
+    # measurements of both channels in order of time, keeping one copy of any measurement found in both
+    entries = sorted(list(a) + list(b), key=lambda x: x.time)
+    merged = Channel(len(entries))
+    for entry in entries:
+        if len(merged) == 0 or merged[-1].time != entry.time or merged[-1].value != entry.value:
+            merged.append(entry.time, entry.value)
+    return merged
+
+def recover(path: str) -> Log:
+    '''Recovers the log of an interrupted test, given the path it would have been saved to.
+
+    The log is rebuilt from its checkpoint file (path + CHECKPOINT_SUFFIX) and, for streamed logs,
+    from the samples already written to the stream file. Samples from the two are merged in order of
+    time, since samples held out of the stream (see Log.hold_stream()) are only in the checkpoint.
+    The recovered log is marked as truncated, and its end time is set to the last recorded sample
+    if the log never ended.'''
+    log = Log()
+    checkpoint_path = path + CHECKPOINT_SUFFIX
+    if os.path.exists(checkpoint_path):
+        log = Log.from_ndjson(checkpoint_path)
+    if path.endswith('.ndjson') and os.path.exists(path):
+        streamed = Log.from_ndjson(path)
+        if streamed.time_log_start != -1:
+            log = streamed # the stream was finalized, so it has every sample and a more recent header than the checkpoint
+        else:
+            for name in Log._CHANNELS:
+                log.__dict__[name] = _merge_channels(log.__dict__[name], streamed.__dict__[name])
+            for name in Log._PID_CHANNELS:
+                channels = log.__dict__[name]
+                for pid, ch in streamed.__dict__[name].items():
+                    channels[pid] = _merge_channels(channels[pid], ch) if pid in channels else ch
+
+    log.truncated = True
+    if log.time_log_end == -1 and log.time_log_start != -1:
+        last_times = [log.timestamps[-1].time] if len(log.timestamps) > 0 else [0]
+        for ch in [log.power, log.freq_gpu]:
+            if len(ch) > 0:
+                last_times.append(ch[-1].time)
+        log.time_log_end = log.time_log_start + max(last_times)
+    return log
 
-def run_blocking(duration: float, interval: float = 0.5) -> Log:
+def run_blocking(duration: float, interval: float = 0.5, sampler: Sampler = None) -> Log:
     '''Log for a set duration, blocking the thread until completed.
     Useful for taking a baseline measurement when not running a test.'''
     log = Log()
-    log.begin(interval=interval)
+    log.begin(interval=interval, sampler=sampler)
     sleep(duration)
     log.end()
     return log
@@ -1,41 +1,73 @@
 import os
-import json
+import statlog
 
 print('Searching...')
 
 log_paths = list()
+partial_paths = list()
 for p, _, fs in list(os.walk('./out')):
     for f in fs:
-        if f.startswith('log_') and f.endswith('json'):
+        if f.startswith('log_') and os.path.splitext(f)[1] in ['.json', '.npz', '.ndjson']:
             log_paths.append(os.path.join(p, f))
+        elif f.startswith('log_') and f.endswith(statlog.CHECKPOINT_SUFFIX):
+            partial_paths.append(os.path.join(p, f))
+
+# salvage logs of interrupted tests from their checkpoints (and streamed samples)
+if len(partial_paths) > 0:
+    print(f'Found {len(partial_paths)} interrupted logs\nRecovering...')
+for partial_path in partial_paths:
+    path = partial_path[:-len(statlog.CHECKPOINT_SUFFIX)]
+    data = statlog.recover(path)
+    data.save(path)
+    os.remove(partial_path)
+    if path not in log_paths:
+        log_paths.append(path)
+    print(f'--- {os.path.basename(path)}: Recovered truncated log')
 
 print(f'Found {len(log_paths)} logs\nValidating...')
 
 bad_logs = list()
+truncated_logs = list()
 for path in log_paths:
     filename = os.path.basename(path)
     failed = False
-    data = None
-    with open(path, 'r') as fp:
-        data = json.load(fp)
+    data = statlog.load(path)
     if data == None:
-        print(f'!!! {filename}: Failed to load JSON')
+        print(f'!!! {filename}: Failed to load log')
         failed = True
 
-    stamps: list[str] = [x['value'] for x in data['timestamps']]
+    if path.endswith('.ndjson') and data.time_log_start == -1:
+        # streamed log without a header or checkpoint, keep what samples were written
+        data = statlog.recover(path)
+        data.save(path)
+        print(f'--- {filename}: Recovered truncated log')
+
+    if data.truncated:
+        # truncated logs are kept, but reported separately from bad logs
+        print(f'--- {filename}: Log is truncated')
+        truncated_logs.append(path)
+        continue
+
+    stamps: list[str] = [x.value for x in data.timestamps]
     for stamp in stamps:
         if stamp.endswith('_START'):
             end_stamp = stamp.rsplit('_', 1)[0] + '_END'
-            if not end_stamp in stamps:
+            if data.get_timestamp(end_stamp) == -1:
                 print(f'!!! {filename}: {stamp} has no corresponding timestamp')
                 failed = True
         if stamp.endswith('_END'):
             start_stamp = stamp.rsplit('_', 1)[0] + '_START'
-            if not start_stamp in stamps:
+            if data.get_timestamp(start_stamp) == -1:
                 print(f'!!! {filename}: {stamp} has no corresponding timestamp')
                 failed = True
     
-    tokens = int(data['tokens_generated'])
+    timing = data.sampler_info
+    if timing.get('missed_ticks', 0) > 0:
+        # not a failure, but the analysis scripts may skip the log (see analysis/log_summary.py)
+        print(f'--- {filename}: Sampler missed {timing["missed_ticks"]} of {timing["ticks"] + timing["missed_ticks"]} ticks '
+              f'(jitter p99 {timing["jitter_p99"] * 1000:.2f} ms)')
+
+    tokens = int(data.tokens_generated)
     if tokens < 0:
         print(f'!!! {filename}: tokens_generated = {tokens}')
         failed = True
@@ -44,6 +76,9 @@ for path in log_paths:
         bad_logs.append(path)
 
 
+if len(truncated_logs) > 0:
+    print(f'{len(truncated_logs)} logs are truncated, these are kept but skipped by the analysis scripts')
+
 if len(bad_logs) > 0:
     if input(f'Remove {len(bad_logs)} bad logs? y/N: ').lower() == 'y':
         for path in bad_logs: